@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# This script reads and writes datasets in chunks, so that memory stays bounded by the chunk size.
+# Datasets are csv files, or parquet files (by their .parquet extension) storing the polarity as a categorical.
+
+import os
+
+import pandas as pd
+
+DATASET_TEXT_LABEL = 'text'
+DATASET_TARGET_LABEL = 'polarity'
+POLARITIES = ['negative', 'neutral', 'positive']
+CHUNK_SIZE = 10000
+
+def is_parquet(path):
+	'''Returns whether a dataset path is a parquet file, by its extension.
+
+	Args:
+		path: Path of the dataset.
+	'''
+	return os.path.splitext(path)[1].lower() == '.parquet'
+
+def read_chunks(path, columns=None, chunk_size=CHUNK_SIZE):
+	'''Yields DataFrames of the rows of a csv or parquet dataset, chunk_size rows at a time.
+
+	Args:
+		path: Path of the dataset.
+		columns: List of the columns to read, or None to read every column.
+		chunk_size: Number of rows per chunk.
+	'''
+	if is_parquet(path):
+		import pyarrow.parquet as pq
+
+		for batch in pq.ParquetFile(path).iter_batches(chunk_size, columns=columns):
+			yield batch.to_pandas()
+		return
+
+	for chunk in pd.read_csv(path, usecols=columns, chunksize=chunk_size):
+		yield chunk
+
+def count_rows(path):
+	'''Returns the number of rows of a csv or parquet dataset.
+
+	Args:
+		path: Path of the dataset.
+	'''
+	if is_parquet(path):
+		import pyarrow.parquet as pq
+
+		return pq.ParquetFile(path).metadata.num_rows
+	return sum(len(chunk) for chunk in read_chunks(path, [DATASET_TEXT_LABEL]))
+
+def to_polarity_categorical(polarities):
+	'''Returns polarity values as a categorical with the same categories in every chunk.
+
+	Args:
+		polarities: A pandas Series of polarity values.
+	'''
+	return pd.Categorical(polarities.astype(str), categories=POLARITIES)
+
+class ChunkWriter(object):
+	'''Writes a dataset one chunk at a time, to a csv file or to a parquet file with a categorical polarity column.
+
+	The dataset is written to a temporary file which replaces the output path when the writer is closed,
+	unless rows are appended to an existing csv dataset.
+	'''
+	def __init__(self, path, columns=(DATASET_TEXT_LABEL, DATASET_TARGET_LABEL), append=False):
+		'''Initializes a ChunkWriter object.
+
+		Args:
+			path: Output path of the dataset.
+			columns: Columns of the dataset, of text values except the polarity.
+			append: Whether rows are appended to the dataset if it exists. Only csv datasets can be appended to.
+		'''
+		super(ChunkWriter, self).__init__()
+		if append and is_parquet(path):
+			raise ValueError('rows can not be appended to a parquet dataset: ' + path)
+
+		self.path = path
+		self.columns = columns
+		self.append = append and os.path.exists(path)
+		# the rows of an existing dataset count towards its csv index
+		self.rows = count_rows(path) if self.append else 0
+		self.tmp_path = path if self.append else path + '.tmp'
+		self.parquet_writer = None
+
+	def write(self, chunk):
+		'''Appends a chunk of rows to the dataset.
+
+		Args:
+			chunk: A DataFrame with the columns of the dataset.
+		'''
+		chunk = chunk[list(self.columns)].reset_index(drop=True)
+		if DATASET_TARGET_LABEL in chunk:
+			chunk[DATASET_TARGET_LABEL] = to_polarity_categorical(chunk[DATASET_TARGET_LABEL])
+
+		if is_parquet(self.path):
+			import pyarrow as pa
+			import pyarrow.parquet as pq
+
+			if self.parquet_writer is None:
+				schema = pa.schema([(column, pa.dictionary(pa.int8(), pa.string()) if column == DATASET_TARGET_LABEL else pa.string()) for column in self.columns])
+				self.parquet_writer = pq.ParquetWriter(self.tmp_path, schema)
+			self.parquet_writer.write_table(pa.Table.from_pandas(chunk, schema=self.parquet_writer.schema, preserve_index=False))
+		else:
+			# the csv index continues across chunks, as if the dataset was written at once
+			chunk.index = range(self.rows, self.rows + len(chunk))
+			is_first = self.rows == 0 and not self.append
+			chunk.to_csv(self.tmp_path, mode='w' if is_first else 'a', header=is_first)
+
+		self.rows += len(chunk)
+
+	def close(self):
+		'''Finishes writing the dataset and moves it to its output path. Returns the number of rows of the dataset.
+		'''
+		if not os.path.exists(self.tmp_path):
+			# an empty dataset still has its columns
+			self.write(pd.DataFrame({column: pd.Series([], dtype=str) for column in self.columns}))
+		if self.parquet_writer is not None:
+			self.parquet_writer.close()
+		if not self.append:
+			os.replace(self.tmp_path, self.path)
+		return self.rows
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			if self.parquet_writer is not None:
+				self.parquet_writer.close()
+			if not self.append and os.path.exists(self.tmp_path):
+				os.remove(self.tmp_path)
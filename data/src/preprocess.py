@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+# This script preprocesses the texts of a csv or parquet dataset with vectorized pandas string operations.
+# The preprocessed rows can be cached to a parquet file keyed by the hash of the dataset file and the preprocessing options,
+# so that repeated runs read them instead of preprocessing the dataset again.
+
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+import datasetio
+
+DATASET_COMPONENT_LABEL = 'set'
+DATASET_TEXT_LABEL = 'text'
+DATASET_TARGET_LABEL = 'polarity'
+
+# 'clean' only keeps alphabets and spaces, 'stopwords' removes english stopwords
+STEPS = ('clean', 'stopwords')
+CLEAN_PATTERN = '[^a-zA-Z ]'
+STOPWORDS_RESOURCE = ('stopwords', 'corpora/stopwords')
+# changing how texts are preprocessed must change this, so that previously cached rows are not reused
+CACHE_VERSION = 2
+CHUNK_SIZE = 10000
+
+def load_stop_words(download=False):
+	'''Returns the set of english stopwords of nltk.
+
+	Args:
+		download: Whether the stopwords may be downloaded if they are missing. Otherwise the network is never used.
+	'''
+	import nltk
+
+	package, resource_path = STOPWORDS_RESOURCE
+	try:
+		nltk.data.find(resource_path)
+	except LookupError:
+		if not download:
+			raise RuntimeError('missing resources for preprocessing: nltk {p} ({r}), allow downloading them to retrieve missing nltk data'.format(p=package, r=resource_path))
+		nltk.download(package)
+
+	from nltk.corpus import stopwords
+	return set(stopwords.words('english'))
+
+def to_texts(texts):
+	'''Returns the values of a pandas Series as strings, missing values included as 'nan' like with pandas before 3.0.
+
+	Args:
+		texts: A pandas Series of texts.
+	'''
+	return texts.where(texts.notna(), 'nan').astype(str)
+
+def clean_texts(texts):
+	'''Returns the texts with all characters except alphabets and spaces removed.
+
+	Args:
+		texts: A pandas Series of texts.
+	'''
+	return to_texts(texts).str.replace(CLEAN_PATTERN, '', regex=True)
+
+def remove_stop_words(texts, stop_words):
+	'''Returns the texts with their stopwords removed, the remaining words separated by single spaces.
+
+	Args:
+		texts: A pandas Series of texts.
+		stop_words: Set of stopwords.
+	'''
+	# every word is a row of the exploded series, labelled with the position of its text
+	words = to_texts(texts).reset_index(drop=True).str.split().explode()
+	words = words[words.notna() & ~words.isin(stop_words)]
+	joined = words.groupby(level=0).agg(' '.join)
+	return pd.Series(joined.reindex(range(len(texts)), fill_value='').values, index=texts.index, dtype=object)
+
+def preprocess(texts, steps, stop_words=None):
+	'''Returns the texts after applying the preprocessing steps.
+
+	Args:
+		texts: A pandas Series of texts.
+		steps: Sequence of preprocessing steps out of STEPS, applied in that order.
+		stop_words: Set of stopwords, required if stopwords are removed.
+	'''
+	texts = to_texts(texts)
+	if 'clean' in steps:
+		texts = clean_texts(texts)
+	if 'stopwords' in steps:
+		texts = remove_stop_words(texts, stop_words)
+	return texts
+
+def hash_file(path):
+	'''Returns the sha256 hex digest of a file's content.
+
+	Args:
+		path: Path of the file.
+	'''
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+def get_cache_path(cache_dir, dataset_path, steps, component):
+	'''Returns the path of the parquet file caching the preprocessed rows of a dataset.
+
+	Args:
+		cache_dir: Directory of the cached files.
+		dataset_path: Path to the csv dataset.
+		steps: Sequence of preprocessing steps.
+		component: Value of the set column of the rows kept, eg. 'test', or None to keep every row.
+	'''
+	options = json.dumps({'version': CACHE_VERSION, 'file': hash_file(dataset_path), 'steps': list(steps), 'component': component}, sort_keys=True)
+	key = hashlib.sha256(options.encode('utf-8')).hexdigest()[:16]
+	name = os.path.splitext(os.path.basename(dataset_path))[0]
+	return os.path.join(cache_dir, '{n}-{k}.parquet'.format(n=name, k=key))
+
+def iterate_chunks(dataset_path, steps, component=None, chunk_size=CHUNK_SIZE, download=False):
+	'''Yields DataFrames of the preprocessed text and polarity of the rows of a csv or parquet dataset, read in chunks.
+
+	Args:
+		dataset_path: Path to the csv or parquet dataset.
+		steps: Sequence of preprocessing steps.
+		component: Value of the set column of the rows kept, eg. 'test', or None to keep every row.
+		chunk_size: Number of csv rows read at a time.
+		download: Whether missing nltk data may be downloaded.
+	'''
+	stop_words = load_stop_words(download) if 'stopwords' in steps else None
+	columns = [DATASET_TEXT_LABEL, DATASET_TARGET_LABEL] + ([] if component is None else [DATASET_COMPONENT_LABEL])
+	for chunk in datasetio.read_chunks(dataset_path, columns, chunk_size):
+		if component is not None:
+			chunk = chunk[chunk[DATASET_COMPONENT_LABEL] == component]
+		yield pd.DataFrame({
+			DATASET_TEXT_LABEL: preprocess(chunk[DATASET_TEXT_LABEL], steps, stop_words).values,
+			DATASET_TARGET_LABEL: chunk[DATASET_TARGET_LABEL].astype(str).values
+		})
+
+def build_cache(dataset_path, steps, component=None, cache_dir=None, download=False):
+	'''Returns the path of the parquet file caching the preprocessed rows of a dataset, writing it if it does not exist yet.
+	Returns None if the cache is disabled or pyarrow is not installed.
+
+	Args:
+		dataset_path: Path to the csv dataset.
+		steps: Sequence of preprocessing steps.
+		component: Value of the set column of the rows kept, eg. 'test', or None to keep every row.
+		cache_dir: Directory of the cached files, or None to disable the cache.
+		download: Whether missing nltk data may be downloaded.
+	'''
+	if cache_dir is None:
+		return None
+	try:
+		import pyarrow as pa
+		import pyarrow.parquet as pq
+	except ImportError:
+		print('pyarrow is not installed, preprocessed rows are not cached')
+		return None
+
+	cache_path = get_cache_path(cache_dir, dataset_path, steps, component)
+	if os.path.exists(cache_path):
+		return cache_path
+
+	os.makedirs(cache_dir, exist_ok=True)
+	schema = pa.schema([(DATASET_TEXT_LABEL, pa.string()), (DATASET_TARGET_LABEL, pa.string())])
+	# written to a temporary file of its own first, so that an interrupted run does not leave a partial cache
+	# and runs preprocessing the same dataset at once do not write to the same file
+	fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+	os.close(fd)
+	try:
+		with pq.ParquetWriter(tmp_path, schema) as writer:
+			for chunk in iterate_chunks(dataset_path, steps, component, download=download):
+				writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+		os.replace(tmp_path, cache_path)
+	except BaseException:
+		os.remove(tmp_path)
+		raise
+	return cache_path
+
+def iterate_batches(dataset_path, steps, batch_size, component=None, cache_dir=None, download=False):
+	'''Yields DataFrames of the preprocessed text and polarity of the rows of a csv dataset, in batches of batch_size rows.
+
+	The rows are read from the parquet cache if it is enabled, preprocessing the dataset into it first if needed.
+
+	Args:
+		dataset_path: Path to the csv dataset.
+		steps: Sequence of preprocessing steps.
+		batch_size: Number of rows per batch.
+		component: Value of the set column of the rows kept, eg. 'test', or None to keep every row.
+		cache_dir: Directory of the cached files, or None to disable the cache.
+		download: Whether missing nltk data may be downloaded.
+	'''
+	cache_path = build_cache(dataset_path, steps, component, cache_dir, download)
+	if cache_path is not None:
+		import pyarrow.parquet as pq
+
+		for batch in pq.ParquetFile(cache_path).iter_batches(batch_size):
+			yield batch.to_pandas()
+		return
+
+	pending = pd.DataFrame({DATASET_TEXT_LABEL: [], DATASET_TARGET_LABEL: []})
+	for chunk in iterate_chunks(dataset_path, steps, component, max(batch_size, CHUNK_SIZE), download):
+		pending = pd.concat([pending, chunk], ignore_index=True)
+		while len(pending) >= batch_size:
+			yield pending.iloc[:batch_size]
+			pending = pending.iloc[batch_size:]
+	if len(pending) > 0:
+		yield pending
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='preprocess the texts of a csv dataset and cache the result')
+	parser.add_argument('-dp', '--datasetpath', help='string: path to the csv data file', type=str, action='store', required=True)
+	parser.add_argument('-st', '--steps', help='string: comma separated preprocessing steps out of ' + str(STEPS), type=str, action='store', default='clean')
+	parser.add_argument('-c', '--component', help='string: only preprocess rows of this set, eg. test', type=str, action='store', required=False)
+	parser.add_argument('-cd', '--cachedir', help='string: directory of the cached parquet files', type=str, action='store', required=True)
+	parser.add_argument('-dl', '--download', help='download the required nltk data', action='store_true')
+	args = parser.parse_args()
+
+	steps = [step for step in args.steps.split(',') if len(step) > 0]
+	for step in steps:
+		if step not in STEPS:
+			parser.error('unknown preprocessing step: ' + step)
+
+	print(build_cache(args.datasetpath, steps, args.component, args.cachedir, args.download))
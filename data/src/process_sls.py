@@ -1,29 +1,58 @@
 #!/usr/bin/env python3
 
-import pandas as pd
+# This script converts text files of the sentiment labelled sentences dataset to csv (or parquet) files.
+# Each file is read in chunks of lines and several files are converted in parallel.
+
+from concurrent.futures import ProcessPoolExecutor
 import argparse
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+
+import datasetio
+
+def convert_chunk(lines):
+	'''Returns a DataFrame of the text and polarity of a chunk of lines, each a sentence followed by its 0 or 1 label.
+
+	Args:
+		lines: List of lines.
+	'''
+	lines = pd.Series(lines, dtype=object).str.strip()
+	lines = lines[lines.str.len() > 0]
+	return pd.DataFrame({
+		datasetio.DATASET_TEXT_LABEL: lines.str[:-1].values,
+		datasetio.DATASET_TARGET_LABEL: np.where(lines.str[-1] == '1', 'positive', 'negative')
+	})
+
+def convert(dataset_path, output_path, chunk_size=datasetio.CHUNK_SIZE):
+	'''Converts a text file of the sentiment labelled sentences dataset. Returns the number of rows written.
+
+	Args:
+		dataset_path: Path of the .txt data file.
+		output_path: Output path of the .csv or .parquet file.
+		chunk_size: Number of lines read at a time.
+	'''
+	with open(dataset_path) as f, datasetio.ChunkWriter(output_path) as writer:
+		while True:
+			lines = list(itertools.islice(f, chunk_size))
+			if len(lines) == 0:
+				break
+			writer.write(convert_chunk(lines))
+		return writer.rows
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Process arguments to convert text files of the sentiment labelled sentences dataset to csv files')
+	parser.add_argument('-dp', '--datasetpath', help='string: paths of data .txt files', type=str, nargs='+', action='store', required=True)
+	parser.add_argument('-op', '--outputpath', help='string: output paths of .csv (or .parquet) files, one per data file', type=str, nargs='+', action='store', required=True)
+	parser.add_argument('-w', '--workers', help='int: number of files converted in parallel, defaults to the number of cpus', type=int, action='store', required=False)
+	args = parser.parse_args()
+
+	if len(args.datasetpath) != len(args.outputpath):
+		parser.error('one output path is required per data file')
 
-parser = argparse.ArgumentParser(description='Process arguments to convert text files of the sentiment labelled sentences dataset to csv files')
-parser.add_argument('-dp', '--datasetpath', help='string: path of data .txt file', type=str, action='store', required=True)
-parser.add_argument('-op', '--outputpath', help='string: output path of .csv file', type=str, action='store', required=True)
-args = parser.parse_args()
-
-with open(args.datasetpath) as f:
-	lines = f.readlines()
-	lines = [x.strip() for x in lines]
-	
-	processed_lines = []
-	polarities = []
-	for line in lines:
-		polarity = None
-		processed_line = line
-		if len(line) > 0:
-			polarity = "positive" if line[len(line) - 1] == "1" else "negative"
-			processed_line = line[:-1]
-
-		if polarity is not None:
-			processed_lines.append(processed_line)
-			polarities.append(polarity)
-
-	df = pd.DataFrame(data={'text': processed_lines, 'polarity': polarities})
-	df.to_csv(args.outputpath)
+	workers = min(len(args.datasetpath), args.workers or os.cpu_count() or 1)
+	with ProcessPoolExecutor(workers) as executor:
+		for dataset_path, rows in zip(args.datasetpath, executor.map(convert, args.datasetpath, args.outputpath)):
+			print('{d}: {r} rows'.format(d=dataset_path, r=rows))
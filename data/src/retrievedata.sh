@@ -7,14 +7,18 @@ cd $(dirname $0)/../source/
 wget 'https://archive.ics.uci.edu/ml/machine-learning-databases/00331/sentiment%20labelled%20sentences.zip'
 unzip '../source/sentiment labelled sentences.zip'
 cd 'sentiment labelled sentences'
+dataset_paths=()
+output_paths=()
 for filename in *; do 
 	# check if it is a data file
 	if [[ $filename == *'_'* ]]; then
 		output_name=${filename%%_*}
-		output_path="../$output_name.csv"
-		python3 ../../src/process_sls.py -dp $filename -op $output_path
+		dataset_paths+=("$filename")
+		output_paths+=("../$output_name.csv")
 	fi
 done
+# the files are converted in parallel
+python3 ../../src/process_sls.py -dp "${dataset_paths[@]}" -op "${output_paths[@]}"
 
 cd ../
 # get emobank
@@ -0,0 +1,78 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+import preprocess
+
+STOP_WORDS = {'the', 'a', 'is', 'not', 'i', 'was', 'it'}
+
+TEXTS = [
+	'The movie was GREAT!!!', 'not good, not bad...', '', ' ', '   spaced   out   text ', 'it', 'I', 'a a a',
+	'Café déjà vu', 'e-mail 2041 attached :)', 'tabs\tand\nnewlines', 'the_end', "don't stop", np.nan, 42,
+]
+
+def preprocess_like_the_old_scripts(texts, steps, stop_words=None):
+	'''The preprocessing of evaluation.py and transformdata.py before it was shared.
+	'''
+	# astype(str) turned missing texts into 'nan' before pandas 3.0
+	texts = texts.map(str)
+	if 'clean' in steps:
+		texts = texts.str.replace('[^a-zA-Z ]', '', regex=True)
+	if 'stopwords' in steps:
+		texts = texts.map(lambda text: ' '.join(word for word in text.split() if word not in stop_words))
+	return texts
+
+def iterate_test_batches_like_the_old_scripts(dataset_path, batch_size, steps, stop_words):
+	'''The test batches of evaluation.py before they were read from the shared preprocessing.
+	'''
+	columns = ['set', 'text', 'polarity']
+	pending = []
+	pending_size = 0
+	for chunk in pd.read_csv(dataset_path, usecols=columns, chunksize=max(batch_size, 10000)):
+		test_chunk = chunk[chunk['set'] == 'test']
+		pending.append(test_chunk)
+		pending_size += len(test_chunk)
+		if pending_size < batch_size:
+			continue
+
+		test_df = pd.concat(pending)
+		for start in range(0, len(test_df) - batch_size + 1, batch_size):
+			batch = test_df.iloc[start:start + batch_size]
+			yield preprocess_like_the_old_scripts(batch['text'], steps, stop_words).tolist(), batch['polarity'].astype(str).tolist()
+		remainder = test_df.iloc[len(test_df) - len(test_df) % batch_size:]
+		pending = [remainder]
+		pending_size = len(remainder)
+
+	if pending_size > 0:
+		batch = pd.concat(pending)
+		yield preprocess_like_the_old_scripts(batch['text'], steps, stop_words).tolist(), batch['polarity'].astype(str).tolist()
+
+def test_preprocess_matches_the_old_scripts():
+	texts = pd.Series(TEXTS, index=range(100, 100 + len(TEXTS)), dtype=object)
+	for steps in [(), ('clean',), ('stopwords',), ('clean', 'stopwords')]:
+		expected = preprocess_like_the_old_scripts(texts, steps, STOP_WORDS)
+		actual = preprocess.preprocess(texts, steps, STOP_WORDS)
+		assert actual.tolist() == expected.tolist()
+		assert actual.index.tolist() == texts.index.tolist()
+
+def test_batches_match_the_old_test_batches(tmp_path, monkeypatch):
+	dataset_path = str(tmp_path / 'split_dataset.csv')
+	rows = len(TEXTS) * 20
+	pd.DataFrame({
+		'text': [TEXTS[i % len(TEXTS)] for i in range(rows)],
+		'polarity': ['positive' if i % 3 == 0 else 'negative' for i in range(rows)],
+		'set': ['test' if i % 4 != 1 else 'train' for i in range(rows)]
+	}).to_csv(dataset_path)
+	monkeypatch.setattr(preprocess, 'load_stop_words', lambda download=False: STOP_WORDS)
+	monkeypatch.setattr(preprocess, 'CHUNK_SIZE', 32)
+
+	steps = ('clean', 'stopwords')
+	expected = list(iterate_test_batches_like_the_old_scripts(dataset_path, 7, steps, STOP_WORDS))
+	# preprocessed directly, then written to the cache and read back from it
+	for cache_dir in [None, str(tmp_path / 'cache'), str(tmp_path / 'cache')]:
+		batches = [(batch['text'].tolist(), batch['polarity'].tolist()) for batch in preprocess.iterate_batches(dataset_path, steps, 7, 'test', cache_dir)]
+		assert batches == expected
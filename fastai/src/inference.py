@@ -2,21 +2,86 @@
 
 # This script is used to perform inference to classify a text using a trained Fast.ai language model.
 
-from fastai import *
-from fastai.text import *
+# import only what is needed, the learner's modules are imported when it is unpickled
+from fastai.basic_data import DatasetType
+from fastai.basic_train import load_learner
+from fastai.text.models.awd_lstm import WeightDropout
+import torch
+from torch import nn
 
 import argparse
+import os
+import threading
 
-def initialize_model(model_dir, model_name):
+# adding a test set mutates the learner's data, batches are predicted one at a time
+batch_lock = threading.Lock()
+
+def initialize_model(model_dir, model_name, quantize=False, num_threads=None):
 	'''Initializes a saved Fast.ai language model.
 
 	Args:
 		model_dir: Directory path for a Fast.ai language model.
 		model_name: File name for a Fast.ai language model.
+		quantize: Whether to apply dynamic int8 quantization to the model's LSTM and linear layers, if it is not quantized yet.
+		num_threads: Number of threads used by torch for intra-op parallelism, or None to keep torch's default.
 	'''
+	if num_threads is not None:
+		torch.set_num_threads(num_threads)
+
 	# prevent exposing the learner
 	global learn
 	learn = load_learner(model_dir, model_name)
+	learn.model.eval()
+	if quantize and not is_quantized(learn.model):
+		learn.model = quantize_model(learn.model)
+
+	global model_path
+	model_path = os.path.join(model_dir, model_name)
+
+def is_quantized(model):
+	'''Returns whether a model contains quantized layers.
+
+	Args:
+		model: A torch module.
+	'''
+	return any('quantized' in type(module).__module__ for module in model.modules())
+
+def unwrap_weight_dropout(model):
+	'''Replaces the weight dropout wrappers of a model's LSTM layers with the LSTM layers themselves.
+	Weight dropout is not applied at inference, and the wrapper prevents the LSTM layers from being quantized.
+
+	Args:
+		model: A torch module, in evaluation mode.
+	'''
+	for name, child in model.named_children():
+		if isinstance(child, WeightDropout):
+			for layer in child.layer_names:
+				setattr(child.module, layer, nn.Parameter(getattr(child, layer + '_raw').data))
+			setattr(model, name, child.module)
+		else:
+			unwrap_weight_dropout(child)
+
+def quantize_model(model):
+	'''Returns a model with its LSTM and linear layers dynamically quantized to int8.
+
+	Args:
+		model: A torch module, in evaluation mode.
+	'''
+	unwrap_weight_dropout(model)
+	return torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+def inference_context():
+	'''Returns a context manager which disables gradient tracking, using inference mode if torch supports it.
+	'''
+	if hasattr(torch, 'inference_mode'):
+		return torch.inference_mode()
+	return torch.no_grad()
+
+def get_identity():
+	'''Returns a string identifying the loaded model by its file path, size and modification time.
+	'''
+	stat = os.stat(model_path)
+	return '{p}:{s}:{m}'.format(p=os.path.abspath(model_path), s=stat.st_size, m=int(stat.st_mtime))
 
 def predict(text):
 	'''Returns the polarity label after performing inference on a text.
@@ -26,17 +91,40 @@ def predict(text):
 	Args:
 		text: Text to perform inference on.
 	'''
-	preds = learn.predict(text)
+	with inference_context():
+		preds = learn.predict(text)
 	polarity = str(preds[0])
 	return polarity
 
+def predict_batch(texts):
+	'''Returns the polarity labels after performing inference on several texts.
+
+	The texts are tokenized, padded into batches and passed through the trained Fast.ai model together,
+	instead of predicting them one at a time.
+
+	Args:
+		texts: List of texts to perform inference on.
+	'''
+	if len(texts) == 0:
+		return []
+
+	with batch_lock, inference_context():
+		learn.data.add_test(texts)
+		# ordered returns the predictions in the order of the texts
+		preds, _ = learn.get_preds(ds_type=DatasetType.Test, ordered=True)
+
+	classes = learn.data.classes
+	return [str(classes[i]) for i in preds.argmax(dim=1).tolist()]
+
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='process arguments required for performing inference with trained model on input text')
 	parser.add_argument('-md', '--modeldirectory', help='string: path to directory containing model file', type=str, action='store', required=True)
 	parser.add_argument('-mn', '--modelname', help='string: name of model file', type=str, action='store', required=True)
 	parser.add_argument('-t', '--text', help='string: text to perform inference on', type=str, action='store', required=True)
+	parser.add_argument('-q', '--quantize', help='apply dynamic int8 quantization to the model', action='store_true')
+	parser.add_argument('-nt', '--numthreads', help='int: number of threads used by torch', type=int, action='store', required=False)
 	args = parser.parse_args()
 
-	initialize_model(args.modeldirectory, args.modelname)
+	initialize_model(args.modeldirectory, args.modelname, args.quantize, args.numthreads)
 	polarity = predict(args.text)
 	print(polarity)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# This script exports a dynamically quantized (int8) version of a trained fastai model for CPU inference,
+# and compares its accuracy and latency with the full precision (fp32) model on the test set.
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+import pandas as pd
+
+import inference
+
+DATASET_COMPONENT_LABEL = 'set'
+DATASET_TEXT_LABEL = 'text'
+DATASET_TARGET_LABEL = 'polarity'
+
+def benchmark(texts, targets, latency_samples):
+	'''Returns the accuracy, per-text latency and batch throughput of the initialized model.
+
+	Args:
+		texts: List of texts of the test set.
+		targets: List of the target polarity of each text.
+		latency_samples: Number of texts predicted one at a time to measure the per-text latency.
+	'''
+	latencies = []
+	for text in texts[:latency_samples]:
+		start = time.perf_counter()
+		inference.predict(text)
+		latencies.append(time.perf_counter() - start)
+
+	start = time.perf_counter()
+	predictions = inference.predict_batch(texts)
+	batch_seconds = time.perf_counter() - start
+
+	correct = sum(1 for prediction, target in zip(predictions, targets) if prediction == target)
+	latencies.sort()
+	return {
+		'accuracy': correct / len(texts) * 100,
+		'latency_p50_ms': statistics.median(latencies) * 1000,
+		'latency_p95_ms': latencies[int(0.95 * (len(latencies) - 1))] * 1000,
+		'batch_texts_per_second': len(texts) / batch_seconds
+	}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='process arguments required for exporting a quantized model and comparing it with the full precision model')
+	parser.add_argument('-dp', '--datasetpath', help='str: path to csv dataset', type=str, action='store', required=True)
+	parser.add_argument('-md', '--modeldirectory', help='str: path to directory in which the saved model file resides', type=str, action='store', required=True)
+	parser.add_argument('-mn', '--modelname', help='str: file name of saved model', type=str, action='store', required=True)
+	parser.add_argument('-on', '--outputname', help='str: file name of the exported quantized model, in the model directory', type=str, action='store', default='textclassifier_int8.pkl')
+	parser.add_argument('-op', '--outputpath', help='str: path to output json file containing the comparison', type=str, action='store', required=True)
+	parser.add_argument('-nt', '--numthreads', help='int: number of threads used by torch', type=int, action='store', required=False)
+	parser.add_argument('-ls', '--latencysamples', help='int: number of texts predicted one at a time to measure latency', type=int, action='store', default=200)
+	args = parser.parse_args()
+
+	df = pd.read_csv(args.datasetpath)
+	test_df = df[df[DATASET_COMPONENT_LABEL] == 'test']
+	texts = [str(text) for text in test_df[DATASET_TEXT_LABEL]]
+	targets = [str(target) for target in test_df[DATASET_TARGET_LABEL]]
+	print('Test Size: ' + str(len(texts)))
+
+	results = {}
+	inference.initialize_model(args.modeldirectory, args.modelname, num_threads=args.numthreads)
+	results['fp32'] = benchmark(texts, targets, args.latencysamples)
+	results['fp32']['size_bytes'] = os.path.getsize(os.path.join(args.modeldirectory, args.modelname))
+
+	# quantize and export, then load the exported model to benchmark the artifact which will be used
+	inference.initialize_model(args.modeldirectory, args.modelname, quantize=True, num_threads=args.numthreads)
+	inference.learn.export(args.outputname)
+	inference.initialize_model(args.modeldirectory, args.outputname, num_threads=args.numthreads)
+	results['int8'] = benchmark(texts, targets, args.latencysamples)
+	results['int8']['size_bytes'] = os.path.getsize(os.path.join(args.modeldirectory, args.outputname))
+
+	for precision, result in results.items():
+		print('{p}: accuracy {a:.2f}, latency p50 {l50:.1f}ms p95 {l95:.1f}ms, batch {t:.1f} texts/s, size {s} bytes'.format(p=precision, a=result['accuracy'],
+			l50=result['latency_p50_ms'], l95=result['latency_p95_ms'], t=result['batch_texts_per_second'], s=result['size_bytes']))
+
+	with open(args.outputpath, 'w') as f:
+		json.dump(results, f, indent=2)
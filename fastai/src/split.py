@@ -1,39 +1,167 @@
 #!/usr/bin/env python3
 
 # This script splits a csv dataset into train, val and test sets.
+# Each row is assigned from a stable hash of its text, so the split is the same on every run and machine,
+# identical texts are always in the same set, and adding rows does not move existing rows to another set.
+# The dataset is read and written in chunks.
 
 import argparse
-import pandas as pd
-from sklearn.model_selection import train_test_split
+import hashlib
+import json
+import os
+import sys
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-dp', '--datasetpath', help='string: path to the csv data file', type=str, action='store', required=True)
-parser.add_argument('-op', '--outputpath', help='string: output path of the split csv data file (including name & extension)', type=str, action='store', required=True)
-parser.add_argument('-train', '--trainsize', help='float: size of training set as a proportion of total.', type=float, action='store', default=0.7)
-parser.add_argument('-test', '--testsize', help='float: size of test set as a proportion of total.', type=float, action='store', default=0.1)
-args = parser.parse_args()
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data/src'))
+import datasetio
 
 DATASET_COMPONENT_LABEL = 'set'
+DATASET_TEXT_LABEL = 'text'
+DATASET_TARGET_LABEL = 'polarity'
+# suffix of the file next to a split dataset recording the number and hash of the dataset rows it was split from
+PREFIX_SUFFIX = '.prefix'
+
+def hash_fraction(text, salt=''):
+	'''Returns a number in [0, 1) derived from a stable hash of a text.
+
+	Args:
+		text: The text.
+		salt: String hashed with the text, to obtain a different split.
+	'''
+	digest = hashlib.md5((salt + text).encode('utf-8')).digest()
+	return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+def assign_sets(texts, train_size, test_size, salt=''):
+	'''Returns an array of the set ('train', 'val' or 'test') of each text.
+
+	Args:
+		texts: A pandas Series of texts.
+		train_size: Proportion of texts in the train set.
+		test_size: Proportion of texts in the test set.
+		salt: String hashed with each text, to obtain a different split.
+	'''
+	fractions = np.array([hash_fraction(text, salt) for text in texts.astype(str)])
+	return np.select([fractions < train_size, fractions >= 1.0 - test_size], ['train', 'test'], 'val')
+
+def update_rows_hash(rows_hash, chunk):
+	'''Adds the texts and polarities of a chunk of rows to a hash.
+
+	Args:
+		rows_hash: A hashlib hash object.
+		chunk: A DataFrame with the text and polarity columns.
+	'''
+	# unit and record separators, so that the boundaries of texts can not be shifted
+	rows = chunk[DATASET_TEXT_LABEL].astype(str) + '\x1f' + chunk[DATASET_TARGET_LABEL].astype(str) + '\x1e'
+	rows_hash.update(''.join(rows).encode('utf-8'))
+
+def read_prefix(output_path):
+	'''Returns a dictionary of the number ('rows') and hash ('sha256') of the dataset rows a split dataset was split from,
+	or None if they were not recorded.
+
+	Args:
+		output_path: Path of the split dataset.
+	'''
+	try:
+		with open(output_path + PREFIX_SUFFIX) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+def split_rows(dataset_path, output_path, train_size, test_size, salt, prefix, chunk_size):
+	'''Writes the rows of a dataset with the set they are assigned to, and records the rows it was split from.
+	Returns the number of rows written to each set, or None if the dataset does not start with the rows of the prefix.
+
+	Args:
+		dataset_path: Path to the csv or parquet dataset.
+		output_path: Output path of the split csv or parquet dataset.
+		train_size: Proportion of rows in the train set.
+		test_size: Proportion of rows in the test set.
+		salt: String hashed with each text, to obtain a different split.
+		prefix: The rows an existing split csv dataset was split from (read_prefix), to split only the rows after them
+			and append them to it, or None to split every row.
+		chunk_size: Number of rows read at a time.
+	'''
+	sizes = {'train': 0, 'val': 0, 'test': 0}
+	rows_hash = hashlib.sha256()
+	with datasetio.ChunkWriter(output_path, (DATASET_TEXT_LABEL, DATASET_TARGET_LABEL, DATASET_COMPONENT_LABEL), prefix is not None) as writer:
+		if prefix is not None and writer.rows != prefix['rows']:
+			return None
+		# rows which are already split are skipped, the output keeps only rows with a text and polarity
+		skip = writer.rows
+		verified = prefix is None
+		for chunk in datasetio.read_chunks(dataset_path, [DATASET_TEXT_LABEL, DATASET_TARGET_LABEL], chunk_size):
+			chunk = chunk.dropna()
+			update_rows_hash(rows_hash, chunk.iloc[:skip])
+			if skip >= len(chunk):
+				skip -= len(chunk)
+				continue
+			chunk = chunk.iloc[skip:]
+			skip = 0
+			# nothing has been appended before the skipped rows are verified
+			if not verified:
+				if rows_hash.hexdigest() != prefix['sha256']:
+					return None
+				verified = True
+
+			update_rows_hash(rows_hash, chunk)
+			chunk = chunk.assign(**{DATASET_COMPONENT_LABEL: assign_sets(chunk[DATASET_TEXT_LABEL], train_size, test_size, salt)})
+			for component, count in chunk[DATASET_COMPONENT_LABEL].value_counts().items():
+				sizes[component] += count
+			writer.write(chunk)
+
+		if not verified and (skip > 0 or rows_hash.hexdigest() != prefix['sha256']):
+			return None
+		rows = writer.rows
+
+	with open(output_path + PREFIX_SUFFIX, 'w') as f:
+		json.dump({'rows': rows, 'sha256': rows_hash.hexdigest()}, f)
+	return sizes
+
+def split(dataset_path, output_path, train_size=0.7, test_size=0.1, salt='', append=False, chunk_size=datasetio.CHUNK_SIZE):
+	'''Writes the rows of a dataset with the set they are assigned to. Returns the number of rows written to each set.
+
+	Args:
+		dataset_path: Path to the csv or parquet dataset.
+		output_path: Output path of the split csv or parquet dataset.
+		train_size: Proportion of rows in the train set.
+		test_size: Proportion of rows in the test set.
+		salt: String hashed with each text, to obtain a different split.
+		append: Whether only the rows of the dataset beyond those of an existing split csv dataset are split and appended to it.
+			Every row is split again if the dataset does not start with the rows the existing split was made from,
+			which are read and hashed to verify it, or if the split dataset is a parquet file.
+		chunk_size: Number of rows read at a time.
+	'''
+	if append and datasetio.is_parquet(output_path):
+		print('Rows can not be appended to the parquet file {o}, splitting every row again'.format(o=output_path))
+	elif append and os.path.exists(output_path):
+		prefix = read_prefix(output_path)
+		if prefix is not None:
+			sizes = split_rows(dataset_path, output_path, train_size, test_size, salt, prefix, chunk_size)
+			if sizes is not None:
+				return sizes
+		print('The dataset does not start with the rows {o} was split from, splitting every row again'.format(o=output_path))
+
+	# the output is replaced, so its recorded rows must not outlive it if splitting fails
+	if os.path.exists(output_path + PREFIX_SUFFIX):
+		os.remove(output_path + PREFIX_SUFFIX)
+	return split_rows(dataset_path, output_path, train_size, test_size, salt, None, chunk_size)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-dp', '--datasetpath', help='string: path to the csv data file', type=str, action='store', required=True)
+	parser.add_argument('-op', '--outputpath', help='string: output path of the split csv data file (including name & extension)', type=str, action='store', required=True)
+	parser.add_argument('-train', '--trainsize', help='float: size of training set as a proportion of total.', type=float, action='store', default=0.7)
+	parser.add_argument('-test', '--testsize', help='float: size of test set as a proportion of total.', type=float, action='store', default=0.1)
+	parser.add_argument('-sa', '--salt', help='string: hashed with each text to obtain a different split', type=str, action='store', default='')
+	parser.add_argument('-a', '--append', help='only split the rows added to the dataset since the csv output was written, appending them to it', action='store_true')
+	parser.add_argument('-cs', '--chunksize', help='int: number of rows read at a time', type=int, action='store', default=datasetio.CHUNK_SIZE)
+	args = parser.parse_args()
+
+	valsize = 1.0 - args.trainsize - args.testsize
+	assert valsize >= 0.0
+	sizes = split(args.datasetpath, args.outputpath, args.trainsize, args.testsize, args.salt, args.append, args.chunksize)
 
-df = pd.read_csv(args.datasetpath, index_col=[0])
-train_val_df, test_df = train_test_split(df, test_size=args.testsize)
-valsize = 1.0 - args.trainsize - args.testsize
-assert valsize >= 0.0
-train_df, val_df = train_test_split(train_val_df, test_size=valsize/(args.trainsize + valsize))
-assert len(train_df) + len(val_df) + len(test_df) == len(df)
-
-# set labels
-train_df[DATASET_COMPONENT_LABEL] = 'train'
-val_df[DATASET_COMPONENT_LABEL] = 'val'
-test_df[DATASET_COMPONENT_LABEL] = 'test'
-
-print('Train Size:', len(train_df))
-print('Validation Size:', len(val_df))
-print('Test Size:', len(test_df))
-
-df_s = [train_df, val_df, test_df]
-df_merged = pd.concat(df_s, ignore_index=True)
-columns = df_merged.columns
-# df_merged.drop([columns[1]], axis=1, inplace=True)
-df_merged = df_merged.dropna()
-df_merged.to_csv(args.outputpath)
\ No newline at end of file
+	print('Train Size:', sizes['train'])
+	print('Validation Size:', sizes['val'])
+	print('Test Size:', sizes['test'])
@@ -1,11 +1,102 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
 import pandas as pd
+import fastai
 from fastai import *
 from fastai.text import *
+# fastai's load_data is shadowed by load_data below
+from fastai.basic_data import load_data as load_databunch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data/src'))
+import preprocess
+
+DATA_LM_NAME = 'data_lm.pkl'
+DATA_CLAS_NAME = 'data_clas.pkl'
+VOCAB_NAME = 'vocab.pkl'
+LM_BATCH_SIZE = 64
+CLAS_BATCH_SIZE = 32
+
+def get_tokenizer_settings(tokenizer):
+	'''Returns a dictionary of the settings which determine how a tokenizer tokenizes and numericalizes texts.
+
+	Args:
+		tokenizer: A fastai Tokenizer.
+	'''
+	rule_names = lambda rules: [getattr(rule, '__name__', repr(rule)) for rule in rules]
+	return {
+		'fastai': fastai.__version__,
+		'tok_func': getattr(tokenizer.tok_func, '__name__', repr(tokenizer.tok_func)),
+		'lang': tokenizer.lang,
+		'pre_rules': rule_names(tokenizer.pre_rules),
+		'post_rules': rule_names(tokenizer.post_rules),
+		'special_cases': list(tokenizer.special_cases)
+	}
+
+def get_cache_dir(cache_root, path, tokenizer):
+	'''Returns the directory of the cached data bunches of a dataset, keyed by the dataset's hash and the tokenizer settings.
+
+	Args:
+		cache_root: Directory of the cached data bunches of every dataset.
+		path: Path to the csv dataset.
+		tokenizer: A fastai Tokenizer.
+	'''
+	key = json.dumps({'dataset': preprocess.hash_file(path), 'tokenizer': get_tokenizer_settings(tokenizer)}, sort_keys=True)
+	return os.path.join(cache_root, hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+
+def load_data(path, tokenizer, cache_root=None):
+	'''Returns the language model and classifier data bunches of a dataset.
+
+	The tokenized and numericalized data bunches and their vocab are saved to a cache directory,
+	from which they are loaded instead of tokenizing the dataset again while it and the tokenizer settings do not change.
+
+	Args:
+		path: Path to the csv dataset.
+		tokenizer: A fastai Tokenizer.
+		cache_root: Directory of the cached data bunches, or None to always tokenize the dataset.
+	'''
+	if cache_root is None:
+		return build_data(path, tokenizer)
+
+	cache_dir = get_cache_dir(cache_root, path, tokenizer)
+	if os.path.exists(cache_dir):
+		print('loading tokenized data from ' + cache_dir)
+		# the data bunches keep the working directory as their path, like those built from the dataset
+		data_lm = load_databunch('', os.path.abspath(os.path.join(cache_dir, DATA_LM_NAME)), bs=LM_BATCH_SIZE)
+		data_clas = load_databunch('', os.path.abspath(os.path.join(cache_dir, DATA_CLAS_NAME)), bs=CLAS_BATCH_SIZE)
+		return data_lm, data_clas
+
+	data_lm, data_clas = build_data(path, tokenizer)
+	# saved to a temporary directory of its own first, so that an interrupted run does not leave a partial cache
+	# and runs tokenizing the same dataset at once do not write to the same directory
+	os.makedirs(cache_root, exist_ok=True)
+	tmp_dir = tempfile.mkdtemp(dir=cache_root, suffix='.tmp')
+	try:
+		data_lm.save(os.path.abspath(os.path.join(tmp_dir, DATA_LM_NAME)))
+		data_clas.save(os.path.abspath(os.path.join(tmp_dir, DATA_CLAS_NAME)))
+		data_lm.train_ds.vocab.save(os.path.join(tmp_dir, VOCAB_NAME))
+		os.replace(tmp_dir, cache_dir)
+	except OSError:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+		if not os.path.exists(cache_dir):
+			raise
+		# another run saved the same data first
+	print('saved tokenized data to ' + cache_dir)
+	return data_lm, data_clas
+
+def build_data(path, tokenizer):
+	'''Returns the language model and classifier data bunches of a dataset, tokenizing and numericalizing its texts.
 
-def load_data(path):
+	Args:
+		path: Path to the csv dataset.
+		tokenizer: A fastai Tokenizer.
+	'''
 	df = pd.read_csv(path, index_col=[0])
 	print(df.head)
 	train_df = df[df[DATASET_COMPONENT_LABEL] == 'train']
@@ -13,9 +104,9 @@ def load_data(path):
 	test_df = df[df[DATASET_COMPONENT_LABEL] == 'test']
 
 	# Language model data
-	data_lm = TextLMDataBunch.from_df(train_df=train_df, valid_df=val_df, test_df=test_df, text_cols='text', label_cols='polarity', path="")
+	data_lm = TextLMDataBunch.from_df(train_df=train_df, valid_df=val_df, test_df=test_df, tokenizer=tokenizer, bs=LM_BATCH_SIZE, text_cols='text', label_cols='polarity', path="")
 	# Classifier model data
-	data_clas = TextClasDataBunch.from_df(train_df=train_df, valid_df=val_df, test_df=test_df, vocab=data_lm.train_ds.vocab, bs=32, text_cols='text', label_cols='polarity', path="")
+	data_clas = TextClasDataBunch.from_df(train_df=train_df, valid_df=val_df, test_df=test_df, tokenizer=tokenizer, vocab=data_lm.train_ds.vocab, bs=CLAS_BATCH_SIZE, text_cols='text', label_cols='polarity', path="")
 	return data_lm, data_clas
 
 def train(data_lm, data_clas):
@@ -60,13 +151,19 @@ if __name__ == '__main__':
 	parser.add_argument('-lme', '--lmepochs', help='int: number of epochs to train language model', type=int, action='store', default=1)
 	parser.add_argument('-tclr', '--tclearningrate', help='float: learning rate for text classifier', type=float, action='store', default=1e-2)
 	parser.add_argument('-tce', '--tcepochs', help='int: number of epochs to train text classifier', type=int, action='store', default=1)
+	parser.add_argument('-cd', '--cachedirectory', help='str: directory of the cached tokenized data, defaults to a databunches directory next to the dataset', type=str, action='store', required=False)
+	parser.add_argument('-nc', '--nocache', help='tokenize the dataset without caching the result', action='store_true')
+	parser.add_argument('-cpu', '--numcpus', help='int: number of processes tokenizing the dataset, defaults to all cores', type=int, action='store', required=False)
 	args = parser.parse_args()
 
 	DATASET_COMPONENT_LABEL = 'set'
 	LANGUAGE_MODEL_NAME = 'languagemodel_encoder'
 	TEXT_MODEL_NAME = 'textclassifier.pkl'
 
-	data_lm, data_clas = load_data(args.datasetpath)
+	# fastai's default number of tokenizing processes is capped below the number of cores
+	tokenizer = Tokenizer(n_cpus=args.numcpus or os.cpu_count())
+	cache_root = None if args.nocache else args.cachedirectory or os.path.join(os.path.dirname(os.path.abspath(args.datasetpath)), 'databunches')
+	data_lm, data_clas = load_data(args.datasetpath, tokenizer, cache_root)
 	learn = train(data_lm, data_clas)
 	learn.export(args.outputdirectory + '/' + TEXT_MODEL_NAME)
 	show_results(learn)
@@ -1,37 +1,80 @@
 #!/usr/bin/env python3
 
-# This script modifies the emobank csv file to add sentiment orientation labels based on each text's valence value and removes unneeded columns
+# This script adds sentiment orientation labels to the emobank texts based on each text's valence value, and combines them
+# with the sentiment labelled sentences into a single dataset of texts and polarities, removing unneeded columns.
+# The sources are read and labelled in chunks, so memory stays bounded by the chunk size and not by the size of the corpora.
 
 import argparse
+import os
+import sys
+
+import numpy as np
 import pandas as pd
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-dr', '--datasetdir', help='string: directory location of data files', type=str, action='store', required=True)
-parser.add_argument('-op', '--outputpath', help='string: output path of the transformed csv data file (including name & extension)', type=str, action='store', required=True)
-args = parser.parse_args()
-
-df_emobank = pd.read_csv(args.datasetdir  + '/emobank.csv', index_col=[0])
-# assign postive, negative and neutral labels based on valence values
-df_emobank['polarity'] = df_emobank.apply(lambda row:
-	'positive' if row.V > 3
-	else 'negative' if row.V < 3
-	else 'neutral',
-	axis=1
-)
-
-df_processed_emobank = pd.DataFrame({'text': df_emobank.text, 'polarity': df_emobank.polarity})
-df_amazon = pd.read_csv(args.datasetdir + '/amazon.csv', index_col=[0])
-df_yelp = pd.read_csv(args.datasetdir + '/yelp.csv',  index_col=[0])
-df_imdb = pd.read_csv(args.datasetdir + '/imdb.csv', index_col=[0])
-
-data = [df_processed_emobank, df_amazon, df_yelp, df_imdb]
-df = pd.concat(data)
-
-# only keep alphabets and spaces
-df['text'] = df['text'].str.replace('[^a-zA-Z ]', '')
-df = df[(len(df.text) > 0) & (df.text != None) & ('NaN' not in df.text)]
-
-# shuffle
-df = df.sample(frac=1).reset_index(drop=True)
-df.to_csv(args.outputpath)
-print('Dataset Size:', len(df))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data/src'))
+import datasetio
+import preprocess
+
+DATASET_TEXT_LABEL = 'text'
+DATASET_TARGET_LABEL = 'polarity'
+EMOBANK_VALENCE_LABEL = 'V'
+
+def label_emobank(chunk):
+	'''Returns a DataFrame of the text and polarity of a chunk of emobank rows.
+	Texts with a valence above 3 are positive, below 3 negative and otherwise neutral.
+
+	Args:
+		chunk: A DataFrame of emobank rows.
+	'''
+	valence = chunk[EMOBANK_VALENCE_LABEL]
+	polarity = np.select([valence > 3, valence < 3], ['positive', 'negative'], 'neutral')
+	return pd.DataFrame({DATASET_TEXT_LABEL: chunk[DATASET_TEXT_LABEL].values, DATASET_TARGET_LABEL: polarity})
+
+def label_sls(chunk):
+	'''Returns a DataFrame of the text and polarity of a chunk of sentiment labelled sentences, which are already labelled.
+
+	Args:
+		chunk: A DataFrame of sentiment labelled sentences.
+	'''
+	return chunk[[DATASET_TEXT_LABEL, DATASET_TARGET_LABEL]]
+
+# source information store: tuples (file name, columns read, function labelling a chunk of rows)
+SOURCES = [
+	('emobank.csv', [DATASET_TEXT_LABEL, EMOBANK_VALENCE_LABEL], label_emobank),
+	('amazon.csv', [DATASET_TEXT_LABEL, DATASET_TARGET_LABEL], label_sls),
+	('yelp.csv', [DATASET_TEXT_LABEL, DATASET_TARGET_LABEL], label_sls),
+	('imdb.csv', [DATASET_TEXT_LABEL, DATASET_TARGET_LABEL], label_sls)
+]
+
+def transform_chunk(chunk):
+	'''Returns a labelled chunk with only alphabets and spaces kept in its texts, without the texts which are missing or become empty.
+
+	Args:
+		chunk: A DataFrame of texts and polarities.
+	'''
+	chunk = chunk[chunk[DATASET_TEXT_LABEL].notna()]
+	chunk = chunk.assign(**{DATASET_TEXT_LABEL: preprocess.clean_texts(chunk[DATASET_TEXT_LABEL])})
+	return chunk[chunk[DATASET_TEXT_LABEL].str.len() > 0]
+
+def transform(dataset_dir, output_path, chunk_size=datasetio.CHUNK_SIZE):
+	'''Writes the labelled texts of every source to a csv or parquet dataset. Returns the number of rows written.
+
+	Args:
+		dataset_dir: Directory of the source csv files.
+		output_path: Output path of the .csv or .parquet dataset.
+		chunk_size: Number of rows read at a time.
+	'''
+	with datasetio.ChunkWriter(output_path) as writer:
+		for file_name, columns, label in SOURCES:
+			for chunk in datasetio.read_chunks(os.path.join(dataset_dir, file_name), columns, chunk_size):
+				writer.write(transform_chunk(label(chunk)))
+		return writer.rows
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-dr', '--datasetdir', help='string: directory location of data files', type=str, action='store', required=True)
+	parser.add_argument('-op', '--outputpath', help='string: output path of the transformed csv (or parquet) data file (including name & extension)', type=str, action='store', required=True)
+	parser.add_argument('-cs', '--chunksize', help='int: number of rows read at a time', type=int, action='store', default=datasetio.CHUNK_SIZE)
+	args = parser.parse_args()
+
+	print('Dataset Size:', transform(args.datasetdir, args.outputpath, args.chunksize))
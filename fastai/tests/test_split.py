@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+import split
+
+def write_dataset(path, count, start=0):
+	texts = ['text number {i}'.format(i=i) for i in range(start, start + count)]
+	pd.DataFrame({'text': texts, 'polarity': ['positive' if i % 2 == 0 else 'negative' for i in range(start, start + count)]}).to_csv(path)
+
+def test_appended_rows_do_not_move_the_existing_rows(tmp_path):
+	dataset_path = str(tmp_path / 'dataset.csv')
+	output_path = str(tmp_path / 'split_dataset.csv')
+	full_path = str(tmp_path / 'full_split_dataset.csv')
+	write_dataset(dataset_path, 500)
+	split.split(dataset_path, output_path, chunk_size=64)
+	before = pd.read_csv(output_path)
+
+	write_dataset(dataset_path, 800)
+	sizes = split.split(dataset_path, output_path, append=True, chunk_size=64)
+	assert sum(sizes.values()) == 300
+	after = pd.read_csv(output_path)
+	pd.testing.assert_frame_equal(after.iloc[:500], before)
+
+	# appending gives the same split as splitting every row
+	split.split(dataset_path, full_path, chunk_size=64)
+	pd.testing.assert_frame_equal(after, pd.read_csv(full_path))
+
+def test_every_row_is_split_again_if_the_dataset_was_edited(tmp_path):
+	dataset_path = str(tmp_path / 'dataset.csv')
+	output_path = str(tmp_path / 'split_dataset.csv')
+	write_dataset(dataset_path, 300)
+	split.split(dataset_path, output_path, chunk_size=64)
+
+	write_dataset(dataset_path, 400, start=1)
+	sizes = split.split(dataset_path, output_path, append=True, chunk_size=64)
+	assert sum(sizes.values()) == 400
+	assert pd.read_csv(output_path)['text'].tolist() == ['text number {i}'.format(i=i) for i in range(1, 401)]
+
+def test_parquet_split_is_split_again_when_appending(tmp_path):
+	dataset_path = str(tmp_path / 'dataset.csv')
+	output_path = str(tmp_path / 'split_dataset.parquet')
+	write_dataset(dataset_path, 200)
+	split.split(dataset_path, output_path, chunk_size=64)
+
+	write_dataset(dataset_path, 250)
+	sizes = split.split(dataset_path, output_path, append=True, chunk_size=64)
+	assert sum(sizes.values()) == 250
+	assert len(pd.read_parquet(output_path)) == 250
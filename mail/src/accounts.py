@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# This script serves several Gmail accounts from one subscriber process.
+# Every account has its own credentials, service pool, history cursor, label cache and label batcher,
+# while the model, prediction cache, statistics and instrumentation are loaded once and shared (mail.start_shared).
+
+import functools
+import json
+import logging
+
+from coalesce import NotificationCoalescer
+import instrumentation
+import mail
+
+logger = logging.getLogger('mailsense.mail.accounts')
+
+# settings which every account must have, and those defaulting to the command line arguments
+REQUIRED_SETTINGS = ('tokenpath', 'subscription', 'topic')
+DEFAULT_SETTINGS = ('project', 'credentialspath')
+
+def load_accounts(accounts_path, defaults):
+	'''Returns a dictionary of the settings of every account in a json file, account name as key.
+
+	The file holds an object with the account names as keys and their settings as values, eg.
+	{"alice": {"tokenpath": "alice.pickle", "subscription": "alice-sub", "topic": "alice-topic"}, ...}
+	Optional settings are the project and credentialspath (defaulting to defaults), historypath
+	(defaulting to mailsense.<name>.history) and weight (share of the model relative to the other accounts, default 1).
+
+	Args:
+		accounts_path: Path of the json file.
+		defaults: A dictionary of the default project and credentialspath.
+	'''
+	with open(accounts_path) as f:
+		accounts = json.load(f)
+	if not isinstance(accounts, dict) or len(accounts) == 0:
+		raise ValueError('{p} must hold an object with at least one account'.format(p=accounts_path))
+
+	accounts_settings = {}
+	for name, settings in accounts.items():
+		missing = [setting for setting in REQUIRED_SETTINGS if setting not in settings]
+		if len(missing) > 0:
+			raise ValueError('account {n} is missing the settings {m}'.format(n=name, m=str(missing)))
+		account_settings = {setting: defaults.get(setting) for setting in DEFAULT_SETTINGS}
+		account_settings['historypath'] = 'mailsense.' + name + '.history'
+		account_settings['weight'] = 1.0
+		account_settings.update(settings)
+		accounts_settings[name] = account_settings
+	return accounts_settings
+
+class Account(object):
+	'''A Gmail account served by a process shared with other accounts.
+
+	Messages of the account are coalesced and processed like those of a single account (mail.process_history),
+	but the account's mails are classified through a FairInference (fairinference.py) shared by every account.
+	Requires mail.start_shared to have been called.
+	'''
+	def __init__(self, name, service_pool, history_path, inference, weight=1.0, label_window=0.5, label_batch_size=1000, coalesce_window=0.05, coalesce_max_wait=0.2):
+		'''Initializes an Account object.
+
+		Caches the ids of the polarity labels and loads the history cursor of the account (mail.start_mailbox).
+
+		Args:
+			name: Unique name of the account.
+			service_pool: A ServicePool (servicepool.py) of Gmail service objects of the account.
+			history_path: The path of the file storing the last fully processed history id of the account.
+			inference: The FairInference shared by every account.
+			weight: Share of the model given to the account relative to the other accounts.
+			label_window: Seconds for which label assignments are buffered before being applied together.
+			label_batch_size: Number of buffered label assignments which triggers applying them immediately.
+			coalesce_window: Seconds without a new message after which coalesced messages are processed.
+			coalesce_max_wait: Maximum number of seconds messages are coalesced for.
+		'''
+		super(Account, self).__init__()
+		self.name = name
+		self.service_pool = service_pool
+		self.label_cache, self.history_sync, self.label_batcher = mail.start_mailbox(service_pool, history_path, label_window, label_batch_size)
+
+		inference.add_inbox(name, weight)
+		# classifies the account's mails through the shared model, eg. for an AsyncPipeline (asyncpipeline.py) of the account
+		self.analyze_many = functools.partial(inference.analyze_many, name)
+		self.coalescer = NotificationCoalescer(instrumentation.timed('total', functools.partial(mail.process_history, service_pool, self.history_sync, self.label_batcher, self.analyze_many)), coalesce_window, coalesce_max_wait, self.history_sync.cursor)
+
+		instrumentation.register_queue('labels.' + name, lambda: self.label_batcher.pending_count)
+		instrumentation.register_queue('inference.' + name, functools.partial(inference.pending_count, name))
+		logger.info('started account %s', name)
+
+	def process_message(self, message):
+		'''Processes a message received by the account's Gmail subscriber, like mail.process_message.
+		Returns whether every new mail of the message's group has been labeled.
+
+		Args:
+			message: A message received by a Gmail subscriber.
+		'''
+		history_id = mail.get_message_history_id(message)
+		logger.info('received message with history id: %s for account %s', history_id, self.name)
+		return self.coalescer.submit(history_id)
+
+	def close(self):
+		'''Applies the account's buffered label assignments and stops refreshing its credentials.
+		'''
+		self.label_batcher.close()
+		self.service_pool.close()
+		logger.info('stopped account %s', self.name)
@@ -0,0 +1,783 @@
+#!/usr/bin/env python3
+
+# This script processes Gmail subscription messages with asyncio, as an alternative to processing them in the subscriber's callback threads.
+# Processing is split into stages connected by bounded queues: history sync, fetch, inference, labeling and metrics.
+# Each stage runs a fixed number of tasks, Gmail requests share one pool of HTTP connections and inference runs in an executor,
+# so hundreds of mails can be in flight on a few threads without a slow request holding a thread.
+
+import aiohttp
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode, urlsplit
+import asyncio
+import email
+import json
+import logging
+import re
+import time
+import uuid
+
+import instrumentation
+from labels import LabelBatcher, get_missing_mail_ids, is_missing_label_error
+import mail
+
+GMAIL_API_URL = 'https://gmail.googleapis.com/gmail/v1/users/me'
+# batch requests are sent to this path of the Gmail API host
+GMAIL_BATCH_PATH = '/batch/gmail/v1'
+
+logger = logging.getLogger('mailsense.mail.asyncpipeline')
+
+# the url and status of a request within a batch request, in place of an aiohttp response
+BatchPartResponse = namedtuple('BatchPartResponse', ['url', 'status'])
+
+def encode_batch(parts, boundary):
+	'''Returns the body of a multipart/mixed batch of HTTP messages, as used by Gmail batch requests.
+
+	Args:
+		parts: A list of tuples of the Content-ID and HTTP message (as bytes) of each part: [(content id, message), ...]
+		boundary: The multipart boundary, which must not occur in the messages.
+	'''
+	body = b''
+	for content_id, http_message in parts:
+		body = body + '--{b}\r\nContent-Type: application/http\r\nContent-ID: <{i}>\r\n\r\n'.format(b=boundary, i=content_id).encode('utf-8') + http_message + b'\r\n'
+	return body + '--{b}--\r\n'.format(b=boundary).encode('utf-8')
+
+def decode_batch(content_type, content):
+	'''Returns a list of tuples of the Content-ID and HTTP message (as bytes) of each part of a multipart/mixed batch.
+
+	Args:
+		content_type: The Content-Type header of the batch, including its boundary.
+		content: The body of the batch, as bytes.
+	'''
+	message = email.message_from_bytes(b'Content-Type: ' + content_type.encode('utf-8') + b'\r\n\r\n' + content)
+	if not message.is_multipart():
+		raise ValueError('batch is not a multipart message: {c}'.format(c=content_type))
+	return [(part.get('Content-ID', '').strip('<>'), part.get_payload(decode=True)) for part in message.get_payload()]
+
+def split_http_message(http_message):
+	'''Returns a tuple of the start line (eg. 'GET /path HTTP/1.1' or 'HTTP/1.1 200 OK') and body of an HTTP message.
+
+	Args:
+		http_message: The HTTP message, as bytes.
+	'''
+	parts = re.split(b'\r?\n\r?\n', http_message, 1)
+	start_line = parts[0].splitlines()[0].decode('utf-8')
+	return start_line, parts[1] if len(parts) > 1 else b''
+
+class GmailApiError(Exception):
+	'''An error response of the Gmail API.
+
+	Like the client library's HttpError, it has the response (with its status) as resp and the response body as content.
+	'''
+	def __init__(self, resp, content):
+		'''Initializes a GmailApiError object.
+
+		Args:
+			resp: The aiohttp response of the failed request, or the BatchPartResponse of a request within a batch request.
+			content: The body of the response, as bytes.
+		'''
+		super(GmailApiError, self).__init__('Gmail API request to {u} returned {s}: {c}'.format(u=resp.url, s=resp.status, c=content[:200]))
+		self.resp = resp
+		self.content = content
+
+class AsyncGmailClient(object):
+	'''A minimal asynchronous client of the Gmail REST API, for the requests made while processing mails.
+
+	Every request goes through a single aiohttp session, so connections are pooled and reused across stages.
+	'''
+	def __init__(self, credential_holder, connections=100, base_url=GMAIL_API_URL):
+		'''Initializes an AsyncGmailClient object. The session is created by open, within the event loop.
+
+		Args:
+			credential_holder: A CredentialHolder (servicepool.py) providing the access token.
+			connections: Maximum number of simultaneous HTTP connections.
+			base_url: Url of the Gmail API for the authenticated user. Batch requests are sent to GMAIL_BATCH_PATH of its host.
+		'''
+		super(AsyncGmailClient, self).__init__()
+		self.credential_holder = credential_holder
+		self.connections = connections
+		self.base_url = base_url
+		url = urlsplit(base_url)
+		self.batch_url = '{s}://{h}{p}'.format(s=url.scheme, h=url.netloc, p=GMAIL_BATCH_PATH)
+		# requests within a batch request address resources by path
+		self.base_path = url.path
+		self.session = None
+
+	async def open(self):
+		'''Creates the HTTP session and its connection pool.
+		'''
+		self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections))
+
+	async def close(self):
+		'''Closes the HTTP session and its connections.
+		'''
+		if self.session is not None:
+			await self.session.close()
+			self.session = None
+
+	async def request(self, endpoint, method, path, params=None, body=None):
+		'''Returns the decoded json response of a Gmail API request.
+		Raises a GmailApiError if the request fails.
+
+		The access token is refreshed once if it has been rejected.
+
+		Args:
+			endpoint: Name of the endpoint the request is counted and timed as, eg. 'messages.get'.
+			method: HTTP method, eg. 'GET'.
+			path: Path of the resource, relative to the base url.
+			params: A list of tuples of query parameters: [(name, value), ...]
+			body: A json serializable request body.
+		'''
+		instrumentation.registry.increment(instrumentation.API_CALLS, endpoint=endpoint)
+		try:
+			with instrumentation.registry.time(instrumentation.API_CALL_SECONDS, endpoint=endpoint):
+				return await self.send(method, path, params, body)
+		except Exception:
+			instrumentation.registry.increment(instrumentation.API_ERRORS, endpoint=endpoint)
+			raise
+
+	async def send(self, method, path, params=None, body=None):
+		'''Sends a Gmail API request and returns its decoded json response, refreshing the access token once if it has been rejected.
+		Raises a GmailApiError if the request fails.
+
+		Args:
+			method: HTTP method, eg. 'GET'.
+			path: Path of the resource, relative to the base url.
+			params: A list of tuples of query parameters: [(name, value), ...]
+			body: A json serializable request body.
+		'''
+		content_type, content = await self.send_raw(method, self.base_url + path, params=params, json=body)
+		return json.loads(content.decode('utf-8')) if len(content) > 0 else {}
+
+	async def send_raw(self, method, url, headers=None, **kwargs):
+		'''Sends an HTTP request and returns a tuple of the Content-Type and body of its response,
+		refreshing the access token once if it has been rejected. Raises a GmailApiError if the request fails.
+
+		Args:
+			method: HTTP method, eg. 'GET'.
+			url: Url of the request.
+			headers: A dictionary of headers sent besides the authorization.
+			kwargs: Further arguments of the aiohttp request, eg. params, json or data.
+		'''
+		for attempt in range(2):
+			request_headers = dict(headers or {})
+			request_headers['Authorization'] = 'Bearer ' + self.credential_holder.get().token
+			async with self.session.request(method, url, headers=request_headers, **kwargs) as response:
+				content = await response.read()
+				if response.status == 401 and attempt == 0:
+					logger.warning('access token was rejected, refreshing it')
+					await asyncio.get_event_loop().run_in_executor(None, self.credential_holder.refresh)
+					continue
+				if response.status >= 400:
+					raise GmailApiError(response, content)
+				return response.headers.get('Content-Type', ''), content
+
+	async def get_profile(self):
+		'''Returns the Gmail profile of the authenticated user.
+		'''
+		return await self.request('getProfile', 'GET', '/profile')
+
+	async def list_added_mail_ids(self, start_history_id):
+		'''Returns a tuple of the ids of mails added since a history id, and the current history id of the inbox.
+
+		Pages through every history record since the history id.
+
+		Args:
+			start_history_id: History id to list the history from.
+		'''
+		mail_ids = []
+		page_token = None
+		while True:
+			params = [('historyTypes', 'messageAdded'), ('startHistoryId', str(start_history_id))]
+			if page_token is not None:
+				params.append(('pageToken', page_token))
+			history_obj = await self.request('history.list', 'GET', '/history', params)
+			for record in history_obj.get('history', []):
+				for added in record.get('messagesAdded', []):
+					mail_ids.append(added['message']['id'])
+
+			page_token = history_obj.get('nextPageToken')
+			if page_token is None:
+				return list(dict.fromkeys(mail_ids)), history_obj['historyId']
+
+	async def get_mails(self, mail_ids):
+		'''Returns a tuple of a dictionary of mail ids to the metadata of Gmail mails, restricted to the fields needed for classification,
+		and a dictionary of mail ids to the GmailApiError of the mails which could not be retrieved.
+
+		Retrieves up to mail.MAIL_BATCH_SIZE mails with a single batch request, with the parameters of mail.get_mail_request.
+		Raises if the batch request itself fails.
+
+		Args:
+			mail_ids: Unique identifiers of the mails to retrieve.
+		'''
+		# content ids must be unique within a batch
+		mail_ids = list(dict.fromkeys(mail_ids))
+		query = urlencode([('format', 'metadata'), ('metadataHeaders', 'Subject'), ('fields', mail.MAIL_FIELDS)])
+		paths = {mail_id: '{p}/messages/{i}?{q}'.format(p=self.base_path, i=quote(mail_id, safe=''), q=query) for mail_id in mail_ids}
+		boundary = 'batch_' + uuid.uuid4().hex
+		body = encode_batch([(mail_id, 'GET {p} HTTP/1.1\r\n\r\n'.format(p=paths[mail_id]).encode('utf-8')) for mail_id in mail_ids], boundary)
+
+		# every request of a batch counts as an API call
+		instrumentation.registry.increment(instrumentation.API_CALLS, len(mail_ids), endpoint='messages.get')
+		instrumentation.registry.increment(instrumentation.API_CALLS, endpoint='batch')
+		try:
+			with instrumentation.registry.time(instrumentation.API_CALL_SECONDS, endpoint='batch'):
+				content_type, content = await self.send_raw('POST', self.batch_url, headers={'Content-Type': 'multipart/mixed; boundary=' + boundary}, data=body)
+			parts = decode_batch(content_type, content)
+		except Exception:
+			instrumentation.registry.increment(instrumentation.API_ERRORS, endpoint='batch')
+			raise
+
+		responses = {}
+		for content_id, http_message in parts:
+			# Gmail prefixes the content id of each response with 'response-'
+			mail_id = content_id[len('response-'):] if content_id.startswith('response-') else content_id
+			responses[mail_id] = split_http_message(http_message)
+
+		mail_objs, mail_errors = {}, {}
+		for mail_id in mail_ids:
+			status_line, part_content = responses.get(mail_id, ('HTTP/1.1 500 Missing', b'no response in the batch'))
+			status = int(status_line.split(' ')[1])
+			if status >= 400:
+				instrumentation.registry.increment(instrumentation.API_ERRORS, endpoint='messages.get')
+				mail_errors[mail_id] = GmailApiError(BatchPartResponse(paths[mail_id], status), part_content)
+			else:
+				mail_objs[mail_id] = json.loads(part_content.decode('utf-8'))
+		return mail_objs, mail_errors
+
+	async def list_labels(self):
+		'''Returns the labels of the authenticated user's Gmail.
+		'''
+		labels_obj = await self.request('labels.list', 'GET', '/labels')
+		return labels_obj.get('labels', [])
+
+	async def create_label(self, label_name):
+		'''Creates a Gmail label and returns its unique identifier.
+
+		Args:
+			label_name: Name of the label to create.
+		'''
+		created_label = await self.request('labels.create', 'POST', '/labels', body={'name': label_name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'})
+		return created_label['id']
+
+	async def batch_modify(self, mail_ids, label_id):
+		'''Assigns a label to up to 1000 Gmail mails with a single request.
+
+		Args:
+			mail_ids: Unique identifiers of the mails to be assigned the label.
+			label_id: Unique identifier of the label to assign.
+		'''
+		await self.request('messages.batchModify', 'POST', '/messages/batchModify', body={'ids': mail_ids, 'removeLabelIds': [], 'addLabelIds': [label_id]})
+
+class HistoryGroup(object):
+	'''The new mails of one history sync, which advance the history cursor once all of them have been labeled.
+	'''
+	def __init__(self, sequence, history_id, synced_history_id, mail_ids, messages=(), started=None):
+		'''Initializes a HistoryGroup object.
+
+		Args:
+			sequence: Sequence of the sync, in the order of the claims of the HistorySync (history.py).
+			history_id: The minimum history id of the messages which triggered the sync.
+			synced_history_id: The history id the mails of the sync are complete up to.
+			mail_ids: Unique identifiers of the mails claimed by the sync.
+			messages: The Gmail subscription messages which triggered the sync, acknowledged once the group is complete.
+			started: The time.perf_counter() value when the sync started, or None for now.
+		'''
+		super(HistoryGroup, self).__init__()
+		self.sequence = sequence
+		self.history_id = history_id
+		self.messages = messages
+		self.synced_history_id = synced_history_id
+		self.pending = set(mail_ids)
+		self.failed = []
+		self.completed = False
+		self.started = time.perf_counter() if started is None else started
+
+class AsyncPipeline(object):
+	'''Processes Gmail subscription messages in asyncio stages.
+
+	History is synced by a single task, so that groups of mails are created in the order of the history cursor.
+	Mails are fetched, classified in batches and labeled in batches by the tasks of the following stages.
+	The cursor is advanced in order, once every mail of a group and of the groups before it has been labeled.
+	If a mail fails, its group and the groups synced before the failure do not advance the cursor,
+	so that the failed mail is listed again by the next sync.
+	Subscription messages are acknowledged once every mail of their group has been labeled,
+	and are not acknowledged otherwise, so that they are delivered again and the failed mails are synced again.
+	The pipeline serves one inbox, whose state is passed to it, so that several inboxes can share a process (accounts.py).
+	'''
+	def __init__(self, credential_holder, history_sync, label_cache, analyze_many, mail_stats, name=None, connections=100, fetch_concurrency=50, inference_concurrency=2, label_concurrency=1, queue_size=1000, inference_batch_size=64, label_window=0.5, coalesce_window=0.05, coalesce_max_wait=0.2, base_url=GMAIL_API_URL):
+		'''Initializes an AsyncPipeline object. The stages are started by start, within the event loop.
+
+		Args:
+			credential_holder: A CredentialHolder (servicepool.py) providing the access token.
+			history_sync: The HistorySync (history.py) of the inbox.
+			label_cache: The LabelCache (labels.py) of the inbox.
+			analyze_many: Function returning the polarity labels of a list of mails' weighted texts, eg. Model.analyze_many (sentimentanalysis.py).
+			mail_stats: The metrics (metrics.py) object the polarities of the labeled mails are recorded to.
+			name: Name of the inbox, distinguishing the queue depths of its pipeline from those of others, or None if there is one inbox.
+			connections: Maximum number of simultaneous HTTP connections to Gmail.
+			fetch_concurrency: Number of batch requests fetching mails at the same time, each for up to mail.MAIL_BATCH_SIZE mails.
+			inference_concurrency: Number of batches classified at the same time, each in a thread of the executor.
+			label_concurrency: Number of label batches applied at the same time.
+			queue_size: Maximum number of mails waiting for each stage, beyond which the previous stage waits.
+			inference_batch_size: Maximum number of mails classified together.
+			label_window: Seconds for which label assignments are collected before being applied together.
+			coalesce_window: Seconds without a new message after which coalesced messages are synced.
+			coalesce_max_wait: Maximum number of seconds messages are coalesced for.
+			base_url: Url of the Gmail API for the authenticated user.
+		'''
+		super(AsyncPipeline, self).__init__()
+		self.client = AsyncGmailClient(credential_holder, connections, base_url)
+		self.history_sync = history_sync
+		self.label_cache = label_cache
+		self.analyze_many = analyze_many
+		self.mail_stats = mail_stats
+		self.name = name
+		self.concurrency = {'history': 1, 'fetch': fetch_concurrency, 'inference': inference_concurrency, 'label': label_concurrency, 'metrics': 1}
+		self.queue_size = queue_size
+		self.inference_batch_size = inference_batch_size
+		self.label_window = label_window
+		self.coalesce_window = coalesce_window
+		self.coalesce_max_wait = coalesce_max_wait
+		self.executor = ThreadPoolExecutor(inference_concurrency, thread_name_prefix='mailsense-inference')
+		self.loop = None
+		self.queues = {}
+		self.tasks = []
+		# in-flight groups
+		self.groups = set()
+		self.syncing = False
+		self.accepting = False
+		self.label_lock = None
+
+	async def start(self):
+		'''Opens the Gmail client and starts the tasks of every stage.
+		'''
+		self.loop = asyncio.get_event_loop()
+		self.label_lock = asyncio.Lock()
+		await self.client.open()
+
+		handlers = {'history': self.sync_history, 'fetch': self.fetch_mails, 'inference': self.classify_mails, 'label': self.label_mails, 'metrics': self.record_polarity}
+		queue_prefix = 'asyncpipeline.' if self.name is None else 'asyncpipeline.' + self.name + '.'
+		for stage, handler in handlers.items():
+			# notifications are small and coalesced, only mails are bounded
+			self.queues[stage] = asyncio.Queue(0 if stage == 'history' else self.queue_size)
+			instrumentation.register_queue(queue_prefix + stage, self.queues[stage].qsize)
+			for i in range(self.concurrency[stage]):
+				self.tasks.append(self.loop.create_task(self.run_stage(stage, handler)))
+
+		self.accepting = True
+		logger.info('started asyncio pipeline with concurrency %s', str(self.concurrency))
+
+	def submit(self, history_id, message=None):
+		'''Queues a notification for its history to be synced. Can be called from any thread.
+
+		Args:
+			history_id: History id of a message received by a Gmail subscriber.
+			message: The Gmail subscription message, to be acknowledged once its mails have been labeled.
+		'''
+		if not self.accepting:
+			raise RuntimeError('asyncio pipeline is not running')
+		self.loop.call_soon_threadsafe(self.queues['history'].put_nowait, (int(history_id), message))
+
+	async def run_stage(self, stage, handler):
+		'''Passes the items of a stage's queue to its handler until cancelled.
+
+		If the handler fails unexpectedly, the mails of its items are failed, so that their groups still complete
+		and their messages are not left unacknowledged.
+
+		Args:
+			stage: Name of the stage.
+			handler: Coroutine function processing a list of items of the stage, which it may collect more items into.
+		'''
+		queue = self.queues[stage]
+		while True:
+			items = [await queue.get()]
+			try:
+				with instrumentation.time_stage(stage):
+					await handler(items)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				logger.error('unexpected failure in %s stage', stage, exc_info=True)
+				self.fail_items(stage, items)
+
+	def fail_items(self, stage, items):
+		'''Fails the mails of the items of a stage, or declines the messages of the history stage's items.
+
+		Args:
+			stage: Name of the stage.
+			items: The items the stage's handler was processing.
+		'''
+		for item in items:
+			try:
+				if stage == 'history':
+					history_id, message = item
+					if message is not None:
+						message.nack()
+				elif stage != 'metrics':
+					# fetch, inference and labeling items start with the group and mail id
+					self.finish_mail(item[0], item[1], failed=True)
+			except Exception as e:
+				logger.error('failed to fail an item of the %s stage', stage, exc_info=True)
+
+	async def collect(self, queue, items, max_items, window=0.0, max_wait=None):
+		'''Adds the items following the given ones in a queue to them, and returns them.
+
+		Waits for items until none has arrived for the window, or until max_wait seconds have passed.
+
+		Args:
+			queue: The asyncio.Queue to take items from.
+			items: The list of items already taken from the queue, which is extended.
+			max_items: Maximum number of items returned.
+			window: Seconds to wait for a next item.
+			max_wait: Maximum number of seconds to wait for items, or None to wait at most one window.
+		'''
+		deadline = time.monotonic() + (window if max_wait is None else max_wait)
+		while len(items) < max_items:
+			if not queue.empty():
+				items.append(queue.get_nowait())
+				continue
+			remaining = min(window, deadline - time.monotonic())
+			if remaining <= 0:
+				break
+			try:
+				items.append(await asyncio.wait_for(queue.get(), remaining))
+			except asyncio.TimeoutError:
+				break
+		return items
+
+	async def sync(self, history_id):
+		'''Returns a tuple of the ids of new mails which have not been claimed yet, the history id they are complete up to,
+		and the sequence of the sync (HistorySync.complete).
+
+		Follows HistorySync.sync (history.py), listing the history with the asynchronous client.
+
+		Args:
+			history_id: History id of a message received by a Gmail subscriber.
+		'''
+		history_sync = self.history_sync
+		start_history_id = history_sync.cursor.get()
+		if start_history_id is None:
+			start_history_id = history_id
+
+		mail_ids, latest_history_id = [], start_history_id
+		backoff = history_sync.backoff
+		for attempt in range(history_sync.retries + 1):
+			try:
+				mail_ids, latest_history_id = await self.client.list_added_mail_ids(start_history_id)
+			except GmailApiError as e:
+				if e.resp.status != 404:
+					raise
+				# the cursor is too old for Gmail to provide the history from it
+				logger.warning('history id %s is no longer available, restarting from history id: %s', start_history_id, history_id)
+				history_sync.cursor.commit(history_id, force=True)
+				start_history_id = history_id
+				continue
+
+			if len(mail_ids) > 0 or int(latest_history_id) >= int(history_id) or attempt == history_sync.retries:
+				break
+			await asyncio.sleep(backoff)
+			backoff = backoff * 2
+
+		claimed, sequence = history_sync.claim(mail_ids, latest_history_id)
+		return claimed, latest_history_id, sequence
+
+	async def sync_history(self, items):
+		'''History stage: coalesces notifications, syncs the history once and queues the new mails to be fetched.
+
+		Args:
+			items: A list of the first of the coalesced messages, as a tuple (history id, message).
+		'''
+		self.syncing = True
+		try:
+			await self.collect(self.queues['history'], items, float('inf'), self.coalesce_window, self.coalesce_max_wait)
+			history_id = min(history_id for history_id, message in items)
+			messages = [message for history_id, message in items if message is not None]
+			if len(items) > 1:
+				logger.info('coalesced %d messages from history id: %s', len(items), history_id)
+			# every mail up to the committed history id has been processed, like in NotificationCoalescer (coalesce.py)
+			max_history_id = max(history_id for history_id, message in items)
+			cursor_history_id = self.history_sync.cursor.get()
+			if cursor_history_id is not None and max_history_id <= cursor_history_id:
+				logger.info('skipping history scan of %d messages up to history id %s, already processed up to %s', len(items), max_history_id, cursor_history_id)
+				for message in messages:
+					message.ack()
+				return
+			started = time.perf_counter()
+
+			try:
+				mail_ids, synced_history_id, sequence = await self.sync(history_id)
+			except Exception as e:
+				logger.error('failed to retrieve history for message with history id: %s', history_id, exc_info=True)
+				for message in messages:
+					message.nack()
+				return
+
+			group = HistoryGroup(sequence, history_id, synced_history_id, mail_ids, messages, started)
+			self.groups.add(group)
+			if len(mail_ids) == 0:
+				logger.info('no new mail ids for message with history id: %s', history_id)
+				self.complete_group(group)
+				return
+			logger.info('retrieved mail ids %s for message with history id: %s', str(mail_ids), history_id)
+		finally:
+			self.syncing = False
+
+		for i, mail_id in enumerate(mail_ids):
+			try:
+				await self.queues['fetch'].put((group, mail_id))
+			except Exception as e:
+				logger.error('failed to queue mail id %s for message with history id: %s', mail_id, history_id, exc_info=True)
+				# the messages of the group are declined once its remaining mails are failed
+				for remaining_mail_id in mail_ids[i:]:
+					self.finish_mail(group, remaining_mail_id, failed=True)
+				return
+
+	async def fetch_mails(self, items):
+		'''Fetch stage: retrieves the texts and labels of the queued mails with a batch request and queues them to be classified.
+
+		Mails which no longer exist or have no texts are processed, like in mail.label_mails.
+
+		Args:
+			items: A list of the first queued mail, as a tuple (HistoryGroup, mail id).
+		'''
+		await self.collect(self.queues['fetch'], items, mail.MAIL_BATCH_SIZE)
+		try:
+			mail_objs, mail_errors = await self.client.get_mails([mail_id for group, mail_id in items])
+		except (ValueError, GmailApiError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+			logger.error('failed to retrieve %d mails', len(items), exc_info=True)
+			for group, mail_id in items:
+				self.finish_mail(group, mail_id, failed=True)
+			return
+
+		for group, mail_id in items:
+			if mail_id in mail_errors:
+				if mail_errors[mail_id].resp.status == 404:
+					logger.warning('mail id %s no longer exists for message with history id: %s', mail_id, group.history_id)
+					self.finish_mail(group, mail_id)
+				else:
+					logger.error('no texts found for mail id %s for message with history id: %s', mail_id, group.history_id, exc_info=mail_errors[mail_id])
+					self.finish_mail(group, mail_id, failed=True)
+				continue
+			mail_obj = mail_objs[mail_id]
+			try:
+				mail_texts = mail.get_mail_obj_texts(mail_obj)
+			except KeyError as e:
+				# fetching the mail again would not give it texts
+				logger.warning('no texts found for mail id %s for message with history id: %s, skipping it', mail_id, group.history_id, exc_info=True)
+				self.finish_mail(group, mail_id)
+				continue
+
+			logger.info('retrieved texts %s for mail from message with history id: %s', mail_texts, group.history_id)
+			await self.queues['inference'].put((group, mail_id, mail_texts, mail_obj.get('labelIds', [])))
+
+	async def classify_mails(self, items):
+		'''Inference stage: classifies the texts of the queued mails in a single batch, in the executor.
+
+		Args:
+			items: A list of the first queued mail, as a tuple (HistoryGroup, mail id, mail texts, mail label ids).
+		'''
+		await self.collect(self.queues['inference'], items, self.inference_batch_size)
+		try:
+			polarity_labels = await self.loop.run_in_executor(self.executor, self.analyze_many, [mail_texts for group, mail_id, mail_texts, label_ids in items])
+		except Exception as e:
+			logger.error('failed to classify %d mails', len(items), exc_info=True)
+			for group, mail_id, mail_texts, label_ids in items:
+				self.finish_mail(group, mail_id, failed=True)
+			return
+
+		for (group, mail_id, mail_texts, label_ids), polarity_label in zip(items, polarity_labels):
+			logger.info('retrieved polarity label %s for mail from message with history id: %s', polarity_label, group.history_id)
+			await self.queues['label'].put((group, mail_id, polarity_label, label_ids))
+
+	async def get_label_id(self, label_name, refresh=False):
+		'''Returns the unique identifier of a Gmail label, looking it up and creating it if it is not cached.
+
+		Args:
+			label_name: Name of the label whose id is to be retrieved.
+			refresh: Whether to look the label up again, because the cached id was reported as missing.
+		'''
+		label_cache = self.label_cache
+		async with self.label_lock:
+			if refresh:
+				label_cache.invalidate(label_name)
+			label_id = label_cache.peek(label_name)
+			if label_id is None:
+				present = {label['name']: label['id'] for label in await self.client.list_labels()}
+				label_id = present.get(label_name)
+				if label_id is None:
+					label_id = await self.client.create_label(label_name)
+				label_cache.put(label_name, label_id)
+			return label_id
+
+	async def label_mails(self, items):
+		'''Labeling stage: collects label assignments for the label window and applies them with a batchModify call per label.
+
+		Args:
+			items: A list of the first queued assignment, as a tuple (HistoryGroup, mail id, polarity label, mail label ids).
+		'''
+		await self.collect(self.queues['label'], items, LabelBatcher.MAX_BATCH_MODIFY_IDS, self.label_window, self.label_window)
+
+		# label name as key, list of tuples (HistoryGroup, mail id) as value
+		assignments = {}
+		for group, mail_id, polarity_label, label_ids in items:
+			label_id = self.label_cache.peek(polarity_label)
+			if label_id is not None and label_id in label_ids:
+				logger.info('mail %s already has label %s for message with history id: %s', mail_id, polarity_label, group.history_id)
+				self.finish_mail(group, mail_id)
+				continue
+			assignments.setdefault(polarity_label, []).append((group, mail_id))
+
+		for polarity_label, label_assignments in assignments.items():
+			# a mail may have been classified more than once within the window
+			mail_ids = list(dict.fromkeys(mail_id for group, mail_id in label_assignments))
+			try:
+				missing_ids = await self.modify_mails(polarity_label, mail_ids)
+			except Exception as e:
+				for group, mail_id in label_assignments:
+					logger.error('failed to assign label %s to mail %s for message with history id: %s', polarity_label, mail_id, group.history_id, exc_info=True)
+					self.finish_mail(group, mail_id, failed=True)
+				continue
+
+			for group, mail_id in label_assignments:
+				if mail_id in missing_ids:
+					# labeling the mail again would fail again
+					logger.warning('mail id %s no longer exists for message with history id: %s', mail_id, group.history_id)
+					self.finish_mail(group, mail_id)
+					continue
+				logger.info('assigned label %s to mail from message with history_id: %s\n', polarity_label, group.history_id)
+				await self.queues['metrics'].put((group, polarity_label))
+				self.finish_mail(group, mail_id)
+
+	async def modify_mails(self, label_name, mail_ids):
+		'''Assigns a label to mails with a batchModify call, like LabelBatcher.modify_mails (labels.py).
+		Returns the set of ids of the mails which no longer exist.
+
+		Args:
+			label_name: Name of the label to assign.
+			mail_ids: Unique identifiers of the mails to be assigned the label.
+		'''
+		missing_ids = set()
+		label_id = await self.get_label_id(label_name)
+		try:
+			await self.client.batch_modify(mail_ids, label_id)
+			return missing_ids
+		except GmailApiError as e:
+			if e.resp.status not in (400, 404):
+				raise
+			if is_missing_label_error(e, label_id):
+				logger.warning('label %s not found, looking it up again', label_name)
+				label_id = await self.get_label_id(label_name, refresh=True)
+			else:
+				missing_ids.update(get_missing_mail_ids(e, mail_ids))
+				if len(missing_ids) == 0:
+					# retrying the same mails would be rejected again
+					return await self.split_mails(label_name, mail_ids, e)
+				logger.warning('mails %s no longer exist, assigning label %s to the other mails', str(sorted(missing_ids)), label_name)
+
+		remaining_ids = [mail_id for mail_id in mail_ids if mail_id not in missing_ids]
+		if len(remaining_ids) == 0:
+			return missing_ids
+		try:
+			await self.client.batch_modify(remaining_ids, label_id)
+		except GmailApiError as e:
+			if e.resp.status not in (400, 404):
+				raise
+			missing_ids.update(await self.split_mails(label_name, remaining_ids, e))
+		return missing_ids
+
+	async def split_mails(self, label_name, mail_ids, e):
+		'''Assigns a label to each half of mails whose batchModify call was rejected, like LabelBatcher.split_mails (labels.py).
+		Returns the set of ids of the mails which no longer exist.
+
+		Args:
+			label_name: Name of the label to assign.
+			mail_ids: Unique identifiers of the mails to be assigned the label.
+			e: The GmailApiError rejecting the call for all of the mails.
+		'''
+		if len(mail_ids) == 1:
+			if e.resp.status != 404:
+				raise e
+			logger.warning('mail %s no longer exists, not assigning label %s', mail_ids[0], label_name)
+			return set(mail_ids)
+
+		logger.warning('failed to assign label %s to %d mails, assigning it to each half of them', label_name, len(mail_ids))
+		half = len(mail_ids) // 2
+		return await self.modify_mails(label_name, mail_ids[:half]) | await self.modify_mails(label_name, mail_ids[half:])
+
+	async def record_polarity(self, items):
+		'''Metrics stage: records the polarity of a labeled mail.
+
+		Args:
+			items: A list of a tuple (HistoryGroup, polarity label).
+		'''
+		group, polarity_label = items[0]
+		try:
+			self.mail_stats.addPolarity(polarity_label)
+		except Exception as e:
+			logger.error('failed to record email polarity classification for message with history id: %s', group.history_id, exc_info=True)
+
+	def finish_mail(self, group, mail_id, failed=False):
+		'''Marks a mail of a group as processed, completing the group once all of its mails are.
+
+		Args:
+			group: The HistoryGroup of the mail.
+			mail_id: Unique identifier of the mail.
+			failed: Whether the mail could not be processed.
+		'''
+		if mail_id not in group.pending:
+			return
+		group.pending.remove(mail_id)
+		if failed:
+			group.failed.append(mail_id)
+		if len(group.pending) == 0:
+			self.complete_group(group)
+
+	def complete_group(self, group):
+		'''Releases the failed mails of a completed group and advances the cursor over the completed groups in sync order (HistorySync.complete).
+
+		Args:
+			group: The HistoryGroup whose mails have all been processed.
+		'''
+		group.completed = True
+		self.groups.discard(group)
+		instrumentation.registry.observe(instrumentation.STAGE_SECONDS, time.perf_counter() - group.started, stage='total')
+		# mails which could not be processed are listed again by a later sync, triggered by the messages being delivered again,
+		# unless they failed too often (HistorySync.complete)
+		try:
+			retried = self.history_sync.complete(group.sequence, group.failed)
+		except Exception as e:
+			logger.error('failed to complete the sync of message with history id: %s', group.history_id, exc_info=True)
+			retried = group.failed
+		for message in group.messages:
+			if len(retried) > 0:
+				message.nack()
+			else:
+				message.ack()
+
+	def is_idle(self):
+		'''Returns whether no notification or mail is being processed.
+		'''
+		return not self.syncing and len(self.groups) == 0 and all(queue.empty() for queue in self.queues.values())
+
+	async def stop(self, timeout=30):
+		'''Stops accepting notifications, waits for the queued ones to be processed and stops every stage.
+
+		Args:
+			timeout: Maximum number of seconds to wait for the queued notifications.
+		'''
+		self.accepting = False
+		deadline = time.monotonic() + timeout
+		while not self.is_idle() and time.monotonic() < deadline:
+			await asyncio.sleep(0.05)
+		if not self.is_idle():
+			logger.warning('stopping with %d history groups still being processed', len(self.groups))
+
+		for task in self.tasks:
+			task.cancel()
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+		self.tasks = []
+		await self.client.close()
+		self.executor.shutdown()
+		logger.info('stopped asyncio pipeline')
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# This script coalesces bursts of Gmail subscription messages, so that a burst is processed with a single history scan.
+
+from concurrent.futures import Future
+import logging
+import threading
+import time
+
+logger = logging.getLogger('mailsense.mail.coalesce')
+
+class NotificationGroup(object):
+	'''Notifications collected within a coalescing window.
+	'''
+	def __init__(self, history_id):
+		'''Initializes a NotificationGroup object with its first notification.
+
+		Args:
+			history_id: History id of the first message received by a Gmail subscriber.
+		'''
+		super(NotificationGroup, self).__init__()
+		self.min_history_id = int(history_id)
+		self.max_history_id = int(history_id)
+		self.size = 1
+		self.first_arrival = time.monotonic()
+		self.last_arrival = self.first_arrival
+		self.future = Future()
+
+	def add(self, history_id):
+		'''Adds a notification to the group.
+
+		Args:
+			history_id: History id of a message received by a Gmail subscriber.
+		'''
+		self.min_history_id = min(self.min_history_id, int(history_id))
+		self.max_history_id = max(self.max_history_id, int(history_id))
+		self.size = self.size + 1
+		self.last_arrival = time.monotonic()
+
+class NotificationCoalescer(object):
+	'''Collects notifications arriving close together and processes them as one group.
+
+	The first notification of a group leads it: its thread waits until no notification has arrived for the window,
+	or until the maximum wait has passed, then processes the group from its minimum history id.
+	The threads of the other notifications wait for the result of the group.
+	A group whose history ids are all covered by the history cursor is not processed, since it has no new mails.
+	'''
+	def __init__(self, process, window=0.05, max_wait=0.2, cursor=None):
+		'''Initializes a NotificationCoalescer object.
+
+		Args:
+			process: Function called with the minimum history id and the number of notifications of a group, to process the group.
+			window: Seconds without a new notification after which a group is processed.
+			max_wait: Maximum number of seconds a group is held open after its first notification.
+			cursor: The HistoryCursor (history.py) of the inbox, or None to process every group.
+		'''
+		super(NotificationCoalescer, self).__init__()
+		self.process = process
+		self.window = window
+		self.max_wait = max_wait
+		self.cursor = cursor
+		self.group = None
+		self.lock = threading.Lock()
+
+	def submit(self, history_id):
+		'''Adds a notification to the current group and blocks until the group has been processed.
+
+		Returns the result of processing the group, or raises its exception.
+
+		Args:
+			history_id: History id of a message received by a Gmail subscriber.
+		'''
+		with self.lock:
+			is_leader = self.group is None
+			if is_leader:
+				self.group = NotificationGroup(history_id)
+			else:
+				self.group.add(history_id)
+			group = self.group
+
+		if is_leader:
+			self.lead(group)
+
+		return group.future.result()
+
+	def lead(self, group):
+		'''Waits for the group to be complete, then processes it.
+
+		Args:
+			group: The NotificationGroup led by the calling thread.
+		'''
+		while True:
+			with self.lock:
+				due = min(group.last_arrival + self.window, group.first_arrival + self.max_wait)
+				remaining = due - time.monotonic()
+				if remaining <= 0:
+					# later notifications start a new group
+					self.group = None
+					break
+			time.sleep(remaining)
+
+		if self.cursor is not None:
+			# every mail up to the committed history id has been processed
+			cursor_history_id = self.cursor.get()
+			if cursor_history_id is not None and group.max_history_id <= cursor_history_id:
+				logger.info('skipping history scan of %d messages up to history id %s, already processed up to %s', group.size, group.max_history_id, cursor_history_id)
+				group.future.set_result(True)
+				return
+
+		try:
+			group.future.set_result(self.process(group.min_history_id, group.size))
+		except Exception as e:
+			group.future.set_exception(e)
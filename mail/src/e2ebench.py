@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# This script benchmarks mailsense end to end, without a Google account.
+# Synthetic mails are delivered to a fake Gmail inbox (fakegmail.py) at a target rate (loadgen.py), and their notifications
+# are processed by the subscriber callbacks, in the callback threads or with the asyncio pipeline.
+# Every model type is benchmarked in a fresh interpreter, reporting the sustained mails/s, the latency from a mail's delivery
+# to its labeling, and the Gmail API calls per mail.
+
+import argparse
+import ast
+import asyncio
+import functools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from evaluation import LATENCY_PERCENTILES, percentile
+
+def start_pipeline(pipeline):
+	'''Starts an AsyncPipeline (asyncpipeline.py) in an event loop running in a background thread. Returns the loop.
+
+	Args:
+		pipeline: The AsyncPipeline to start.
+	'''
+	loop = asyncio.new_event_loop()
+	threading.Thread(target=loop.run_forever, name='mailsense-asyncpipeline', daemon=True).start()
+	asyncio.run_coroutine_threadsafe(pipeline.start(), loop).result()
+	return loop
+
+def run(config):
+	'''Returns the results of benchmarking a model type, in the current interpreter.
+
+	Args:
+		config: A dictionary of the benchmark settings, as parsed from the command line.
+	'''
+	import fakegmail
+	import instrumentation
+	import loadgen
+	import mail
+	from sentimentanalysis import ModelType
+	from servicepool import ServicePool
+	import subscriber
+
+	work_dir = tempfile.mkdtemp(prefix='mailsense-e2ebench-')
+	mailbox = fakegmail.FakeMailbox(config['latency'], config['latencies'], config['errorrate'], config['seed'])
+	credential_holder = fakegmail.FakeCredentialHolder()
+	service_pool = ServicePool(credential_holder, config['servicepoolsize'], build=lambda creds: fakegmail.FakeGmailService(mailbox))
+
+	mail.start(ModelType[config['modeltype']], config['modelargs'], os.path.join(work_dir, 'mail.log'), service_pool, os.path.join(work_dir, 'mailsense.history'), download=config['download'], inference_workers=config['inferenceworkers'], metrics_path=os.path.join(work_dir, 'mailsense.db'))
+	# calls made at startup, eg. to create the labels, are not counted
+	startup = mailbox.stats()
+
+	server, pipeline, loop = None, None, None
+	callback = subscriber.callback
+	if config['asyncpipeline']:
+		from asyncpipeline import AsyncPipeline
+
+		server = fakegmail.FakeGmailServer(mailbox)
+		server.start()
+		pipeline = AsyncPipeline(credential_holder, mail.history_sync, mail.label_cache, mail.model.analyze_many, mail.mail_stats, base_url=server.base_url)
+		loop = start_pipeline(pipeline)
+		callback = functools.partial(subscriber.async_callback, pipeline)
+
+	streaming_pull_future, publisher = None, None
+	if config['emulator']:
+		# notifications go through the Pub/Sub emulator, with the subscriber client used in production
+		from google.api_core import exceptions
+		from google.cloud import pubsub_v1
+
+		publisher = loadgen.TopicPublisher(config['project'], config['topic'])
+		subscriber_client = pubsub_v1.SubscriberClient()
+		subscription_path = subscriber_client.subscription_path(config['project'], config['subscription'])
+		try:
+			subscriber_client.create_subscription(name=subscription_path, topic=publisher.topic_path)
+		except exceptions.AlreadyExists:
+			pass
+		streaming_pull_future = subscriber_client.subscribe(subscription_path, callback=callback, flow_control=subscriber.get_flow_control(config['flowmaxmessages'], 10 * 1024 * 1024, 3600), scheduler=subscriber.get_scheduler(config['callbackthreads']))
+	else:
+		publisher = loadgen.LocalSubscriber(callback, config['flowmaxmessages'], config['callbackthreads'])
+
+	replay_seconds = loadgen.replay(mailbox, publisher.publish, config['rate'], config['mails'], config['seed'])
+	deadline = time.monotonic() + config['timeout']
+	while mailbox.stats()['labeled'] < config['mails'] and time.monotonic() < deadline:
+		time.sleep(0.05)
+
+	if streaming_pull_future is not None:
+		streaming_pull_future.cancel()
+	publisher.close()
+	if pipeline is not None:
+		asyncio.run_coroutine_threadsafe(pipeline.stop(), loop).result()
+		loop.call_soon_threadsafe(loop.stop)
+		server.stop()
+	mail.stop()
+
+	stats = mailbox.stats()
+	labeled = [mail_id for mail_id in mailbox.labeled_at]
+	latencies = sorted(mailbox.labeled_at[mail_id] - mailbox.delivered_at[mail_id] for mail_id in labeled)
+	seconds = max(mailbox.labeled_at.values()) - min(mailbox.delivered_at.values()) if len(labeled) > 0 else None
+	calls = {endpoint: count - startup['calls'].get(endpoint, 0) for endpoint, count in stats['calls'].items()}
+	calls = {endpoint: count for endpoint, count in calls.items() if count > 0}
+
+	return {
+		'model_type': config['modeltype'],
+		'mode': 'asyncpipeline' if config['asyncpipeline'] else 'threads',
+		'mails': config['mails'],
+		'target_rate': config['rate'],
+		'replay_seconds': replay_seconds,
+		'labeled': len(labeled),
+		'mails_per_second': len(labeled) / seconds if seconds else None,
+		'latency_ms': {'p' + str(p): None if len(latencies) == 0 else percentile(latencies, p) * 1000 for p in LATENCY_PERCENTILES},
+		'api_calls': calls,
+		# a batch request is an HTTP request holding several calls, not a call of its own
+		'api_calls_per_mail': sum(count for endpoint, count in calls.items() if endpoint != 'batch') / len(labeled) if len(labeled) > 0 else None,
+		'http_requests_per_mail': (stats['requests'] - startup['requests']) / len(labeled) if len(labeled) > 0 else None,
+		# latencies of the processing stages and API calls, as recorded by the service itself
+		'instrumentation': instrumentation.registry.summary()
+	}
+
+def run_benchmark(config):
+	'''Returns the results of benchmarking a model type in a fresh interpreter, or a dictionary with its error.
+
+	Args:
+		config: A dictionary of the benchmark settings, as parsed from the command line.
+	'''
+	command = [sys.executable, __file__, '--child', json.dumps(config)]
+	completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+	if completed.returncode != 0:
+		return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'exit code ' + str(completed.returncode)}
+	return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def print_result(result):
+	'''Prints a summary of the results of a model type.
+
+	Args:
+		result: The results returned by run.
+	'''
+	print('{mt} ({m}): {l}/{n} mails labeled, {r:.1f} mails/s, latency {p}, {c:.2f} API calls and {h:.2f} HTTP requests per mail'.format(
+		mt=result['model_type'], m=result['mode'], l=result['labeled'], n=result['mails'], r=result['mails_per_second'] or 0,
+		p=', '.join('{p} {l:.1f}ms'.format(p=p, l=latency) for p, latency in result['latency_ms'].items() if latency is not None),
+		c=result['api_calls_per_mail'] or 0, h=result['http_requests_per_mail'] or 0))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='benchmark mailsense end to end against a fake Gmail inbox and synthetic traffic')
+	parser.add_argument('-mt', '--modeltypes', help='string: comma separated model types to benchmark', type=str, action='store', default='nltk,textblob,fastai')
+	parser.add_argument('-ma', '--modelargs', help='dict: model type as key, arguments to initialize the respective model as value', type=ast.literal_eval, action='store', default={})
+	parser.add_argument('-n', '--mails', help='int: number of synthetic mails delivered', type=int, action='store', default=1000)
+	parser.add_argument('-r', '--rate', help='float: target number of mails delivered per second', type=float, action='store', default=100.0)
+	parser.add_argument('-la', '--latency', help='float: seconds every Gmail API call takes', type=float, action='store', default=0.02)
+	parser.add_argument('-le', '--latencies', help='dict: seconds taken by the calls of specific endpoints, eg. {\'messages.get\': 0.05}', type=ast.literal_eval, action='store', default={})
+	parser.add_argument('-er', '--errorrate', help='float: probability of a history, get or modify call failing', type=float, action='store', default=0.0)
+	parser.add_argument('-sd', '--seed', help='int: seed of the synthetic mails and injected errors', type=int, action='store', default=0)
+	parser.add_argument('-to', '--timeout', help='float: maximum number of seconds to wait for the mails to be labeled after the last delivery', type=float, action='store', default=60.0)
+	parser.add_argument('-ap', '--asyncpipeline', help='process messages with the asyncio pipeline, against a fake Gmail server on localhost', action='store_true')
+	parser.add_argument('-fm', '--flowmaxmessages', help='int: maximum number of messages being processed', type=int, action='store', default=100)
+	parser.add_argument('-ct', '--callbackthreads', help='int: number of threads running subscriber callbacks', type=int, action='store', default=10)
+	parser.add_argument('-sp', '--servicepoolsize', help='int: maximum number of Gmail service objects shared by callbacks', type=int, action='store', default=10)
+	parser.add_argument('-iw', '--inferenceworkers', help='int: number of worker processes running the model', type=int, action='store', default=0)
+	parser.add_argument('-em', '--emulator', help='publish and receive notifications through the Pub/Sub emulator at PUBSUB_EMULATOR_HOST', action='store_true')
+	parser.add_argument('-p', '--project', help='string: project of the emulator topic and subscription', type=str, action='store', default='mailsense-bench')
+	parser.add_argument('-t', '--topic', help='string: name of the emulator topic', type=str, action='store', default='mailsense-bench')
+	parser.add_argument('-s', '--subscription', help='string: name of the emulator subscription', type=str, action='store', default='mailsense-bench')
+	parser.add_argument('-dl', '--download', help='download missing nltk data required by the models', action='store_true')
+	parser.add_argument('-op', '--outputpath', help='string: path to output json file with the results', type=str, action='store', required=False)
+	parser.add_argument('--child', help=argparse.SUPPRESS, type=json.loads, action='store', required=False)
+	args = parser.parse_args()
+
+	if args.child is not None:
+		print(json.dumps(run(args.child)))
+		sys.exit(0)
+
+	if args.emulator and 'PUBSUB_EMULATOR_HOST' not in os.environ:
+		parser.error('PUBSUB_EMULATOR_HOST must be set to use the Pub/Sub emulator')
+
+	results = {}
+	for model_type_name in args.modeltypes.split(','):
+		config = dict(vars(args), modeltype=model_type_name, modelargs=args.modelargs.get(model_type_name))
+		del config['child'], config['modeltypes'], config['outputpath']
+		result = run_benchmark(config)
+		results[model_type_name] = result
+		if 'error' in result:
+			print('{mt}: failed: {e}'.format(mt=model_type_name, e=result['error']))
+		else:
+			print_result(result)
+
+	if args.outputpath is not None:
+		with open(args.outputpath, 'w') as f:
+			json.dump(results, f, indent=2)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# This script evaluates and benchmarks any sentiment analysis model type on the test set of a dataset.
+# The test set is streamed in batches, optionally sharded across processes, and the accuracy, confusion matrix,
+# throughput and per-text latency are written to a json file.
+
+import argparse
+import ast
+from concurrent.futures import ProcessPoolExecutor
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+from sentimentanalysis import MODEL_ARGUMENT_CHOICES, Model, ModelType
+
+# the preprocessing module is shared with the dataset scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data/src'))
+import preprocess
+
+# preprocessing steps applied to the test texts by default, model type name as key
+DEFAULT_PREPROCESSING = {
+	'fastai': (),
+	'textblob': ('clean',),
+	'nltk': ('clean', 'stopwords')
+}
+LATENCY_PERCENTILES = (50, 95, 99)
+
+def get_default_cache_dir():
+	'''Returns the default directory of the cached preprocessed rows, in the user's cache directory.
+
+	The cache is kept out of the dataset's directory, which is tracked by dvc.
+	Cached files are keyed by the hash of their dataset, so datasets can share the directory.
+	'''
+	cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+	return os.path.join(cache_home, 'mailsense', 'preprocessed')
+
+def evaluate_shard(model_type, model_args, dataset_path, batch_size=256, shard=0, shards=1, preprocessing=(), latency_samples=200, download=False, cache_dir=None):
+	'''Returns the raw results of evaluating a model on a shard of the test batches.
+
+	Batch i belongs to shard i modulo shards. The first latency_samples texts are also predicted one at a time to measure the per-text latency.
+
+	Args:
+		model_type: A ModelType (sentimentanalysis.py) value of the sentiment analysis model to evaluate.
+		model_args: The arguments for the respective sentiment analysis model.
+		dataset_path: Path to the csv dataset.
+		batch_size: Number of texts predicted together.
+		shard: Index of the shard to evaluate.
+		shards: Total number of shards.
+		preprocessing: Sequence of preprocessing steps (preprocess.py) applied to the texts.
+		latency_samples: Number of texts predicted one at a time.
+		download: Whether missing nltk data may be downloaded.
+		cache_dir: Directory of the cached preprocessed rows, or None to preprocess the texts while evaluating.
+	'''
+	model = Model(model_type, model_args, download=download)
+
+	confusion = {}
+	latencies = []
+	total = 0
+	predict_seconds = 0.0
+	for i, batch in enumerate(preprocess.iterate_batches(dataset_path, preprocessing, batch_size, 'test', cache_dir, download)):
+		if i % shards != shard:
+			continue
+
+		texts = batch[preprocess.DATASET_TEXT_LABEL].tolist()
+		targets = batch[preprocess.DATASET_TARGET_LABEL].tolist()
+		for text in texts[:max(0, latency_samples - len(latencies))]:
+			start = time.perf_counter()
+			model.predict_many([text])
+			latencies.append(time.perf_counter() - start)
+
+		start = time.perf_counter()
+		predictions = model.predict_many(texts)
+		predict_seconds += time.perf_counter() - start
+
+		for target, prediction in zip(targets, predictions):
+			target_counts = confusion.setdefault(target, {})
+			target_counts[prediction] = target_counts.get(prediction, 0) + 1
+		total += len(texts)
+
+	return {'model_identity': model.model_identity, 'texts': total, 'predict_seconds': predict_seconds, 'latencies': latencies, 'confusion': confusion}
+
+def percentile(sorted_values, p):
+	'''Returns the nearest-rank percentile of sorted values, or None if there are none.
+
+	Args:
+		sorted_values: List of values in ascending order.
+		p: Percentile, between 0 and 100.
+	'''
+	if len(sorted_values) == 0:
+		return None
+	return sorted_values[max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))]
+
+def evaluate(model_type, model_args, dataset_path, batch_size=256, shards=1, preprocessing=None, latency_samples=200, download=False, cache_dir=None):
+	'''Returns a report of the accuracy, confusion matrix, throughput and per-text latency of a model on the test set of a dataset.
+
+	Args:
+		model_type: A ModelType (sentimentanalysis.py) value of the sentiment analysis model to evaluate.
+		model_args: The arguments for the respective sentiment analysis model.
+		dataset_path: Path to the csv dataset.
+		batch_size: Number of texts predicted together.
+		shards: Number of processes the test batches are split between, each loading the model.
+		preprocessing: Sequence of preprocessing steps (preprocess.py), or None for the default steps of the model type.
+		latency_samples: Number of texts predicted one at a time, per shard, to measure the per-text latency.
+		download: Whether missing nltk data may be downloaded.
+		cache_dir: Directory of the cached preprocessed rows, or None to preprocess the texts while evaluating.
+	'''
+	if preprocessing is None:
+		preprocessing = DEFAULT_PREPROCESSING[str(model_type)]
+	preprocessing = tuple(preprocessing)
+	# preprocessed once, before the shards read the cache
+	preprocess.build_cache(dataset_path, preprocessing, 'test', cache_dir, download)
+
+	if shards == 1:
+		results = [evaluate_shard(model_type, model_args, dataset_path, batch_size, 0, 1, preprocessing, latency_samples, download, cache_dir)]
+	else:
+		# spawn, so that each shard imports and loads only its own model
+		with ProcessPoolExecutor(shards, mp_context=multiprocessing.get_context('spawn')) as executor:
+			futures = [executor.submit(evaluate_shard, model_type, model_args, dataset_path, batch_size, shard, shards, preprocessing, latency_samples, download, cache_dir) for shard in range(shards)]
+			results = [future.result() for future in futures]
+
+	confusion = {}
+	for result in results:
+		for target, target_counts in result['confusion'].items():
+			for prediction, count in target_counts.items():
+				confusion.setdefault(target, {})
+				confusion[target][prediction] = confusion[target].get(prediction, 0) + count
+
+	labels = sorted(set(confusion) | set(prediction for target_counts in confusion.values() for prediction in target_counts))
+	total = sum(result['texts'] for result in results)
+	correct = sum(confusion.get(label, {}).get(label, 0) for label in labels)
+	latencies = sorted(latency for result in results for latency in result['latencies'])
+
+	return {
+		'model_type': str(model_type),
+		'model_identity': results[0]['model_identity'],
+		'dataset_path': dataset_path,
+		'preprocessing': list(preprocessing),
+		'batch_size': batch_size,
+		'shards': shards,
+		'texts': total,
+		'accuracy': correct / total * 100 if total > 0 else None,
+		# rows are targets, columns are predictions
+		'confusion_matrix': {'labels': labels, 'counts': [[confusion.get(target, {}).get(prediction, 0) for prediction in labels] for target in labels]},
+		# the shards predict in parallel
+		'texts_per_second': sum(result['texts'] / result['predict_seconds'] for result in results if result['predict_seconds'] > 0),
+		'latency_samples': len(latencies),
+		'latency_ms': {'p' + str(p): None if len(latencies) == 0 else percentile(latencies, p) * 1000 for p in LATENCY_PERCENTILES}
+	}
+
+def print_report(report):
+	'''Prints a summary of an evaluation report.
+
+	Args:
+		report: A report returned by evaluate.
+	'''
+	print('Test Size: ' + str(report['texts']))
+	print('accuracy: ' + str(report['accuracy']))
+	print('throughput: {t:.1f} texts/s'.format(t=report['texts_per_second']))
+	print('latency: ' + ', '.join('{p} {l:.2f}ms'.format(p=p, l=latency) for p, latency in report['latency_ms'].items() if latency is not None))
+	labels = report['confusion_matrix']['labels']
+	print('confusion matrix (rows: target, columns: predicted):')
+	print('\t'.join([''] + labels))
+	for label, counts in zip(labels, report['confusion_matrix']['counts']):
+		print('\t'.join([label] + [str(count) for count in counts]))
+
+def write_report(report, output_path):
+	'''Writes an evaluation report to a json file.
+
+	Args:
+		report: A report returned by evaluate.
+		output_path: Path of the json file.
+	'''
+	with open(output_path, 'w') as f:
+		json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='evaluate and benchmark a sentiment analysis model on the test set of a dataset')
+	parser.add_argument('-mt', '--modeltype', help='string: the type of model to evaluate', type=lambda model: ModelType[model], choices=list(ModelType), action='store', required=True)
+	parser.add_argument('-ma', '--modelargs', help='dict: the arguments to initialize the respective model. Arguments required for the various model types: ' + str(MODEL_ARGUMENT_CHOICES), type=ast.literal_eval, action='store', required=False)
+	parser.add_argument('-dp', '--datasetpath', help='str: path to csv dataset', type=str, action='store', required=True)
+	parser.add_argument('-op', '--outputpath', help='str: path to output json file containing the evaluation report', type=str, action='store', required=True)
+	parser.add_argument('-bs', '--batchsize', help='int: number of texts predicted together', type=int, action='store', default=256)
+	parser.add_argument('-sh', '--shards', help='int: number of processes the test set is split between', type=int, action='store', default=1)
+	parser.add_argument('-pp', '--preprocessing', help='str: comma separated preprocessing steps out of ' + str(preprocess.STEPS) + ', defaults to those of the model type', type=str, action='store', required=False)
+	parser.add_argument('-cd', '--cachedir', help='str: directory of the cached preprocessed test rows, defaults to mailsense/preprocessed in the user cache directory (~/.cache)', type=str, action='store', required=False)
+	parser.add_argument('-nc', '--nocache', help='preprocess the test rows without caching them', action='store_true')
+	parser.add_argument('-ls', '--latencysamples', help='int: number of texts predicted one at a time per shard to measure latency', type=int, action='store', default=200)
+	parser.add_argument('-dl', '--download', help='download missing nltk data required by the model and preprocessing', action='store_true')
+	args = parser.parse_args()
+
+	preprocessing = None
+	if args.preprocessing is not None:
+		preprocessing = [step for step in args.preprocessing.split(',') if len(step) > 0]
+		for step in preprocessing:
+			if step not in preprocess.STEPS:
+				parser.error('unknown preprocessing step: ' + step)
+	cache_dir = None if args.nocache else args.cachedir or get_default_cache_dir()
+
+	report = evaluate(args.modeltype, args.modelargs, args.datasetpath, args.batchsize, args.shards, preprocessing, args.latencysamples, args.download, cache_dir)
+	print_report(report)
+	write_report(report, args.outputpath)
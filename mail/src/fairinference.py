@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# This script shares one sentiment analysis model between the inboxes served by a process.
+# Every inbox queues its mails separately, and the model takes turns between the inboxes with queued mails,
+# so that a burst of mails in one inbox does not hold back the mails of the others.
+
+from collections import deque
+from concurrent.futures import Future
+import threading
+
+class FairInference(object):
+	'''Classifies the mails of several inboxes with one shared model, scheduling the inboxes with deficit round robin.
+
+	Each inbox has a queue of batches of mails. On its turn, an inbox is credited quantum * weight mails,
+	and its queued batches which fit in its credit are classified together. An inbox which still has queued mails
+	goes to the back of the line, so an inbox with a backlog delays the others by at most one turn.
+	'''
+	def __init__(self, model, quantum=64, workers=1):
+		'''Initializes a FairInference object and starts its worker threads.
+
+		Args:
+			model: The shared Model (sentimentanalysis.py).
+			quantum: Number of mails an inbox of weight 1 is credited per turn, also the maximum size of a queued batch.
+			workers: Number of threads classifying batches at the same time, eg. the number of inference worker processes.
+		'''
+		super(FairInference, self).__init__()
+		if quantum < 1:
+			raise ValueError('inference quantum must be at least 1')
+
+		self.model = model
+		self.quantum = quantum
+		# inbox name as key, deque of [list of mails' weighted texts, Future] as value
+		self.queues = {}
+		self.weights = {}
+		self.credits = {}
+		# inboxes with queued mails, in the order of their turns
+		self.turns = deque()
+		self.condition = threading.Condition()
+		self.closed = False
+
+		self.threads = [threading.Thread(target=self.run, name='mailsense-fairinference', daemon=True) for i in range(max(workers, 1))]
+		for thread in self.threads:
+			thread.start()
+
+	def add_inbox(self, name, weight=1.0):
+		'''Registers an inbox.
+
+		Args:
+			name: Unique name of the inbox.
+			weight: Share of the model given to the inbox relative to the others when they all have queued mails.
+		'''
+		if weight <= 0:
+			raise ValueError('inference weight of inbox {n} must be positive'.format(n=name))
+		with self.condition:
+			self.queues[name] = deque()
+			self.weights[name] = weight
+			self.credits[name] = 0.0
+
+	def pending_count(self, name):
+		'''Returns the number of mails of an inbox waiting to be classified.
+
+		Args:
+			name: Name of the inbox.
+		'''
+		with self.condition:
+			return sum(len(mails_texts) for mails_texts, future in self.queues[name])
+
+	def analyze_many(self, name, texts_weights_list):
+		'''Returns the polarity labels of the mails of an inbox, blocking until it has been their turn.
+
+		Args:
+			name: Name of the inbox.
+			texts_weights_list: A List of lists of tuples: [[(text, weight of text), ...], ...]
+		'''
+		futures = []
+		with self.condition:
+			if self.closed:
+				raise RuntimeError('fair inference is closed')
+			queue = self.queues[name]
+			for i in range(0, len(texts_weights_list), self.quantum):
+				future = Future()
+				queue.append([texts_weights_list[i:i + self.quantum], future])
+				futures.append(future)
+			if len(futures) > 0 and name not in self.turns:
+				self.turns.append(name)
+				self.condition.notify()
+
+		polarity_labels = []
+		for future in futures:
+			polarity_labels.extend(future.result())
+		return polarity_labels
+
+	def take_turn(self):
+		'''Returns the batches classified on the next turn, waiting for one. Returns None once closed.
+		The caller must hold the condition.
+		'''
+		while len(self.turns) == 0:
+			if self.closed:
+				return None
+			self.condition.wait()
+
+		name = self.turns.popleft()
+		queue = self.queues[name]
+		self.credits[name] = self.credits[name] + self.quantum * self.weights[name]
+		batches = []
+		while len(queue) > 0 and len(queue[0][0]) <= self.credits[name]:
+			batch = queue.popleft()
+			self.credits[name] = self.credits[name] - len(batch[0])
+			batches.append(batch)
+
+		if len(queue) > 0:
+			self.turns.append(name)
+			self.condition.notify()
+		else:
+			# an idle inbox does not save up credit
+			self.credits[name] = 0.0
+		return batches
+
+	def run(self):
+		'''Classifies the batches of each turn together until closed.
+		'''
+		while True:
+			with self.condition:
+				batches = self.take_turn()
+			if batches is None:
+				return
+			if len(batches) == 0:
+				continue
+
+			try:
+				polarity_labels = self.model.analyze_many([texts_weights for mails_texts, future in batches for texts_weights in mails_texts])
+			except Exception as e:
+				for mails_texts, future in batches:
+					future.set_exception(e)
+				continue
+
+			start = 0
+			for mails_texts, future in batches:
+				future.set_result(polarity_labels[start:start + len(mails_texts)])
+				start = start + len(mails_texts)
+
+	def close(self):
+		'''Classifies the queued mails and stops the worker threads.
+		'''
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+		for thread in self.threads:
+			thread.join()
@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+
+# This script provides a local stand-in for the Gmail API endpoints used by mailsense, for benchmarks and tests without a Google account.
+# A FakeMailbox holds the mails, history and labels of an inbox. It is used in-process through a FakeGmailService,
+# which mimics the service objects of the Gmail API client, or over localhost through FakeGmailServer, for the asyncio pipeline.
+# Every call can be given a latency and a probability of failing, and is counted per endpoint.
+
+from apiclient import errors
+import httplib2
+
+import asyncio
+import bisect
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+# endpoints which fail with the error rate, those used at startup (labels, profile) never fail
+ERROR_ENDPOINTS = ('history.list', 'messages.get', 'messages.modify', 'messages.batchModify')
+HISTORY_PAGE_SIZE = 100
+
+class FakeMailbox(object):
+	'''The mails, history and labels of a fake Gmail inbox, shared by the fake service objects and server. Thread safe.
+	'''
+	def __init__(self, latency=0.0, latencies=None, error_rate=0.0, seed=0, email_address='benchmark@example.com'):
+		'''Initializes an empty FakeMailbox object.
+
+		Args:
+			latency: Seconds every call takes.
+			latencies: A dictionary of seconds taken by the calls of specific endpoints, endpoint name (eg. 'messages.get') as key.
+			error_rate: Probability of a call to one of ERROR_ENDPOINTS failing with a server error.
+			seed: Seed of the random error injection.
+			email_address: Email address of the inbox.
+		'''
+		super(FakeMailbox, self).__init__()
+		self.latency = latency
+		self.latencies = latencies or {}
+		self.error_rate = error_rate
+		self.random = random.Random(seed)
+		self.email_address = email_address
+		self.lock = threading.Lock()
+		self.history_id = 1000
+		# history ids and mail ids of the added mails, in history order
+		self.history_ids = []
+		self.history_mail_ids = []
+		self.mails = {}
+		# ids of mails whose retrieval fails with a server error, eg. to test retries
+		self.unavailable_mail_ids = set()
+		self.labels = {}
+		self.delivered_at = {}
+		self.labeled_at = {}
+		# number of calls per endpoint, and number of HTTP requests (a batch request holds several calls)
+		self.calls = {}
+		self.requests = 0
+
+	def begin(self, endpoint, request=True):
+		'''Counts a call to an endpoint. Returns a tuple of the seconds the call takes, and the HTTP status it fails with or None.
+
+		Args:
+			endpoint: Name of the endpoint, eg. 'messages.get'.
+			request: Whether the call is an HTTP request of its own, rather than part of a batch request.
+		'''
+		with self.lock:
+			self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+			if request:
+				self.requests = self.requests + 1
+			failure = 500 if endpoint in ERROR_ENDPOINTS and self.random.random() < self.error_rate else None
+		return self.latencies.get(endpoint, self.latency), failure
+
+	def deliver(self, subject, snippet):
+		'''Adds a mail to the inbox and returns a tuple of its id and the history id of its arrival.
+
+		Args:
+			subject: Subject of the mail.
+			snippet: Snippet of the mail's body.
+		'''
+		with self.lock:
+			self.history_id = self.history_id + 1
+			mail_id = format(self.history_id, 'x')
+			self.mails[mail_id] = {'id': mail_id, 'snippet': snippet, 'labelIds': ['INBOX'], 'payload': {'headers': [{'name': 'Subject', 'value': subject}]}}
+			self.history_ids.append(self.history_id)
+			self.history_mail_ids.append(mail_id)
+			self.delivered_at[mail_id] = time.monotonic()
+			return mail_id, self.history_id
+
+	def get_profile(self):
+		'''Returns the profile of the inbox.
+		'''
+		with self.lock:
+			return {'emailAddress': self.email_address, 'historyId': str(self.history_id)}
+
+	def list_history(self, start_history_id, page_token=None):
+		'''Returns a page of the history records of the mails added after a history id.
+
+		Args:
+			start_history_id: History id to list the history from.
+			page_token: Token of the page to return, or None for the first page.
+		'''
+		with self.lock:
+			# page tokens are positions in the history
+			start = bisect.bisect_right(self.history_ids, int(start_history_id)) if page_token is None else int(page_token)
+			end = min(start + HISTORY_PAGE_SIZE, len(self.history_ids))
+			history_obj = {'historyId': str(self.history_id)}
+			if end > start:
+				history_obj['history'] = [{'id': str(history_id), 'messagesAdded': [{'message': {'id': mail_id}}]} for history_id, mail_id in zip(self.history_ids[start:end], self.history_mail_ids[start:end])]
+			if end < len(self.history_ids):
+				history_obj['nextPageToken'] = str(end)
+		return history_obj
+
+	def get_mail(self, mail_id):
+		'''Returns a copy of a mail, or None if there is no such mail.
+
+		Args:
+			mail_id: Unique identifier of the mail.
+		'''
+		with self.lock:
+			mail_obj = self.mails.get(mail_id)
+			return None if mail_obj is None else dict(mail_obj, labelIds=list(mail_obj['labelIds']))
+
+	def list_labels(self):
+		'''Returns the labels of the inbox.
+		'''
+		with self.lock:
+			return [{'id': label_id, 'name': label_name} for label_id, label_name in self.labels.items()]
+
+	def create_label(self, label_name):
+		'''Creates a label and returns it.
+
+		Args:
+			label_name: Name of the label.
+		'''
+		with self.lock:
+			label_id = 'Label_' + str(len(self.labels) + 1)
+			self.labels[label_id] = label_name
+			return {'id': label_id, 'name': label_name}
+
+	def add_label(self, mail_ids, label_ids):
+		'''Adds labels to mails. Returns the HTTP status and content of an error, or None if the labels have been added.
+
+		Args:
+			mail_ids: Unique identifiers of the mails.
+			label_ids: Unique identifiers of the labels to add.
+		'''
+		now = time.monotonic()
+		with self.lock:
+			for label_id in label_ids:
+				if label_id not in self.labels:
+					return 400, b'Invalid label: ' + label_id.encode('utf-8')
+			for mail_id in mail_ids:
+				if mail_id not in self.mails:
+					# no mail is modified if any of them does not exist
+					return 404, b'Requested entity was not found: ' + mail_id.encode('utf-8')
+			for mail_id in mail_ids:
+				mail_obj = self.mails[mail_id]
+				mail_obj['labelIds'] = list(dict.fromkeys(mail_obj['labelIds'] + list(label_ids)))
+				self.labeled_at.setdefault(mail_id, now)
+		return None
+
+	def stats(self):
+		'''Returns a dictionary of the number of mails delivered and labeled, the calls per endpoint and the HTTP requests.
+		'''
+		with self.lock:
+			return {'delivered': len(self.delivered_at), 'labeled': len(self.labeled_at), 'calls': dict(self.calls), 'requests': self.requests}
+
+def raise_http_error(status, content):
+	'''Raises an HttpError of the Gmail API client.
+
+	Args:
+		status: HTTP status of the error.
+		content: Body of the error response.
+	'''
+	raise errors.HttpError(httplib2.Response({'status': status}), content)
+
+def check_label_result(result):
+	'''Raises an HttpError if adding labels failed.
+
+	Args:
+		result: The result of FakeMailbox.add_label.
+	'''
+	if result is not None:
+		raise_http_error(*result)
+
+def get_mail_or_raise(mailbox, mail_id):
+	'''Returns a mail of a FakeMailbox, raising an HttpError if there is no such mail.
+
+	Args:
+		mailbox: A FakeMailbox.
+		mail_id: Unique identifier of the mail.
+	'''
+	if mail_id in mailbox.unavailable_mail_ids:
+		raise_http_error(503, b'Backend Error')
+	mail_obj = mailbox.get_mail(mail_id)
+	if mail_obj is None:
+		raise_http_error(404, b'Requested entity was not found.')
+	return mail_obj
+
+class FakeRequest(object):
+	'''A request of a FakeGmailService, executed like a request of the Gmail API client.
+	'''
+	def __init__(self, mailbox, endpoint, operation):
+		'''Initializes a FakeRequest object.
+
+		Args:
+			mailbox: The FakeMailbox the request is made to.
+			endpoint: Name of the endpoint, eg. 'messages.get'.
+			operation: Function returning the response, or raising an HttpError.
+		'''
+		super(FakeRequest, self).__init__()
+		self.mailbox = mailbox
+		self.endpoint = endpoint
+		self.operation = operation
+
+	def run(self, request=True):
+		'''Returns the response of the request, raising an HttpError if it fails.
+
+		Args:
+			request: Whether the call is an HTTP request of its own, rather than part of a batch request.
+		'''
+		latency, failure = self.mailbox.begin(self.endpoint, request)
+		if request:
+			time.sleep(latency)
+		if failure is not None:
+			raise_http_error(failure, b'Injected backend error')
+		return self.operation()
+
+	def execute(self):
+		'''Returns the response of the request, raising an HttpError if it fails.
+		'''
+		return self.run()
+
+class FakeBatchRequest(object):
+	'''A batch of requests of a FakeGmailService, sent as a single HTTP request.
+	'''
+	def __init__(self, mailbox, callback):
+		'''Initializes an empty FakeBatchRequest object.
+
+		Args:
+			mailbox: The FakeMailbox the requests are made to.
+			callback: Function called with the request id, response and exception of each request.
+		'''
+		super(FakeBatchRequest, self).__init__()
+		self.mailbox = mailbox
+		self.callback = callback
+		self.requests = []
+
+	def add(self, request, request_id):
+		'''Adds a request to the batch.
+
+		Args:
+			request: A FakeRequest.
+			request_id: Identifier of the request passed to the callback.
+		'''
+		self.requests.append((request_id, request))
+
+	def execute(self):
+		'''Executes every request of the batch, calling the callback with the result of each.
+		'''
+		latency, failure = self.mailbox.begin('batch')
+		time.sleep(latency)
+		for request_id, request in self.requests:
+			try:
+				response, exception = request.run(request=False), None
+			except errors.HttpError as e:
+				response, exception = None, e
+			self.callback(request_id, response, exception)
+
+class FakeUsers(object):
+	'''The users resource of a FakeGmailService, providing its history, messages and labels resources.
+	'''
+	def __init__(self, mailbox):
+		'''Initializes a FakeUsers object.
+
+		Args:
+			mailbox: The FakeMailbox the requests are made to.
+		'''
+		super(FakeUsers, self).__init__()
+		self.mailbox = mailbox
+
+	def getProfile(self, userId):
+		'''Returns a request for the profile of the inbox.
+		'''
+		return FakeRequest(self.mailbox, 'getProfile', self.mailbox.get_profile)
+
+	def watch(self, userId, body):
+		'''Returns a request enabling push notifications, which only returns the profile.
+		'''
+		return FakeRequest(self.mailbox, 'watch', self.mailbox.get_profile)
+
+	def history(self):
+		'''Returns the history resource.
+		'''
+		return FakeHistory(self.mailbox)
+
+	def messages(self):
+		'''Returns the messages resource.
+		'''
+		return FakeMessages(self.mailbox)
+
+	def labels(self):
+		'''Returns the labels resource.
+		'''
+		return FakeLabels(self.mailbox)
+
+class FakeHistory(object):
+	'''The history resource of a FakeGmailService.
+	'''
+	def __init__(self, mailbox):
+		'''Initializes a FakeHistory object.
+
+		Args:
+			mailbox: The FakeMailbox the requests are made to.
+		'''
+		super(FakeHistory, self).__init__()
+		self.mailbox = mailbox
+
+	def list(self, userId, historyTypes=None, startHistoryId=None, pageToken=None):
+		'''Returns a request for a page of the history since a history id.
+		'''
+		return FakeRequest(self.mailbox, 'history.list', lambda: self.mailbox.list_history(startHistoryId, pageToken))
+
+class FakeMessages(object):
+	'''The messages resource of a FakeGmailService.
+	'''
+	def __init__(self, mailbox):
+		'''Initializes a FakeMessages object.
+
+		Args:
+			mailbox: The FakeMailbox the requests are made to.
+		'''
+		super(FakeMessages, self).__init__()
+		self.mailbox = mailbox
+
+	def get(self, userId, id, format=None, metadataHeaders=None, fields=None):
+		'''Returns a request for a mail, which always returns every field.
+		'''
+		return FakeRequest(self.mailbox, 'messages.get', lambda: get_mail_or_raise(self.mailbox, id))
+
+	def modify(self, userId, id, body):
+		'''Returns a request adding labels to a mail.
+		'''
+		return FakeRequest(self.mailbox, 'messages.modify', lambda: check_label_result(self.mailbox.add_label([id], body.get('addLabelIds', []))))
+
+	def batchModify(self, userId, body):
+		'''Returns a request adding labels to several mails.
+		'''
+		return FakeRequest(self.mailbox, 'messages.batchModify', lambda: check_label_result(self.mailbox.add_label(body['ids'], body.get('addLabelIds', []))))
+
+class FakeLabels(object):
+	'''The labels resource of a FakeGmailService.
+	'''
+	def __init__(self, mailbox):
+		'''Initializes a FakeLabels object.
+
+		Args:
+			mailbox: The FakeMailbox the requests are made to.
+		'''
+		super(FakeLabels, self).__init__()
+		self.mailbox = mailbox
+
+	def list(self, userId):
+		'''Returns a request for the labels of the inbox.
+		'''
+		return FakeRequest(self.mailbox, 'labels.list', lambda: {'labels': self.mailbox.list_labels()})
+
+	def create(self, userId, body):
+		'''Returns a request creating a label.
+		'''
+		return FakeRequest(self.mailbox, 'labels.create', lambda: self.mailbox.create_label(body['name']))
+
+class FakeGmailService(object):
+	'''A stand-in for a Gmail service object of the Gmail API client, backed by a FakeMailbox.
+	'''
+	def __init__(self, mailbox):
+		'''Initializes a FakeGmailService object.
+
+		Args:
+			mailbox: The FakeMailbox the requests are made to.
+		'''
+		super(FakeGmailService, self).__init__()
+		self.mailbox = mailbox
+
+	def users(self):
+		'''Returns the users resource.
+		'''
+		return FakeUsers(self.mailbox)
+
+	def new_batch_http_request(self, callback):
+		'''Returns an empty batch request, calling the callback with the result of each of its requests.
+		'''
+		return FakeBatchRequest(self.mailbox, callback)
+
+class FakeCredentialHolder(object):
+	'''A stand-in for a CredentialHolder (servicepool.py), with a constant access token.
+	'''
+	class Credentials(object):
+		token = 'fake-token'
+
+	def get(self):
+		'''Returns the constant credentials.
+		'''
+		return self.Credentials
+
+	def refresh(self):
+		'''Does nothing, the access token never expires.
+		'''
+
+	def stop(self):
+		'''Does nothing, there is no refresh thread.
+		'''
+
+class FakeGmailServer(object):
+	'''Serves a FakeMailbox over localhost with the paths of the Gmail REST API, from a background thread.
+	'''
+	def __init__(self, mailbox, host='127.0.0.1', port=0):
+		'''Initializes a FakeGmailServer object.
+
+		Args:
+			mailbox: The FakeMailbox served.
+			host: Host to listen on.
+			port: Port to listen on, or 0 to pick a free port.
+		'''
+		super(FakeGmailServer, self).__init__()
+		self.mailbox = mailbox
+		self.host = host
+		self.port = port
+		self.loop = None
+		self.runner = None
+		self.thread = None
+
+	@property
+	def base_url(self):
+		'''Url of the Gmail API for the fake user, to pass as base url to AsyncGmailClient (asyncpipeline.py).
+		'''
+		return 'http://{h}:{p}/gmail/v1/users/me'.format(h=self.host, p=self.port)
+
+	async def handle(self, endpoint, operation):
+		'''Returns the response of a call to an endpoint, after its latency.
+
+		Args:
+			endpoint: Name of the endpoint, eg. 'messages.get'.
+			operation: Function returning the response, or raising an HttpError.
+		'''
+		from aiohttp import web
+
+		latency, failure = self.mailbox.begin(endpoint)
+		await asyncio.sleep(latency)
+		try:
+			if failure is not None:
+				raise_http_error(failure, b'Injected backend error')
+			response = operation()
+		except errors.HttpError as e:
+			return web.Response(status=e.resp.status, body=e.content)
+		if response is None:
+			return web.Response(status=204)
+		return web.json_response(response)
+
+	async def handle_batch(self, request):
+		'''Returns the multipart response of a batch request, after its latency.
+
+		Only requests for mails (messages.get) are supported within a batch, each failing with the error rate.
+
+		Args:
+			request: The aiohttp request of the batch.
+		'''
+		from aiohttp import web
+		from asyncpipeline import decode_batch, encode_batch, split_http_message
+
+		latency, failure = self.mailbox.begin('batch')
+		await asyncio.sleep(latency)
+		parts = decode_batch(request.headers['Content-Type'], await request.read())
+
+		response_parts = []
+		for content_id, http_message in parts:
+			start_line, body = split_http_message(http_message)
+			match = re.match(r'GET /gmail/v1/users/me/messages/([^/?]+)', start_line)
+			try:
+				if match is None:
+					raise_http_error(400, b'Unsupported request within a batch')
+				part_latency, part_failure = self.mailbox.begin('messages.get', request=False)
+				if part_failure is not None:
+					raise_http_error(part_failure, b'Injected backend error')
+				status, content = 200, json.dumps(get_mail_or_raise(self.mailbox, match.group(1))).encode('utf-8')
+			except errors.HttpError as e:
+				status, content = e.resp.status, e.content
+			http_response = 'HTTP/1.1 {s} {r}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n'.format(s=status, r='OK' if status == 200 else 'Error').encode('utf-8') + content
+			response_parts.append(('response-' + content_id, http_response))
+
+		boundary = 'batch_' + uuid.uuid4().hex
+		return web.Response(body=encode_batch(response_parts, boundary), headers={'Content-Type': 'multipart/mixed; boundary=' + boundary})
+
+	def create_app(self):
+		'''Returns the aiohttp application serving the Gmail endpoints.
+		'''
+		from aiohttp import web
+
+		mailbox = self.mailbox
+		async def get_profile(request):
+			return await self.handle('getProfile', mailbox.get_profile)
+		async def list_history(request):
+			return await self.handle('history.list', lambda: mailbox.list_history(request.query['startHistoryId'], request.query.get('pageToken')))
+		async def get_mail(request):
+			return await self.handle('messages.get', lambda: get_mail_or_raise(mailbox, request.match_info['id']))
+		async def modify(request):
+			body = await request.json()
+			return await self.handle('messages.modify', lambda: check_label_result(mailbox.add_label([request.match_info['id']], body.get('addLabelIds', []))))
+		async def batch_modify(request):
+			body = await request.json()
+			return await self.handle('messages.batchModify', lambda: check_label_result(mailbox.add_label(body['ids'], body.get('addLabelIds', []))))
+		async def list_labels(request):
+			return await self.handle('labels.list', lambda: {'labels': mailbox.list_labels()})
+		async def create_label(request):
+			body = await request.json()
+			return await self.handle('labels.create', lambda: mailbox.create_label(body['name']))
+
+		app = web.Application()
+		prefix = '/gmail/v1/users/me'
+		app.router.add_get(prefix + '/profile', get_profile)
+		app.router.add_get(prefix + '/history', list_history)
+		app.router.add_post(prefix + '/messages/batchModify', batch_modify)
+		app.router.add_get(prefix + '/messages/{id}', get_mail)
+		app.router.add_post(prefix + '/messages/{id}/modify', modify)
+		app.router.add_get(prefix + '/labels', list_labels)
+		app.router.add_post(prefix + '/labels', create_label)
+		app.router.add_post('/batch/gmail/v1', self.handle_batch)
+		return app
+
+	def start(self):
+		'''Starts serving in a background thread, returning once the server is listening.
+		'''
+		from aiohttp import web
+
+		self.loop = asyncio.new_event_loop()
+		self.runner = web.AppRunner(self.create_app())
+		self.loop.run_until_complete(self.runner.setup())
+		site = web.TCPSite(self.runner, self.host, self.port)
+		self.loop.run_until_complete(site.start())
+		# the actual port, if a free port was picked
+		self.port = self.runner.addresses[0][1]
+		self.thread = threading.Thread(target=self.loop.run_forever, name='mailsense-fakegmail', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		'''Stops serving and the background thread.
+		'''
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+		self.loop.run_until_complete(self.runner.cleanup())
+		self.loop.close()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+# This script incrementally synchronizes the mails added to a Gmail inbox, using its history.
+# The last fully processed history id is persisted, so every history record is scanned once.
+
+from apiclient import errors
+
+from collections import OrderedDict
+import logging
+import os
+import threading
+import time
+
+from instrumentation import execute
+
+logger = logging.getLogger('mailsense.mail.history')
+
+class HistoryCursor(object):
+	'''The last fully processed Gmail history id, persisted to a file.
+	'''
+	def __init__(self, path):
+		'''Initializes a HistoryCursor object, loading the persisted history id if present.
+
+		Args:
+			path: Path of the file storing the history id.
+		'''
+		super(HistoryCursor, self).__init__()
+		self.path = path
+		self.lock = threading.Lock()
+		self.history_id = None
+		if os.path.exists(path):
+			with open(path) as f:
+				content = f.read().strip()
+			if len(content) > 0:
+				self.history_id = int(content)
+
+	def get(self):
+		'''Returns the persisted history id, or None if there is none.
+		'''
+		return self.history_id
+
+	def commit(self, history_id, force=False):
+		'''Persists a history id if it is ahead of the current one.
+
+		Args:
+			history_id: The history id up to which all mails have been processed.
+			force: Whether to persist the history id even if it is behind the current one.
+		'''
+		history_id = int(history_id)
+		with self.lock:
+			if not force and self.history_id is not None and history_id <= self.history_id:
+				return
+			# write to a temporary file first so that the cursor is never left half-written
+			tmp_path = self.path + '.tmp'
+			with open(tmp_path, 'w') as f:
+				f.write(str(history_id))
+			os.replace(tmp_path, self.path)
+			self.history_id = history_id
+
+class HistorySync(object):
+	'''Lists the mails added to a Gmail inbox since the persisted history cursor.
+
+	Pages through every history record since the cursor.
+	Mail ids are deduplicated across notifications, so overlapping scans do not process a mail twice.
+	Syncs may be processed at the same time, but the cursor only advances over them in the order of their claims:
+	if the mails of a sync fail, no sync claimed before the failure advances the cursor, so that the failed mails
+	are listed again by the next sync rather than skipped by a later one completing first.
+	A mail holds the cursor for at most max_failures failed attempts, after which it is given up on.
+	'''
+	def __init__(self, cursor, seen_size=10000, retries=3, backoff=0.1, max_failures=5):
+		'''Initializes a HistorySync object.
+
+		Args:
+			cursor: A HistoryCursor of the last fully processed history id.
+			seen_size: Number of recently claimed mail ids remembered for deduplication.
+			retries: Number of times an empty history is listed again while Gmail has not caught up with a notification.
+			backoff: Seconds to wait before the first retry, doubled on each subsequent retry.
+			max_failures: Number of failed attempts to process a mail after which the cursor advances past it.
+		'''
+		super(HistorySync, self).__init__()
+		self.cursor = cursor
+		self.seen_size = seen_size
+		self.retries = retries
+		self.backoff = backoff
+		self.max_failures = max_failures
+		# ordered to evict the oldest mail ids first
+		self.seen = OrderedDict()
+		# mail id as key, number of failed attempts to process the mail as value
+		self.failures = OrderedDict()
+		# claimed syncs which have not advanced the cursor yet: sequence as key, [synced history id, completed, failed] as value
+		self.syncs = OrderedDict()
+		self.next_sequence = 0
+		# only syncs from this sequence on may advance the cursor
+		self.commit_sequence = 0
+		self.lock = threading.Lock()
+
+	def seed(self, service):
+		'''Sets the cursor to the current history id of the inbox if there is no persisted cursor.
+
+		Args:
+			service: A Gmail service object to access the Gmail API.
+		'''
+		if self.cursor.get() is None:
+			profile = execute(service.users().getProfile(userId='me'), 'getProfile')
+			self.cursor.commit(profile['historyId'])
+			logger.info('seeded history cursor with history id: %s', profile['historyId'])
+
+	def sync(self, service, history_id):
+		'''Returns a tuple of the ids of new mails which have not been claimed yet, the history id they are complete up to,
+		and the sequence of the sync, to be passed to complete once the mails have been processed.
+
+		Lists the history from the cursor, or from the given history id if there is no cursor.
+		Retries with a short backoff only if the history is empty and Gmail has not caught up with the given history id.
+
+		Args:
+			service: A Gmail service object to access the Gmail API.
+			history_id: History id of a message received by a Gmail subscriber.
+		'''
+		start_history_id = self.cursor.get()
+		if start_history_id is None:
+			start_history_id = history_id
+
+		mail_ids, latest_history_id = [], start_history_id
+		backoff = self.backoff
+		for attempt in range(self.retries + 1):
+			try:
+				mail_ids, latest_history_id = list_added_mail_ids(service, start_history_id)
+			except errors.HttpError as e:
+				if e.resp.status != 404:
+					raise
+				# the cursor is too old for Gmail to provide the history from it
+				logger.warning('history id %s is no longer available, restarting from history id: %s', start_history_id, history_id)
+				self.cursor.commit(history_id, force=True)
+				start_history_id = history_id
+				continue
+
+			if len(mail_ids) > 0 or int(latest_history_id) >= int(history_id) or attempt == self.retries:
+				break
+			time.sleep(backoff)
+			backoff = backoff * 2
+
+		claimed, sequence = self.claim(mail_ids, latest_history_id)
+		return claimed, latest_history_id, sequence
+
+	def claim(self, mail_ids, synced_history_id):
+		'''Returns a tuple of the mail ids which have not been claimed by an earlier sync, which are claimed,
+		and the sequence of the sync, to be passed to complete once the mails have been processed.
+
+		Args:
+			mail_ids: Unique identifiers of mails.
+			synced_history_id: The history id the mails are complete up to.
+		'''
+		claimed = []
+		with self.lock:
+			sequence = self.next_sequence
+			self.next_sequence = self.next_sequence + 1
+			self.syncs[sequence] = [synced_history_id, False, False]
+			for mail_id in mail_ids:
+				if mail_id in self.seen:
+					continue
+				self.seen[mail_id] = True
+				claimed.append(mail_id)
+			while len(self.seen) > self.seen_size:
+				self.seen.popitem(last=False)
+		return claimed, sequence
+
+	def complete(self, sequence, failed_mail_ids=()):
+		'''Marks a sync as processed, and advances the cursor over the processed syncs in the order of their claims.
+		Returns the ids of the failed mails which are to be retried.
+
+		Mails which could not be processed are released, so that a later sync lists them again,
+		unless they have failed max_failures times, in which case they no longer hold the cursor.
+
+		Args:
+			sequence: The sequence returned by sync.
+			failed_mail_ids: Unique identifiers of the mails of the sync which could not be processed.
+		'''
+		retried = []
+		with self.lock:
+			for mail_id in failed_mail_ids:
+				failures = self.failures.pop(mail_id, 0) + 1
+				if failures >= self.max_failures:
+					# the mail stays claimed, so that it is not processed again while it is remembered
+					logger.error('giving up on mail %s after %d failed attempts', mail_id, failures)
+					continue
+				self.failures[mail_id] = failures
+				self.seen.pop(mail_id, None)
+				retried.append(mail_id)
+			while len(self.failures) > self.seen_size:
+				self.failures.popitem(last=False)
+
+			sync = self.syncs[sequence]
+			sync[1] = True
+			if len(retried) > 0:
+				sync[2] = True
+				# syncs claimed so far may have listed the failed mails, later ones list them again
+				self.commit_sequence = self.next_sequence
+
+			history_id = None
+			while len(self.syncs) > 0:
+				first_sequence, (synced_history_id, completed, failed) = next(iter(self.syncs.items()))
+				if not completed:
+					break
+				self.syncs.popitem(last=False)
+				if not failed and first_sequence >= self.commit_sequence:
+					history_id = synced_history_id
+			if history_id is not None:
+				self.cursor.commit(history_id)
+		return retried
+
+def list_added_mail_ids(service, start_history_id):
+	'''Returns a tuple of the ids of mails added since a history id, and the current history id of the inbox.
+
+	Pages through every history record since the history id.
+
+	Args:
+		service: A Gmail service object to access the Gmail API.
+		start_history_id: History id to list the history from.
+	'''
+	mail_ids = []
+	page_token = None
+	while True:
+		history_obj = execute(service.users().history().list(userId='me', historyTypes='messageAdded', startHistoryId=start_history_id, pageToken=page_token), 'history.list')
+		for record in history_obj.get('history', []):
+			for added in record.get('messagesAdded', []):
+				mail_ids.append(added['message']['id'])
+
+		page_token = history_obj.get('nextPageToken')
+		if page_token is None:
+			return list(dict.fromkeys(mail_ids)), history_obj['historyId']
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+# This script runs sentiment analysis inference in worker processes, so that CPU-bound inference
+# does not hold the GIL of the process serving the Gmail subscription callbacks.
+
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, TimeoutError, wait
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import os
+import threading
+
+logger = logging.getLogger('mailsense.mail.inferencepool')
+
+def initialize_worker(model_type, model_args, download, barrier):
+	'''Loads the sentiment analysis model once in a worker process.
+
+	Args:
+		model_type: A ModelType (sentimentanalysis.py) value of the sentiment analysis model to use.
+		model_args: The arguments for the respective sentiment analysis model.
+		download: Whether missing nltk data of the model may be downloaded.
+		barrier: A multiprocessing Barrier shared by the workers, waited on when warming up.
+	'''
+	from sentimentanalysis import Model
+
+	global worker_model, worker_barrier
+	worker_model = Model(model_type, model_args, download=download)
+	worker_barrier = barrier
+
+def predict_in_worker(texts):
+	'''Returns the polarity of each text, predicted by the worker's model.
+
+	Args:
+		texts: List of texts to classify.
+	'''
+	return worker_model.model.predict_batch(texts)
+
+def get_worker_identity():
+	'''Returns the identity of the worker's model.
+	'''
+	return worker_model.model_identity
+
+def ping():
+	'''Returns the process id of the worker, to check that it responds.
+	'''
+	return os.getpid()
+
+def warm_up(timeout):
+	'''Returns the process id of the worker once every worker has loaded the model.
+
+	A worker runs a task only after its model is loaded, and blocks here until every worker runs one,
+	so the warm-up tasks of the pool run in distinct workers.
+
+	Args:
+		timeout: Seconds to wait for the other workers.
+	'''
+	worker_barrier.wait(timeout)
+	return os.getpid()
+
+class InferencePool(object):
+	'''Runs a sentiment analysis model in worker processes, with the interface of a backend inference module.
+
+	The model is loaded once in each worker.
+	Crashed or unresponsive workers are replaced by restarting the pool, checked on each request
+	and periodically while no request is in flight.
+	'''
+	def __init__(self, model_type, model_args, workers, download=False, timeout=60, health_interval=30, ping_timeout=5, min_chunk_size=8):
+		'''Initializes an InferencePool object and waits until the model is loaded in every worker.
+
+		Args:
+			model_type: A ModelType (sentimentanalysis.py) value of the sentiment analysis model to use.
+			model_args: The arguments for the respective sentiment analysis model.
+			workers: Number of worker processes.
+			download: Whether missing nltk data of the model may be downloaded.
+			timeout: Seconds to wait for a prediction before the workers are considered unresponsive.
+			health_interval: Seconds between health checks of the workers.
+			ping_timeout: Seconds to wait for idle workers to respond to a health check.
+			min_chunk_size: Minimum number of texts sent to a worker when a batch is split between workers.
+		'''
+		super(InferencePool, self).__init__()
+		if workers < 1:
+			raise ValueError('inference pool needs at least 1 worker')
+
+		self.model_type = model_type
+		self.model_args = model_args
+		self.workers = workers
+		self.download = download
+		self.timeout = timeout
+		self.health_interval = health_interval
+		self.ping_timeout = ping_timeout
+		self.min_chunk_size = min_chunk_size
+		self.lock = threading.Lock()
+		self.executor = None
+		self.stopped = threading.Event()
+		# number of requests waiting for the workers
+		self.in_flight = 0
+		self.in_flight_lock = threading.Lock()
+
+		self.start_executor()
+		self.identity = self.executor.submit(get_worker_identity).result(timeout)
+
+		self.health_thread = threading.Thread(target=self.run_health_checks, name='mailsense-inference-health', daemon=True)
+		self.health_thread.start()
+
+	def start_executor(self):
+		'''Starts the worker processes and waits until each has loaded the model. The caller must hold the lock, or be initializing.
+		'''
+		# spawn, since forking a process with running threads is not safe
+		context = multiprocessing.get_context('spawn')
+		barrier = context.Barrier(self.workers)
+		self.executor = ProcessPoolExecutor(self.workers, mp_context=context, initializer=initialize_worker, initargs=(self.model_type, self.model_args, self.download, barrier))
+		try:
+			pids = set(future.result() for future in [self.executor.submit(warm_up, self.timeout) for i in range(self.workers)])
+		except (BrokenProcessPool, threading.BrokenBarrierError) as e:
+			self.executor.shutdown(wait=False)
+			raise RuntimeError('failed to load the {mt} model in the inference workers'.format(mt=self.model_type)) from e
+		logger.info('started %d inference workers: %s', self.workers, str(sorted(pids)))
+
+	def restart(self, executor):
+		'''Replaces the worker processes, unless they have already been replaced since the given executor was used.
+
+		Args:
+			executor: The executor whose workers crashed or became unresponsive.
+		'''
+		with self.lock:
+			if self.executor is not executor or self.stopped.is_set():
+				return
+			logger.warning('restarting inference workers')
+			# unresponsive workers would otherwise keep running
+			for process in list(getattr(executor, '_processes', {}).values()):
+				process.terminate()
+			executor.shutdown(wait=False)
+			self.start_executor()
+
+	def submit_many(self, function, args_list):
+		'''Runs a function in the workers once per arguments and returns the results,
+		restarting the workers and retrying once if they fail.
+
+		Waiting for the workers releases the GIL, so other threads keep running.
+
+		Args:
+			function: Module-level function to run.
+			args_list: List of tuples of the arguments of each run.
+		'''
+		for attempt in range(2):
+			executor = self.executor
+			with self.in_flight_lock:
+				self.in_flight = self.in_flight + 1
+			try:
+				futures = [executor.submit(function, *args) for args in args_list]
+				done, not_done = wait(futures, self.timeout, return_when=FIRST_EXCEPTION)
+				for future in not_done:
+					future.cancel()
+				for future in done:
+					if future.exception() is not None:
+						raise future.exception()
+				if len(not_done) > 0:
+					raise TimeoutError()
+				return [future.result() for future in futures]
+			except (BrokenProcessPool, TimeoutError) as e:
+				logger.error('inference workers failed', exc_info=True)
+				if attempt == 1:
+					raise
+				self.restart(executor)
+			finally:
+				with self.in_flight_lock:
+					self.in_flight = self.in_flight - 1
+
+	def submit(self, function, *args):
+		'''Runs a function in a worker and returns its result, restarting the workers and retrying once if they fail.
+
+		Args:
+			function: Module-level function to run.
+			args: Arguments of the function.
+		'''
+		return self.submit_many(function, [args])[0]
+
+	def get_identity(self):
+		'''Returns a string identifying the model loaded by the workers.
+		'''
+		return self.identity
+
+	def predict_batch(self, texts):
+		'''Returns the polarity of each text, splitting the texts between the workers.
+
+		Args:
+			texts: List of texts to classify.
+		'''
+		if len(texts) == 0:
+			return []
+		chunk_size = max(self.min_chunk_size, -(-len(texts) // self.workers))
+		chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+		polarities = self.submit_many(predict_in_worker, [(chunk,) for chunk in chunks])
+		return [polarity for chunk_polarities in polarities for polarity in chunk_polarities]
+
+	def run_health_checks(self):
+		'''Periodically checks that idle workers respond, restarting them otherwise.
+
+		Workers with requests in flight are not checked, since the requests wait for them with the prediction timeout.
+		'''
+		while not self.stopped.wait(self.health_interval):
+			with self.in_flight_lock:
+				if self.in_flight > 0:
+					continue
+			executor = self.executor
+			try:
+				executor.submit(ping).result(self.ping_timeout)
+			except (BrokenProcessPool, TimeoutError) as e:
+				with self.in_flight_lock:
+					# the ping may have been queued behind a request submitted meanwhile
+					if self.in_flight > 0 and not isinstance(e, BrokenProcessPool):
+						continue
+				logger.error('inference workers failed health check', exc_info=True)
+				try:
+					self.restart(executor)
+				except Exception as e:
+					logger.error('failed to restart inference workers', exc_info=True)
+			except Exception as e:
+				# eg. the executor was shut down by a restart or by close meanwhile, the next check uses the current one
+				logger.error('failed to check the health of inference workers', exc_info=True)
+
+	def close(self):
+		'''Stops the health checks and the worker processes.
+		'''
+		self.stopped.set()
+		with self.lock:
+			self.executor.shutdown(wait=True)
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+
+# This script records where the time of processing mails goes: the latency of each processing stage and Gmail API call,
+# the number of API calls, the depth of the queues and the hit rate of the caches.
+# Latencies are recorded in HDR-style histograms, so recording is a counter increment and percentiles stay accurate.
+# The metrics are served over HTTP in the Prometheus text format, and can be rolled up into the mailsense.db SQLite file.
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('mailsense.mail.instrumentation')
+
+# histogram buckets: values (in microseconds) below SUB_BUCKETS have a bucket each, every further power of two is split into
+# SUB_BUCKETS / 2 buckets, so a recorded value is within 1 / (SUB_BUCKETS / 2) of the value it is counted as
+SUB_BUCKET_BITS = 8
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS >> 1
+# values above 2 ** (SUB_BUCKET_BITS + MAX_SHIFT) microseconds (about 3 days) are counted in the last bucket
+MAX_SHIFT = 30
+BUCKETS = SUB_BUCKETS + MAX_SHIFT * HALF_SUB_BUCKETS
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+STAGE_SECONDS = 'mailsense_stage_seconds'
+API_CALL_SECONDS = 'mailsense_api_call_seconds'
+API_CALLS = 'mailsense_api_calls_total'
+API_ERRORS = 'mailsense_api_errors_total'
+QUEUE_DEPTH = 'mailsense_queue_depth'
+CACHE_LOOKUPS = 'mailsense_cache_lookups_total'
+CACHE_HIT_RATIO = 'mailsense_cache_hit_ratio'
+
+# metric information store: name as key, tuple (Prometheus type, help) as value
+METRICS = {
+	STAGE_SECONDS: ('summary', 'Seconds taken by each stage of processing mails.'),
+	API_CALL_SECONDS: ('summary', 'Seconds taken by each Gmail API call, by endpoint.'),
+	API_CALLS: ('counter', 'Number of Gmail API calls, by endpoint.'),
+	API_ERRORS: ('counter', 'Number of failed Gmail API calls, by endpoint.'),
+	QUEUE_DEPTH: ('gauge', 'Number of items waiting in each queue.'),
+	CACHE_LOOKUPS: ('counter', 'Number of cache lookups, by cache and result.'),
+	CACHE_HIT_RATIO: ('gauge', 'Fraction of the cache lookups which were hits, by cache.')
+}
+
+# rollup table information store: name as key, list of tuples (field name, field type) as value
+ROLLUP_TABLES = {
+	'instrumentation_latencies': [('timestamp', 'integer'), ('metric', 'text'), ('labels', 'text'), ('count', 'integer'), ('sum', 'real'), ('p50', 'real'), ('p95', 'real'), ('p99', 'real'), ('max', 'real')],
+	'instrumentation_counters': [('timestamp', 'integer'), ('metric', 'text'), ('labels', 'text'), ('count', 'real')]
+}
+
+def get_bucket_index(value):
+	'''Returns the index of the histogram bucket counting a value.
+
+	Args:
+		value: A non-negative integer, eg. a number of microseconds.
+	'''
+	if value < SUB_BUCKETS:
+		return value
+	shift = min(value.bit_length() - SUB_BUCKET_BITS, MAX_SHIFT)
+	# the top SUB_BUCKET_BITS bits of the value, whose first bit is always set
+	mantissa = min(value >> shift, SUB_BUCKETS - 1)
+	return SUB_BUCKETS + (shift - 1) * HALF_SUB_BUCKETS + mantissa - HALF_SUB_BUCKETS
+
+def get_bucket_value(index):
+	'''Returns the highest value counted by a histogram bucket.
+
+	Args:
+		index: Index of the bucket.
+	'''
+	if index < SUB_BUCKETS:
+		return index
+	shift = (index - SUB_BUCKETS) // HALF_SUB_BUCKETS + 1
+	mantissa = (index - SUB_BUCKETS) % HALF_SUB_BUCKETS + HALF_SUB_BUCKETS
+	return ((mantissa + 1) << shift) - 1
+
+class Histogram(object):
+	'''An HDR-style histogram of durations, with a bounded relative error and a fixed number of buckets. Thread safe.
+	'''
+	def __init__(self, counts=None, total=0.0):
+		'''Initializes a Histogram object.
+
+		Args:
+			counts: The number of durations counted by each bucket, or None for an empty histogram.
+			total: The sum of the recorded durations in seconds.
+		'''
+		super(Histogram, self).__init__()
+		self.counts = [0] * BUCKETS if counts is None else counts
+		self.count = sum(self.counts)
+		self.sum = total
+		self.lock = threading.Lock()
+
+	def record(self, seconds):
+		'''Records a duration.
+
+		Args:
+			seconds: The duration in seconds.
+		'''
+		index = get_bucket_index(max(int(seconds * 1000000), 0))
+		with self.lock:
+			self.counts[index] += 1
+			self.count += 1
+			self.sum += seconds
+
+	def snapshot(self):
+		'''Returns a copy of the histogram.
+		'''
+		with self.lock:
+			return Histogram(list(self.counts), self.sum)
+
+	def subtract(self, earlier):
+		'''Returns a histogram of the durations recorded since an earlier snapshot of this histogram.
+
+		Args:
+			earlier: A snapshot of this histogram.
+		'''
+		return Histogram([count - earlier_count for count, earlier_count in zip(self.counts, earlier.counts)], self.sum - earlier.sum)
+
+	def percentile(self, p):
+		'''Returns the duration in seconds below which p percent of the durations are, or None if there are none.
+
+		Args:
+			p: Percentile, between 0 and 100.
+		'''
+		if self.count == 0:
+			return None
+		rank = max(1, math.ceil(p / 100 * self.count))
+		seen = 0
+		for index, count in enumerate(self.counts):
+			seen += count
+			if seen >= rank:
+				return get_bucket_value(index) / 1000000
+
+	def max(self):
+		'''Returns the highest recorded duration in seconds, or None if there are none.
+		'''
+		return self.percentile(100)
+
+def get_labels_key(labels):
+	'''Returns a hashable key of a dictionary of metric labels.
+
+	Args:
+		labels: A dictionary of label values, label name as key.
+	'''
+	return tuple(sorted(labels.items()))
+
+def format_labels(labels_key, extra=()):
+	'''Returns metric labels in the Prometheus text format, eg. {stage="fetch"}, or an empty string if there are none.
+
+	Args:
+		labels_key: A key returned by get_labels_key.
+		extra: Further tuples (label name, label value).
+	'''
+	labels = list(labels_key) + list(extra)
+	if len(labels) == 0:
+		return ''
+	return '{' + ','.join('{n}="{v}"'.format(n=name, v=str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels) + '}'
+
+def format_value(value):
+	'''Returns a metric value in the Prometheus text format.
+
+	Args:
+		value: A number, or None if there is no value.
+	'''
+	if value is None:
+		return 'NaN'
+	return repr(float(value))
+
+class Registry(object):
+	'''The latency histograms, counters and gauges of the process. Thread safe.
+
+	Gauges are functions evaluated when the metrics are read, so that they cost nothing while processing mails.
+	'''
+	def __init__(self):
+		'''Initializes an empty Registry object.
+		'''
+		super(Registry, self).__init__()
+		# metric name as key, dictionary of labels key to Histogram or count as value
+		self.histograms = {}
+		self.counters = {}
+		# metric name as key, list of functions returning the labels and values of the gauge as value
+		self.gauges = {}
+		self.lock = threading.Lock()
+
+	def observe(self, name, seconds, **labels):
+		'''Records a duration in the histogram of a metric.
+
+		Args:
+			name: Name of the metric, eg. STAGE_SECONDS.
+			seconds: The duration in seconds.
+			labels: Labels of the histogram, eg. stage='fetch'.
+		'''
+		key = get_labels_key(labels)
+		histogram = self.histograms.get(name, {}).get(key)
+		if histogram is None:
+			with self.lock:
+				histogram = self.histograms.setdefault(name, {}).setdefault(key, Histogram())
+		histogram.record(seconds)
+
+	@contextmanager
+	def time(self, name, **labels):
+		'''Context manager which records the duration of its block in the histogram of a metric, even if the block raises.
+
+		Args:
+			name: Name of the metric, eg. STAGE_SECONDS.
+			labels: Labels of the histogram, eg. stage='fetch'.
+		'''
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start, **labels)
+
+	def increment(self, name, amount=1, **labels):
+		'''Adds to a counter.
+
+		Args:
+			name: Name of the metric, eg. API_CALLS.
+			amount: Number added to the counter.
+			labels: Labels of the counter, eg. endpoint='messages.get'.
+		'''
+		key = get_labels_key(labels)
+		with self.lock:
+			counters = self.counters.setdefault(name, {})
+			counters[key] = counters.get(key, 0) + amount
+
+	def register_gauge(self, name, function):
+		'''Registers a function returning the values of a gauge when the metrics are read.
+
+		Args:
+			name: Name of the metric, eg. QUEUE_DEPTH.
+			function: Function returning a list of tuples of the labels dictionaries and values of the gauge: [(labels, value), ...]
+		'''
+		with self.lock:
+			self.gauges.setdefault(name, []).append(function)
+
+	def snapshot(self):
+		'''Returns a tuple of copies of the histograms and the counters, metric name as key and dictionary of labels key to value as value.
+		'''
+		with self.lock:
+			histograms = {name: dict(histograms) for name, histograms in self.histograms.items()}
+			counters = {name: dict(counters) for name, counters in self.counters.items()}
+		return {name: {key: histogram.snapshot() for key, histogram in histograms.items()} for name, histograms in histograms.items()}, counters
+
+	def read_gauges(self):
+		'''Returns the current values of the gauges, metric name as key and dictionary of labels key to value as value.
+		'''
+		with self.lock:
+			gauges = {name: list(functions) for name, functions in self.gauges.items()}
+		values = {}
+		for name, functions in gauges.items():
+			for function in functions:
+				try:
+					for labels, value in function():
+						values.setdefault(name, {})[get_labels_key(labels)] = value
+				except Exception as e:
+					logger.error('failed to read gauge %s', name, exc_info=True)
+		return values
+
+	def render(self):
+		'''Returns every metric in the Prometheus text exposition format.
+		'''
+		histograms, counters = self.snapshot()
+		gauges = self.read_gauges()
+		lines = []
+		for name in sorted(set(histograms) | set(counters) | set(gauges)):
+			metric_type, help_text = METRICS.get(name, ('untyped', name))
+			lines.append('# HELP {n} {h}'.format(n=name, h=help_text))
+			lines.append('# TYPE {n} {t}'.format(n=name, t=metric_type))
+			for key, histogram in sorted(histograms.get(name, {}).items()):
+				for quantile in QUANTILES:
+					lines.append('{n}{l} {v}'.format(n=name, l=format_labels(key, [('quantile', quantile)]), v=format_value(histogram.percentile(quantile * 100))))
+				lines.append('{n}_sum{l} {v}'.format(n=name, l=format_labels(key), v=format_value(histogram.sum)))
+				lines.append('{n}_count{l} {v}'.format(n=name, l=format_labels(key), v=histogram.count))
+			for key, value in sorted(list(counters.get(name, {}).items()) + list(gauges.get(name, {}).items())):
+				lines.append('{n}{l} {v}'.format(n=name, l=format_labels(key), v=format_value(value)))
+		return '\n'.join(lines) + '\n'
+
+	def summary(self):
+		'''Returns a dictionary of the p50/p95/p99 latencies in milliseconds and the counters, eg. for benchmark reports.
+		'''
+		histograms, counters = self.snapshot()
+		return {
+			'latency_ms': {name: {format_labels(key): {'count': histogram.count, 'p50': histogram.percentile(50) * 1000, 'p95': histogram.percentile(95) * 1000, 'p99': histogram.percentile(99) * 1000} for key, histogram in histograms[name].items() if histogram.count > 0} for name in histograms},
+			'counters': {name: {format_labels(key): value for key, value in counters[name].items()} for name in counters}
+		}
+
+# the registry of the process, shared by every module
+registry = Registry()
+
+def time_stage(stage):
+	'''Context manager which records the duration of its block as the latency of a processing stage.
+
+	Args:
+		stage: Name of the stage, eg. 'fetch'.
+	'''
+	return registry.time(STAGE_SECONDS, stage=stage)
+
+def timed(stage, function):
+	'''Returns a function calling a function and recording its duration as the latency of a processing stage.
+
+	Args:
+		stage: Name of the stage, eg. 'total'.
+		function: The function to call.
+	'''
+	def call(*args, **kwargs):
+		with time_stage(stage):
+			return function(*args, **kwargs)
+	return call
+
+def execute(request, endpoint):
+	'''Executes a request of the Gmail API client and returns its response, recording its latency and outcome.
+
+	Args:
+		request: A request of a Gmail service object.
+		endpoint: Name of the endpoint, eg. 'messages.get'.
+	'''
+	registry.increment(API_CALLS, endpoint=endpoint)
+	try:
+		with registry.time(API_CALL_SECONDS, endpoint=endpoint):
+			return request.execute()
+	except Exception:
+		registry.increment(API_ERRORS, endpoint=endpoint)
+		raise
+
+def register_queue(queue_name, function):
+	'''Registers a function returning the number of items waiting in a queue.
+
+	Args:
+		queue_name: Name of the queue, eg. 'labels'.
+		function: Function returning the number of items.
+	'''
+	registry.register_gauge(QUEUE_DEPTH, lambda: [({'queue': queue_name}, function())])
+
+def register_cache(cache_name, function):
+	'''Registers a function returning the hit and miss counts of a cache.
+
+	Args:
+		cache_name: Name of the cache, eg. 'predictions'.
+		function: Function returning a dictionary with the 'hits' and 'misses' of the cache.
+	'''
+	def read_lookups():
+		stats = function()
+		return [({'cache': cache_name, 'result': 'hit'}, stats['hits']), ({'cache': cache_name, 'result': 'miss'}, stats['misses'])]
+	def read_hit_ratio():
+		stats = function()
+		lookups = stats['hits'] + stats['misses']
+		return [({'cache': cache_name}, stats['hits'] / lookups if lookups > 0 else None)]
+	registry.register_gauge(CACHE_LOOKUPS, read_lookups)
+	registry.register_gauge(CACHE_HIT_RATIO, read_hit_ratio)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	'''Serves the metrics of the registry at /metrics.
+	'''
+	def do_GET(self):
+		'''Responds with the metrics in the Prometheus text format.
+		'''
+		if self.path.split('?')[0] != '/metrics':
+			self.send_error(404)
+			return
+		body = registry.render().encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		'''Does not log requests, scrapes are not worth a log line each.
+		'''
+
+class MetricsServer(object):
+	'''Serves the metrics of the registry in the Prometheus text format from a background thread.
+	'''
+	def __init__(self, host='127.0.0.1', port=9100):
+		'''Initializes a MetricsServer object and starts serving.
+
+		Args:
+			host: Host to listen on, local only by default.
+			port: Port to listen on.
+		'''
+		super(MetricsServer, self).__init__()
+		self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+		self.server.daemon_threads = True
+		self.thread = threading.Thread(target=self.server.serve_forever, name='mailsense-metrics-server', daemon=True)
+		self.thread.start()
+		logger.info('serving metrics at http://%s:%d/metrics', host, self.server.server_address[1])
+
+	def close(self):
+		'''Stops serving.
+		'''
+		self.server.shutdown()
+		self.server.server_close()
+
+class Rollup(object):
+	'''Periodically writes the latencies and counters recorded since the previous rollup to SQLite tables, eg. of mailsense.db.
+	'''
+	def __init__(self, db_name='mailsense.db', interval=60):
+		'''Initializes a Rollup object, creating its tables if needed, and starts its thread.
+
+		Args:
+			db_name: Path of the SQLite database file.
+			interval: Seconds between rollups.
+		'''
+		super(Rollup, self).__init__()
+		self.db_name = db_name
+		self.interval = interval
+		self.stopped = threading.Event()
+		self.previous = ({}, {})
+
+		conn = sqlite3.connect(db_name)
+		for table_name, fields in ROLLUP_TABLES.items():
+			conn.execute('create table if not exists {tn} ({f})'.format(tn=table_name, f=', '.join('{fn} {ft}'.format(fn=field_name, ft=field_type) for field_name, field_type in fields)))
+			conn.execute('create index if not exists {tn}_timestamp on {tn} (timestamp)'.format(tn=table_name))
+		conn.commit()
+		conn.close()
+
+		self.thread = threading.Thread(target=self.run, name='mailsense-metrics-rollup', daemon=True)
+		self.thread.start()
+
+	def write(self, conn):
+		'''Writes a row per histogram and counter which changed since the previous rollup.
+
+		Args:
+			conn: A connection to the SQLite database.
+		'''
+		histograms, counters = registry.snapshot()
+		previous_histograms, previous_counters = self.previous
+		timestamp = int(time.time())
+		latency_rows = []
+		for name, name_histograms in histograms.items():
+			for key, histogram in name_histograms.items():
+				earlier = previous_histograms.get(name, {}).get(key)
+				interval_histogram = histogram if earlier is None else histogram.subtract(earlier)
+				if interval_histogram.count > 0:
+					latency_rows.append((timestamp, name, json.dumps(dict(key), sort_keys=True), interval_histogram.count, interval_histogram.sum,
+						interval_histogram.percentile(50), interval_histogram.percentile(95), interval_histogram.percentile(99), interval_histogram.max()))
+		counter_rows = []
+		for name, name_counters in counters.items():
+			for key, value in name_counters.items():
+				delta = value - previous_counters.get(name, {}).get(key, 0)
+				if delta > 0:
+					counter_rows.append((timestamp, name, json.dumps(dict(key), sort_keys=True), delta))
+
+		conn.executemany('insert into instrumentation_latencies values (?, ?, ?, ?, ?, ?, ?, ?, ?)', latency_rows)
+		conn.executemany('insert into instrumentation_counters values (?, ?, ?, ?)', counter_rows)
+		conn.commit()
+		self.previous = (histograms, counters)
+
+	def run(self):
+		'''Rolls the metrics up every interval until stopped, and once more when stopped.
+		'''
+		# the connection is owned by this thread
+		conn = sqlite3.connect(self.db_name)
+		try:
+			while True:
+				stopped = self.stopped.wait(self.interval)
+				try:
+					self.write(conn)
+				except Exception as e:
+					logger.error('failed to roll up metrics', exc_info=True)
+				if stopped:
+					return
+		finally:
+			conn.close()
+
+	def close(self):
+		'''Writes the last rollup and stops the thread.
+		'''
+		self.stopped.set()
+		self.thread.join()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+# This script keeps track of the Gmail labels assigned by mailsense.
+
+from apiclient import errors
+
+from concurrent.futures import Future
+import logging
+import threading
+import time
+
+from instrumentation import execute
+
+logger = logging.getLogger('mailsense.mail.labels')
+
+def create_label(service, label_name):
+	'''Creates a Gmail label and returns its unique identifier.
+
+	Args:
+		service: A Gmail service object to access the Gmail API.
+		label_name: Name of the label to create.
+	'''
+	created_label = execute(service.users().labels().create(userId='me', body={'name': label_name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'}), 'labels.create')
+	return created_label['id']
+
+def is_missing_label_error(e, label_id):
+	'''Returns whether a Gmail API error was caused by a label that does not exist (anymore).
+
+	Only errors naming the label are, since a 404 of a batchModify call may as well be caused by a mail.
+
+	Args:
+		e: An HttpError raised by the Gmail API.
+		label_id: Unique identifier of the label of the failed request.
+	'''
+	return e.resp.status in (400, 404) and label_id.encode('utf-8') in e.content
+
+def get_missing_mail_ids(e, mail_ids):
+	'''Returns the ids of the mails named by a Gmail API error caused by mails that do not exist (anymore).
+
+	Args:
+		e: An HttpError raised by the Gmail API.
+		mail_ids: Unique identifiers of the mails of the failed request.
+	'''
+	if e.resp.status not in (400, 404):
+		return []
+	return [mail_id for mail_id in mail_ids if mail_id.encode('utf-8') in e.content]
+
+class LabelCache(object):
+	'''A process-wide, thread-safe cache of Gmail label ids by label name.
+
+	Labels are looked up with a single list call and created if they do not exist.
+	Entries are invalidated when Gmail reports a label as missing.
+	'''
+	def __init__(self):
+		'''Initializes an empty LabelCache object.
+		'''
+		super(LabelCache, self).__init__()
+		self.label_ids = {}
+		self.lock = threading.Lock()
+
+	def warm(self, service, label_names):
+		'''Fills the cache with the ids of the given labels, creating the labels which do not exist.
+
+		Args:
+			service: A Gmail service object to access the Gmail API.
+			label_names: Names of the labels to cache.
+		'''
+		with self.lock:
+			self.fill(service, label_names)
+
+	def fill(self, service, label_names):
+		'''Looks up the ids of the given labels with a single list call and caches them.
+		The caller must hold the lock.
+
+		Args:
+			service: A Gmail service object to access the Gmail API.
+			label_names: Names of the labels to cache.
+		'''
+		# all present labels
+		labels = execute(service.users().labels().list(userId='me'), 'labels.list').get('labels', [])
+		present = {label['name']: label['id'] for label in labels}
+		for label_name in label_names:
+			if label_name not in present:
+				present[label_name] = create_label(service, label_name)
+			self.label_ids[label_name] = present[label_name]
+
+	def get(self, service, label_name):
+		'''Returns the unique identifier of a Gmail label, looking it up if it is not cached.
+
+		Args:
+			service: A Gmail service object to access the Gmail API.
+			label_name: Name of the label whose id is to be retrieved.
+		'''
+		label_id = self.label_ids.get(label_name)
+		if label_id is not None:
+			return label_id
+
+		with self.lock:
+			# another thread may have filled the entry while waiting for the lock
+			if label_name not in self.label_ids:
+				self.fill(service, [label_name])
+			return self.label_ids[label_name]
+
+	def peek(self, label_name):
+		'''Returns the cached id of a label without looking it up, or None if it is not cached.
+
+		Args:
+			label_name: Name of the label whose id is to be retrieved.
+		'''
+		return self.label_ids.get(label_name)
+
+	def put(self, label_name, label_id):
+		'''Caches the id of a label which has been looked up elsewhere.
+
+		Args:
+			label_name: Name of the label.
+			label_id: Unique identifier of the label.
+		'''
+		with self.lock:
+			self.label_ids[label_name] = label_id
+
+	def invalidate(self, label_name=None):
+		'''Removes a label from the cache, or every label if no name is given.
+
+		Args:
+			label_name: Name of the label to remove.
+		'''
+		with self.lock:
+			if label_name is None:
+				self.label_ids.clear()
+			else:
+				self.label_ids.pop(label_name, None)
+
+class LabelBatcher(object):
+	'''Buffers label assignments and applies them with Gmail's batchModify.
+
+	Assignments are collected for a short window, or until the buffer reaches its maximum size.
+	They are then grouped by label, so each flush costs one batchModify call per label (per MAX_BATCH_MODIFY_IDS mails).
+	'''
+	# maximum number of mail ids accepted by a single batchModify call
+	MAX_BATCH_MODIFY_IDS = 1000
+
+	def __init__(self, service_pool, label_cache, window=0.5, max_size=1000):
+		'''Initializes a LabelBatcher object and starts its flushing thread.
+
+		Args:
+			service_pool: A ServicePool (servicepool.py) of Gmail service objects.
+			label_cache: A LabelCache used to resolve label names to ids.
+			window: Seconds to wait after the first buffered assignment before flushing.
+			max_size: Number of buffered assignments which triggers an immediate flush.
+		'''
+		super(LabelBatcher, self).__init__()
+		self.service_pool = service_pool
+		self.label_cache = label_cache
+		self.window = window
+		self.max_size = max_size
+		# label name as key, list of tuples (mail id, future) as value
+		self.pending = {}
+		self.pending_count = 0
+		self.deadline = None
+		self.closed = False
+		self.condition = threading.Condition()
+
+		self.flush_thread = threading.Thread(target=self.run, name='mailsense-labels', daemon=True)
+		self.flush_thread.start()
+
+	def add(self, mail_id, label_name, mail_label_ids=()):
+		'''Buffers the assignment of a label to a Gmail mail.
+
+		Returns a future which resolves to True once the label has been assigned,
+		to False if the mail already has the label, or to None if the mail no longer exists.
+
+		Args:
+			mail_id: Unique identifier for a Gmail mail to be assigned a label to.
+			label_name: Name of the label to assign.
+			mail_label_ids: Ids of the labels the mail already has, as fetched with the mail.
+		'''
+		future = Future()
+		label_id = self.label_cache.peek(label_name)
+		if label_id is not None and label_id in mail_label_ids:
+			future.set_result(False)
+			return future
+
+		with self.condition:
+			if self.closed:
+				raise RuntimeError('label batcher is closed')
+			self.pending.setdefault(label_name, []).append((mail_id, future))
+			self.pending_count = self.pending_count + 1
+			if self.deadline is None:
+				self.deadline = time.monotonic() + self.window
+				# the flushing thread waits without a timeout while the buffer is empty
+				self.condition.notify()
+			elif self.pending_count >= self.max_size:
+				self.condition.notify()
+
+		return future
+
+	def take_pending(self):
+		'''Waits until the buffer is due to be flushed and returns its contents.
+		Returns None once the batcher is closed and the buffer is empty.
+		'''
+		with self.condition:
+			while True:
+				if self.pending_count >= self.max_size or (self.pending_count > 0 and self.closed):
+					break
+				if self.closed:
+					return None
+
+				if self.deadline is None:
+					self.condition.wait()
+				else:
+					remaining = self.deadline - time.monotonic()
+					if remaining <= 0:
+						break
+					self.condition.wait(remaining)
+
+			pending = self.pending
+			self.pending = {}
+			self.pending_count = 0
+			self.deadline = None
+			return pending
+
+	def run(self):
+		'''Flushes buffered assignments until the batcher is closed.
+		'''
+		while True:
+			pending = self.take_pending()
+			if pending is None:
+				return
+			try:
+				with self.service_pool.borrow() as service:
+					for label_name, assignments in pending.items():
+						self.flush_label(service, label_name, assignments)
+			except Exception as e:
+				logger.error('failed to flush label assignments', exc_info=True)
+				for assignments in pending.values():
+					for mail_id, future in assignments:
+						if not future.done():
+							future.set_exception(e)
+
+	def flush_label(self, service, label_name, assignments):
+		'''Assigns a label to buffered mails with as few batchModify calls as possible.
+
+		Args:
+			service: A Gmail service object to access the Gmail API.
+			label_name: Name of the label to assign.
+			assignments: A list of tuples: [(mail id, future), ...]
+		'''
+		for i in range(0, len(assignments), self.MAX_BATCH_MODIFY_IDS):
+			chunk = assignments[i:i + self.MAX_BATCH_MODIFY_IDS]
+			# a mail may have been classified more than once within the window
+			mail_ids = list(dict.fromkeys(mail_id for mail_id, future in chunk))
+			try:
+				missing_ids = self.modify_mails(service, label_name, mail_ids)
+			except Exception as e:
+				for mail_id, future in chunk:
+					future.set_exception(e)
+				continue
+
+			for mail_id, future in chunk:
+				future.set_result(None if mail_id in missing_ids else True)
+
+	def modify_mails(self, service, label_name, mail_ids):
+		'''Assigns a label to up to MAX_BATCH_MODIFY_IDS mails with a batchModify call.
+		Returns the set of ids of the mails which no longer exist.
+
+		If the call fails because the label or some of the mails no longer exist, it is retried once,
+		with the label looked up again or without those mails. If the call is still rejected, the mails are split (split_mails).
+
+		Args:
+			service: A Gmail service object to access the Gmail API.
+			label_name: Name of the label to assign.
+			mail_ids: Unique identifiers of the mails to be assigned the label.
+		'''
+		missing_ids = set()
+		label_id = self.label_cache.get(service, label_name)
+		try:
+			batch_modify(service, mail_ids, label_id)
+			return missing_ids
+		except errors.HttpError as e:
+			if e.resp.status not in (400, 404):
+				raise
+			if is_missing_label_error(e, label_id):
+				logger.warning('label %s not found, looking it up again', label_name)
+				self.label_cache.invalidate(label_name)
+				label_id = self.label_cache.get(service, label_name)
+			else:
+				missing_ids.update(get_missing_mail_ids(e, mail_ids))
+				if len(missing_ids) == 0:
+					# retrying the same mails would be rejected again
+					return self.split_mails(service, label_name, mail_ids, e)
+				logger.warning('mails %s no longer exist, assigning label %s to the other mails', str(sorted(missing_ids)), label_name)
+
+		remaining_ids = [mail_id for mail_id in mail_ids if mail_id not in missing_ids]
+		if len(remaining_ids) == 0:
+			return missing_ids
+		try:
+			batch_modify(service, remaining_ids, label_id)
+		except errors.HttpError as e:
+			if e.resp.status not in (400, 404):
+				raise
+			missing_ids.update(self.split_mails(service, label_name, remaining_ids, e))
+		return missing_ids
+
+	def split_mails(self, service, label_name, mail_ids, e):
+		'''Assigns a label to each half of mails whose batchModify call was rejected, down to single mails,
+		so that mails which cannot be labeled do not fail the others. Returns the set of ids of the mails which no longer exist.
+
+		A single mail rejected with a 404 no longer exists.
+
+		Args:
+			service: A Gmail service object to access the Gmail API.
+			label_name: Name of the label to assign.
+			mail_ids: Unique identifiers of the mails to be assigned the label.
+			e: The HttpError rejecting the call for all of the mails.
+		'''
+		if len(mail_ids) == 1:
+			if e.resp.status != 404:
+				raise e
+			logger.warning('mail %s no longer exists, not assigning label %s', mail_ids[0], label_name)
+			return set(mail_ids)
+
+		logger.warning('failed to assign label %s to %d mails, assigning it to each half of them', label_name, len(mail_ids))
+		half = len(mail_ids) // 2
+		return self.modify_mails(service, label_name, mail_ids[:half]) | self.modify_mails(service, label_name, mail_ids[half:])
+
+	def close(self):
+		'''Flushes the remaining assignments and stops the flushing thread.
+		'''
+		with self.condition:
+			self.closed = True
+			self.condition.notify()
+		self.flush_thread.join()
+
+def batch_modify(service, mail_ids, label_id):
+	'''Assigns a label to up to 1000 Gmail mails with a single request.
+
+	Args:
+		service: A Gmail service object to access the Gmail API.
+		mail_ids: Unique identifiers of the mails to be assigned the label.
+		label_id: Unique identifier of the label to assign.
+	'''
+	body = {'ids': mail_ids, 'removeLabelIds': [], 'addLabelIds': [label_id]}
+	execute(service.users().messages().batchModify(userId='me', body=body), 'messages.batchModify')
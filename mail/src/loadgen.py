@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+# This script generates synthetic inbox traffic: mails are delivered to a FakeMailbox (fakegmail.py) at a target rate,
+# and a Gmail push notification is published for each of them.
+# Notifications are published to a Pub/Sub topic (the Pub/Sub emulator if PUBSUB_EMULATOR_HOST is set),
+# or to an in-process stand-in for the subscriber client which calls a subscriber callback directly.
+
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger('mailsense.mail.loadgen')
+
+# synthetic subjects and snippets, polarity as key
+SUBJECTS = {
+	'positive': ['Great news about your order', 'Thank you for your help', 'Congratulations on the new role', 'Loved the presentation today'],
+	'negative': ['Your payment has failed', 'Unfortunately we cannot proceed', 'Complaint about a late delivery', 'Urgent: account suspended'],
+	'neutral': ['Meeting notes for Tuesday', 'Your weekly summary', 'Invoice 2041 attached', 'Reminder: project sync at 3pm']
+}
+SNIPPETS = {
+	'positive': ['It was wonderful working with you, everyone was delighted with the results.', 'We are happy to let you know that your request was approved.', 'Thanks a lot, this is excellent and exactly what we needed.'],
+	'negative': ['We are sorry, but the item arrived broken and the refund was rejected.', 'This is the third time the service has failed, which is terrible.', 'I am disappointed and frustrated with the lack of response.'],
+	'neutral': ['Please find the agenda for the next meeting below.', 'The report covers the period from the first to the last day of the month.', 'The document has been shared with the team for review.']
+}
+
+def generate_mails(count, seed=0):
+	'''Yields tuples (subject, snippet) of synthetic mails of random polarities.
+
+	Args:
+		count: Number of mails.
+		seed: Seed of the random choices, so that runs are repeatable.
+	'''
+	choices = random.Random(seed)
+	polarities = sorted(SUBJECTS)
+	for i in range(count):
+		polarity = choices.choice(polarities)
+		yield choices.choice(SUBJECTS[polarity]), choices.choice(SNIPPETS[polarity])
+
+def get_notification_data(email_address, history_id):
+	'''Returns the data of a Gmail push notification.
+
+	Args:
+		email_address: Email address of the inbox.
+		history_id: History id of the inbox change.
+	'''
+	return json.dumps({'emailAddress': email_address, 'historyId': history_id}).encode('utf-8')
+
+class LocalMessage(object):
+	'''A stand-in for a message received by the Pub/Sub subscriber client.
+	'''
+	def __init__(self, subscriber, message_id, data):
+		'''Initializes a LocalMessage object.
+
+		Args:
+			subscriber: The LocalSubscriber delivering the message.
+			message_id: Unique identifier of the message.
+			data: Data of the message, as bytes.
+		'''
+		super(LocalMessage, self).__init__()
+		self.subscriber = subscriber
+		self.message_id = message_id
+		self.data = data
+		self.publish_time = time.time()
+		self.settled = False
+
+	def ack(self):
+		'''Acknowledges the message.
+		'''
+		self.subscriber.settle(self, True)
+
+	def nack(self):
+		'''Declines the message, so that it is delivered again.
+		'''
+		self.subscriber.settle(self, False)
+
+class LocalSubscriber(object):
+	'''An in-process stand-in for a streaming pull of the Pub/Sub subscriber client, delivering published messages to a callback.
+
+	Like the subscriber client with FlowControl and a ThreadScheduler, at most max_messages messages are outstanding
+	and callbacks run in a fixed number of threads. Publishing waits while max_messages messages are outstanding.
+	Declined messages are delivered again after a delay.
+	'''
+	def __init__(self, callback, max_messages=100, threads=10, redelivery_delay=0.1):
+		'''Initializes a LocalSubscriber object.
+
+		Args:
+			callback: Function called with each delivered LocalMessage, eg. subscriber.callback.
+			max_messages: Maximum number of messages delivered but not acknowledged yet.
+			threads: Number of threads running the callback.
+			redelivery_delay: Seconds after which a declined message is delivered again.
+		'''
+		super(LocalSubscriber, self).__init__()
+		self.callback = callback
+		self.redelivery_delay = redelivery_delay
+		self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='mailsense-localsub')
+		self.outstanding = threading.BoundedSemaphore(max_messages)
+		self.message_ids = itertools.count(1)
+		self.lock = threading.Lock()
+		self.acked = 0
+		self.nacked = 0
+		self.closed = False
+		# redelivered LocalMessage as key, threading.Timer of its pending redelivery as value
+		self.timers = {}
+
+	def publish(self, data):
+		'''Delivers a message to the callback, waiting while too many messages are outstanding.
+
+		Args:
+			data: Data of the message, as bytes.
+		'''
+		self.outstanding.acquire()
+		message = LocalMessage(self, str(next(self.message_ids)), data)
+		self.executor.submit(self.deliver, message)
+
+	def deliver(self, message):
+		'''Calls the callback with a message, declining the message if the callback raises.
+
+		Args:
+			message: A LocalMessage.
+		'''
+		try:
+			self.callback(message)
+		except Exception as e:
+			logger.error('callback failed for message %s', message.message_id, exc_info=True)
+			message.nack()
+
+	def settle(self, message, acked):
+		'''Records the acknowledgement of a message, or delivers it again if it was declined.
+
+		Args:
+			message: A LocalMessage.
+			acked: Whether the message was acknowledged.
+		'''
+		with self.lock:
+			# like the subscriber client, only the first response to a delivery counts
+			if message.settled:
+				return
+			message.settled = True
+			if acked:
+				self.acked = self.acked + 1
+			else:
+				self.nacked = self.nacked + 1
+			closed = self.closed
+
+		if acked:
+			self.outstanding.release()
+		elif not closed:
+			redelivered = LocalMessage(self, message.message_id, message.data)
+			timer = threading.Timer(self.redelivery_delay, self.redeliver, (redelivered,))
+			with self.lock:
+				if self.closed:
+					return
+				self.timers[redelivered] = timer
+			timer.start()
+
+	def redeliver(self, message):
+		'''Delivers a declined message again, unless the subscriber has been closed meanwhile.
+
+		Args:
+			message: A LocalMessage.
+		'''
+		with self.lock:
+			self.timers.pop(message, None)
+			# the executor is shut down once closed, submitting under the lock keeps close from racing it
+			if not self.closed:
+				self.executor.submit(self.deliver, message)
+
+	def close(self):
+		'''Stops delivering messages, cancelling pending redeliveries and waiting for the running callbacks.
+		'''
+		with self.lock:
+			self.closed = True
+			timers = list(self.timers.values())
+			self.timers.clear()
+		for timer in timers:
+			timer.cancel()
+		self.executor.shutdown()
+
+class TopicPublisher(object):
+	'''Publishes messages to a Pub/Sub topic with the publisher client.
+
+	The client publishes to the Pub/Sub emulator instead of Google Cloud if the PUBSUB_EMULATOR_HOST environment variable is set.
+	'''
+	def __init__(self, project, topic, create=True):
+		'''Initializes a TopicPublisher object.
+
+		Args:
+			project: Name of the project from Google Cloud, any name for the emulator.
+			topic: Name of the topic.
+			create: Whether to create the topic if it does not exist.
+		'''
+		super(TopicPublisher, self).__init__()
+		from google.api_core import exceptions
+		from google.cloud import pubsub_v1
+
+		self.client = pubsub_v1.PublisherClient()
+		self.topic_path = self.client.topic_path(project, topic)
+		self.futures = []
+		if create:
+			try:
+				self.client.create_topic(name=self.topic_path)
+			except exceptions.AlreadyExists:
+				pass
+
+	def publish(self, data):
+		'''Publishes a message to the topic without waiting for it to be sent.
+
+		Args:
+			data: Data of the message, as bytes.
+		'''
+		self.futures.append(self.client.publish(self.topic_path, data))
+
+	def close(self):
+		'''Waits for the published messages to be sent.
+		'''
+		for future in self.futures:
+			future.result()
+		self.futures = []
+
+def replay(mailbox, publish, rate, count, seed=0):
+	'''Delivers synthetic mails to a FakeMailbox at a target rate, publishing a Gmail push notification for each of them.
+	Returns the number of seconds taken.
+
+	Mails are delivered on a fixed schedule, so that a slow publish is caught up with rather than lowering the rate.
+
+	Args:
+		mailbox: A FakeMailbox (fakegmail.py).
+		publish: Function called with the data of each notification.
+		rate: Target number of mails per second.
+		count: Number of mails.
+		seed: Seed of the synthetic mails.
+	'''
+	start = time.monotonic()
+	for i, (subject, snippet) in enumerate(generate_mails(count, seed)):
+		delay = start + i / rate - time.monotonic()
+		if delay > 0:
+			time.sleep(delay)
+		mail_id, history_id = mailbox.deliver(subject, snippet)
+		publish(get_notification_data(mailbox.email_address, history_id))
+	return time.monotonic() - start
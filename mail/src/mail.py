@@ -1,20 +1,30 @@
 #!/usr/bin/env python3
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
 from apiclient import errors
 
+from concurrent.futures import wait
 from datetime import datetime, timezone
-import os.path
-import pickle
 import ast
-import operator
-import time
+import functools
 import logging
 
 from sentimentanalysis import Model
 from metrics import metrics
+from servicepool import load_credentials, build_service
+from labels import LabelCache, LabelBatcher
+from history import HistoryCursor, HistorySync
+from coalesce import NotificationCoalescer
+from predictioncache import PredictionCache
+import instrumentation
+from instrumentation import execute, time_stage
+
+# set weights for mail texts
+MAIL_SUBJECT_WEIGHT = 0.3
+MAIL_SNIPPET_WEIGHT = 0.7 # greater weight for body snippet since it is likely to contain more info.
+# only the fields needed for classification are requested
+MAIL_FIELDS = 'id,snippet,labelIds,payload/headers'
+# Gmail recommends at most 50 requests per batch to avoid rate limiting
+MAIL_BATCH_SIZE = 50
 
 def get_service(credentials_path, token_path):
 	''' Constructs a Gmail service object to use the Gmail API.
@@ -27,161 +37,244 @@ def get_service(credentials_path, token_path):
 		Returns:
 			service: Gmail service object.
 	'''
-	scopes = ['https://www.googleapis.com/auth/gmail.modify']
-
-	creds = None
-	# The file token.pickle stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-	if os.path.exists(token_path):
-		with open(token_path, 'rb') as token:
-			creds = pickle.load(token)
-
-	# If there are no (valid) credentials available, let the user log in.
-	if not creds or not creds.valid:
-		if creds and creds.expired and creds.refresh_token:
-			creds.refresh(Request())
-		else:
-			flow = InstalledAppFlow.from_client_secrets_file(
-				credentials_path, scopes)
-			creds = flow.run_local_server()
-		# Save the credentials for the next run
-		with open(token_path, 'wb') as token:
-			pickle.dump(creds, token)
-
-	service = build('gmail', 'v1', credentials=creds)
+	creds = load_credentials(credentials_path, token_path)
+	service = build_service(creds)
 	return service
 
-def get_mail_ids(service, history_id):
-	'''Returns a list of ids of new Gmail mails based on a message received by a Gmail subscriber.
+def get_header(mail_obj, header_name):
+	'''Returns the value of a header of a Gmail mail, or None if the mail does not have the header.
 
-	Retrieves the history of messages added to the Gmail inbox.
+	Header names are compared case-insensitively.
 
 	Args:
-		service: A Gmail service object to access the Gmail API.
-		history_id: History id of a message received by a Gmail subscriber parsed into a dictionary.
+		mail_obj: A Gmail message resource, containing its payload headers.
+		header_name: Name of the header to retrieve, eg. 'Subject'.
 	'''
-	try:
-		history_obj = service.users().history().list(userId='me', historyTypes='messageAdded', startHistoryId=history_id).execute()
-		mail_ids = []
-		for mail in history_obj['history'][0]['messages']:
-			mail_ids.append(mail['id'])
+	for header in mail_obj.get('payload', {}).get('headers', []):
+		if header['name'].lower() == header_name.lower():
+			return header['value']
 
-		return mail_ids
-	except (KeyError, errors.HttpError) as e:
-		# can be due to no new messages
-		logger.warning('no mail id found for message with history id: %s', history_id, exc_info=True)
+def get_mail_obj_texts(mail_obj):
+	'''Returns a list of tuples of the subject and snippet of a Gmail message resource and their weights.
 
-def get_weighted_mail_texts(service, mail_id, history_id):
-	'''Returns a list of tuples of selected texts of a Gmail mail and their weights for sentiment classification.
+	Args:
+		mail_obj: A Gmail message resource, containing its payload headers and snippet.
+	'''
+	mail_subject = get_header(mail_obj, 'Subject') or ''
+	mail_snippet = mail_obj['snippet']
+	return [(mail_subject, MAIL_SUBJECT_WEIGHT), (mail_snippet, MAIL_SNIPPET_WEIGHT)]
 
-	Retrieves the subject and a snippet of the mail's body using the mail's unique identifier.
-	Returns the texts and their respectives weights as a list of tuples.
+def get_mail_request(service, mail_id):
+	'''Returns a request for the metadata of a Gmail mail, restricted to the fields needed for classification.
 
 	Args:
 		service: A Gmail service object to access the Gmail API.
-		mail_id: Unique identifier of a mail to retrieve texts for.
-		history_id: History id of a message received by a Gmail subscriber parsed into a dictionary.
+		mail_id: Unique identifier of a mail to retrieve.
 	'''
-	# set weights for mail texts
-	MAIL_SUBJECT_WEIGHT = 0.3
-	MAIL_SNIPPET_WEIGHT = 0.7 # greater weight for body snippet since it is likely to contain more info.
-	try:
-		mail_obj = service.users().messages().get(userId='me', id=mail_id).execute()
-		mail_subject = mail_obj['payload']['headers'][3]['value']
-		mail_snippet = mail_obj['snippet']
-		return [(mail_subject, MAIL_SUBJECT_WEIGHT), (mail_snippet, MAIL_SNIPPET_WEIGHT)]
-	except (KeyError, errors.HttpError) as e:
-		logger.error('no texts found for mail id %s for message with history id: ', mail_id, history_id, exc_info=True)
+	return service.users().messages().get(userId='me', id=mail_id, format='metadata', metadataHeaders=['Subject'], fields=MAIL_FIELDS)
 
-def get_label_id(service, label_name):
-	'''Returns the unique identifier for a Gmail label based on its name.
+def get_mails_batch(service, mail_ids, history_id):
+	'''Returns a tuple of a dictionary of mail ids to the Gmail message resources needed for classification,
+	and a list of the ids of the mails which no longer exist.
 
-	Retrieves all the labels in the authenticated user's Gmail.
-	Returns the id of the first label whose name matches.
-	Creates the label if there is no match and returns its id.
+	Retrieves the subject, snippet and label ids of every mail with batch HTTP requests, each containing up to MAIL_BATCH_SIZE mails.
+	Mails which could not be retrieved are logged and left out. Mails which were deleted (or trashed, or replaced drafts)
+	since they were listed are not found, which is final, unlike server and network errors.
 
 	Args:
 		service: A Gmail service object to access the Gmail API.
-		label_name: Name of the label whose id is to be retrieved.
+		mail_ids: Unique identifiers of the mails to retrieve.
+		history_id: History id of a message received by a Gmail subscriber parsed into a dictionary.
 	'''
-	# all present labels
-	labels = service.users().labels().list(userId='me').execute().get('labels', [])
-	for label in labels:
-		if label['name'] == label_name:
-			return label['id']
+	# request ids must be unique within a batch
+	mail_ids = list(dict.fromkeys(mail_ids))
+	mail_objs = {}
+	missing_ids = []
+	def on_response(request_id, response, exception):
+		if exception is not None:
+			instrumentation.registry.increment(instrumentation.API_ERRORS, endpoint='messages.get')
+			if isinstance(exception, errors.HttpError) and exception.resp.status == 404:
+				logger.warning('mail id %s no longer exists for message with history id: %s', request_id, history_id)
+				missing_ids.append(request_id)
+			else:
+				logger.error('no texts found for mail id %s for message with history id: %s', request_id, history_id, exc_info=exception)
+		else:
+			mail_objs[request_id] = response
+
+	for i in range(0, len(mail_ids), MAIL_BATCH_SIZE):
+		batch = service.new_batch_http_request(callback=on_response)
+		for mail_id in mail_ids[i:i + MAIL_BATCH_SIZE]:
+			batch.add(get_mail_request(service, mail_id), request_id=mail_id)
+		# every request of a batch counts as an API call
+		instrumentation.registry.increment(instrumentation.API_CALLS, len(mail_ids[i:i + MAIL_BATCH_SIZE]), endpoint='messages.get')
+		try:
+			execute(batch, 'batch')
+		except errors.HttpError as e:
+			logger.error('failed to retrieve mails %s for message with history id: %s', str(mail_ids[i:i + MAIL_BATCH_SIZE]), history_id, exc_info=True)
 
-	created_label = service.users().labels().create(userId='me', body={'name': label_name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'}).execute()
-	return created_label['id']
+	return {mail_id: mail_objs[mail_id] for mail_id in mail_ids if mail_id in mail_objs}, missing_ids
 
-def assign_label(service, mail_id, polarity_label):
-	'''Assigns a label to a Gmail mail.
+def get_message_history_id(message):
+	'''Returns the history id of a message received by a Gmail subscriber.
 
-	Determines the label to be assigned, as a combination of the polarity text and its corresponding emoji.
-	Assigns the label to the relevant mail using the mail's id and the label's id.
+	Args:
+		message: A message received by a Gmail subscriber.
+	'''
+	message_dict = ast.literal_eval(message.data.decode('utf-8'))
+	return message_dict['historyId']
+
+def process_message(message):
+	'''Processes a message received by a Gmail subscriber.
+
+	Messages arriving close together are coalesced, so that they are processed together with a single history scan.
+	Blocks until the group of the message has been processed.
+	Returns whether every new mail of the group has been labeled.
 
 	Args:
-		service: A Gmail service object to access the Gmail API.
-		mail_id: Unique identifier for a Gmail mail to be assigned a label to.
-		polarity_label: Polarity label of the mail, a result of the classification of its text(s).
+		message: A message received by a Gmail subscriber.
 	'''
-	label_id = get_label_id(service, polarity_label)
-	# assign label to mail
-	labels_to_change = {'removeLabelIds': [], 'addLabelIds': [label_id]}
-	service.users().messages().modify(userId='me', id=mail_id, body=labels_to_change).execute()
+	history_id = get_message_history_id(message)
+	logger.info('received message with history id: %s', history_id)
+
+	return coalescer.submit(history_id)
 
-def process_message(service, message):
-	'''Orchestrator, to processes a message received by a Gmail subscriber.
+def process_history(service_pool, history_sync, label_batcher, analyze_many, history_id, notifications=1):
+	'''Orchestrator, to process the new mails of one or more messages received by a Gmail subscriber.
 
 	Calls functions to achieve the following (in order):
-		Retrieve the id of a new mail in an inbox, if any.
-		Retrieve relevant texts of the new mail using the id.
+		Retrieve the ids of new mails in an inbox since the history cursor, if any.
+		Retrieve relevant texts of the new mails using the ids.
 		Retrieve inference on the texts.
-		Assign a label to the new mail.
+		Assign a label to the new mails.
+		Advance the history cursor once every mail has been labeled.
+	A Gmail service object is borrowed from the pool for the duration of the Gmail requests.
+	Returns whether every new mail has been labeled, so that the messages can be acknowledged.
 
 	Args:
-		service: A Gmail service object to access the Gmail API.
-		message: A message received by a Gmail subscriber.
+		service_pool: A ServicePool (servicepool.py) of Gmail service objects.
+		history_sync: The HistorySync (history.py) of the inbox.
+		label_batcher: The LabelBatcher (labels.py) of the inbox.
+		analyze_many: Function returning the polarity labels of a list of mails' weighted texts, eg. model.analyze_many.
+		history_id: The minimum history id of the messages received by a Gmail subscriber.
+		notifications: The number of messages coalesced into this processing.
 	'''
-	message_dict = ast.literal_eval(message.data.decode('utf-8'))
-	history_id = message_dict['historyId']
-	logger.info('received message with history id: %s', history_id)
+	if notifications > 1:
+		logger.info('coalesced %d messages from history id: %s', notifications, history_id)
+
+	# the service object is returned before waiting on labels, which are flushed with a pooled service object
+	with service_pool.borrow() as service:
+		try:
+			with time_stage('history'):
+				mail_ids, synced_history_id, sequence = history_sync.sync(service, history_id)
+		except errors.HttpError as e:
+			logger.error('failed to retrieve history for message with history id: %s', history_id, exc_info=True)
+			return False
+		if len(mail_ids) == 0:
+			logger.info('no new mail ids for message with history id: %s', history_id)
+			history_sync.complete(sequence)
+			return True
+		logger.info('retrieved mail ids %s for message with history id: %s', str(mail_ids), history_id)
+
+		try:
+			with time_stage('fetch'):
+				mail_objs, missing_ids = get_mails_batch(service, mail_ids, history_id)
+		except Exception:
+			history_sync.complete(sequence, mail_ids)
+			raise
+
+	try:
+		# mails which no longer exist are processed, listing them again would fail again
+		unprocessed = label_mails(label_batcher, analyze_many, [mail_id for mail_id in mail_ids if mail_id not in missing_ids], mail_objs, history_id)
+	except Exception:
+		# the claimed mails must be released and the sync completed, or the cursor could not advance anymore
+		history_sync.complete(sequence, mail_ids)
+		raise
 
-	# buffer to allow Gmail API provide up-to-date results
-	time.sleep(1)
+	# mails which could not be processed are listed again by a later sync, unless they have failed too often
+	retried = history_sync.complete(sequence, unprocessed)
+	return len(retried) == 0
 
-	mail_ids = get_mail_ids(service, history_id)
-	if mail_ids is None or len(mail_ids) == 0:
-		return
-	logger.info('retrieved mail ids %s for message with history id: %s', str(mail_ids), history_id)
+def label_mails(label_batcher, analyze_many, mail_ids, mail_objs, history_id):
+	'''Classifies and labels the retrieved mails of a sync. Returns the ids of the mails which could not be processed.
 
-	for mail_id in mail_ids:
-		mail_texts = get_weighted_mail_texts(service, mail_id, history_id)
-		if mail_texts is None:
-			return
+	Mails without texts are skipped, and count as processed, like mails which no longer exist once they are labeled.
+
+	Args:
+		label_batcher: The LabelBatcher (labels.py) of the inbox.
+		analyze_many: Function returning the polarity labels of a list of mails' weighted texts, eg. model.analyze_many.
+		mail_ids: Unique identifiers of the mails claimed by the sync which still exist.
+		mail_objs: A dictionary of mail ids to the Gmail message resources which could be retrieved.
+		history_id: The minimum history id of the messages received by a Gmail subscriber.
+	'''
+	unprocessed = [mail_id for mail_id in mail_ids if mail_id not in mail_objs]
+	mails_texts = []
+	for mail_id, mail_obj in mail_objs.items():
+		try:
+			mail_texts = get_mail_obj_texts(mail_obj)
+		except KeyError as e:
+			# fetching the mail again would not give it texts
+			logger.warning('no texts found for mail id %s for message with history id: %s, skipping it', mail_id, history_id, exc_info=True)
+			continue
 		logger.info('retrieved texts %s for mail from message with history id: %s', mail_texts, history_id)
+		mails_texts.append((mail_id, mail_texts))
+
+	# classify the texts of every mail in a single batch
+	with time_stage('inference'):
+		polarity_labels = analyze_many([mail_texts for mail_id, mail_texts in mails_texts])
 
-		polarity_label = model.analyze(mail_texts)
+	labelings = []
+	for (mail_id, mail_texts), polarity_label in zip(mails_texts, polarity_labels):
 		logger.info('retrieved polarity label %s for mail from message with history id: %s', polarity_label, history_id)
 
-		assign_label(service, mail_id, polarity_label)
+		labeled = label_batcher.add(mail_id, polarity_label, mail_objs[mail_id].get('labelIds', []))
+		labelings.append((mail_id, polarity_label, labeled))
+	with time_stage('label'):
+		wait([labeled for mail_id, polarity_label, labeled in labelings])
+
+	for mail_id, polarity_label, labeled in labelings:
+		try:
+			assigned = labeled.result()
+			if assigned is None:
+				# labeling the mail again would fail again
+				logger.warning('mail id %s no longer exists for message with history id: %s', mail_id, history_id)
+				continue
+			if not assigned:
+				logger.info('mail %s already has label %s for message with history id: %s', mail_id, polarity_label, history_id)
+				continue
+		except Exception as e:
+			logger.error('failed to assign label %s to mail %s for message with history id: %s', polarity_label, mail_id, history_id, exc_info=True)
+			unprocessed.append(mail_id)
+			continue
+
 		logger.info('assigned label %s to mail from message with history_id: %s\n', polarity_label, history_id)
 		try:
-			mail_stats.addPolarity(polarity_label)
-		except Error as e:
+			with time_stage('metrics'):
+				mail_stats.addPolarity(polarity_label)
+		except Exception as e:
 			logger.error('failed to record email polarity classification for message with history id: %s', history_id, exc_info=True)
 
-def start(model_type, model_args, log_path):
-	'''Performs initialization tasks.
+	return unprocessed
+
+def start_shared(log_path, model_type, model_args, cache_size=10000, cache_path=None, download=False, inference_workers=0, metrics_path='mailsense.db', metrics_port=0, metrics_host='127.0.0.1', rollup_interval=0):
+	'''Performs the initialization tasks shared by every inbox.
 
 	Initializes logger.
 	Triggers the initialization of the polarity classification model.
+	Starts recording the mail statistics and serving the instrumentation metrics.
 	Defines global variables to be used.
 
 	Args:
+		log_path: The path of the log file for this file.
 		model_type: A ModelType (sentimentanalysis.py) value of the sentiment analysis model to use.
 		model_args: The argument for the respective sentiment analysis model.
-		log_path: The path of the log file for this file.
+		cache_size: Maximum number of cached text polarity predictions, or 0 to disable the cache.
+		cache_path: The path of a SQLite file to persist cached predictions to, or None to keep them in memory only.
+		download: Whether missing nltk data of the model may be downloaded.
+		inference_workers: Number of worker processes running the model, or 0 to run it in the callback threads.
+		metrics_path: The path of the SQLite file the mail statistics are written to.
+		metrics_port: The port the instrumentation metrics are served on in the Prometheus text format, or 0 to not serve them.
+		metrics_host: The host the instrumentation metrics are served on.
+		rollup_interval: Seconds between rollups of the instrumentation metrics into the SQLite file of the mail statistics, or 0 to not roll them up.
 	'''
 	logging.basicConfig(filename=log_path, level=logging.INFO, format=str(datetime.now(timezone.utc).astimezone()) + ' %(name)s' + ' %(levelname)s-%(message)s')
 	global logger
@@ -190,19 +283,145 @@ def start(model_type, model_args, log_path):
 
 	global mail_stats
 	try:
-		mail_stats = metrics()
-	except Error as e:
+		mail_stats = metrics(db_name=metrics_path)
+	except Exception as e:
 		msg = 'failed to initialize mail statistics'
 		logger.error(msg, exc_info=True)
 		raise RuntimeError(msg)
 
+	global prediction_cache
+	prediction_cache = None
+	try:
+		if cache_size > 0:
+			prediction_cache = PredictionCache(cache_size, cache_path)
+	except Exception as e:
+		msg = 'failed to initialize prediction cache'
+		logger.error(msg, exc_info=True)
+		raise RuntimeError(msg)
+
 	global model
 	try:
-		model = Model(model_type, model_args)
-	except Error as e:
+		model = Model(model_type, model_args, prediction_cache, download, inference_workers)
+	except Exception as e:
 		msg = 'failed to initialize sentiment analysis model'
 		logger.error(msg, exc_info=True)
 		raise RuntimeError(msg)
 
-	logger.info('initialization complete')
+	instrumentation.register_queue('metrics', mail_stats.records.qsize)
+	if prediction_cache is not None:
+		instrumentation.register_cache('predictions', prediction_cache.stats)
+
+	global metrics_server
+	global metrics_rollup
+	metrics_server, metrics_rollup = None, None
+	try:
+		if metrics_port > 0:
+			metrics_server = instrumentation.MetricsServer(metrics_host, metrics_port)
+		if rollup_interval > 0:
+			metrics_rollup = instrumentation.Rollup(metrics_path, rollup_interval)
+	except Exception as e:
+		msg = 'failed to initialize instrumentation'
+		logger.error(msg, exc_info=True)
+		raise RuntimeError(msg)
+
 	logger.info('model being used: %s', str(model_type))
+
+def start_mailbox(service_pool, history_path, label_window=0.5, label_batch_size=1000):
+	'''Performs the initialization tasks of an inbox, once start_shared has been called.
+	Returns a tuple of the LabelCache, HistorySync and LabelBatcher (labels.py, history.py) of the inbox.
+
+	Caches the ids of the polarity labels, creating the labels if needed.
+	Loads the history cursor, seeding it with the inbox's current history id if there is none.
+
+	Args:
+		service_pool: A ServicePool (servicepool.py) of Gmail service objects of the inbox.
+		history_path: The path of the file storing the last fully processed history id of the inbox.
+		label_window: Seconds for which label assignments are buffered before being applied together.
+		label_batch_size: Number of buffered label assignments which triggers applying them immediately.
+	'''
+	mailbox_label_cache = LabelCache()
+	try:
+		with service_pool.borrow() as service:
+			mailbox_label_cache.warm(service, model.POLARITY_LABELS.values())
+	except Exception as e:
+		msg = 'failed to retrieve polarity labels'
+		logger.error(msg, exc_info=True)
+		raise RuntimeError(msg)
+
+	mailbox_history_sync = HistorySync(HistoryCursor(history_path))
+	try:
+		with service_pool.borrow() as service:
+			mailbox_history_sync.seed(service)
+	except Exception as e:
+		msg = 'failed to initialize history cursor'
+		logger.error(msg, exc_info=True)
+		raise RuntimeError(msg)
+
+	return mailbox_label_cache, mailbox_history_sync, LabelBatcher(service_pool, mailbox_label_cache, label_window, label_batch_size)
+
+def start(model_type, model_args, log_path, service_pool, history_path, label_window=0.5, label_batch_size=1000, coalesce_window=0.05, coalesce_max_wait=0.2, cache_size=10000, cache_path=None, download=False, inference_workers=0, metrics_path='mailsense.db', metrics_port=0, metrics_host='127.0.0.1', rollup_interval=0):
+	'''Performs initialization tasks for a single inbox.
+
+	Performs the shared initialization tasks (start_shared) and those of the inbox (start_mailbox).
+	Defines global variables to be used.
+
+	Args:
+		model_type: A ModelType (sentimentanalysis.py) value of the sentiment analysis model to use.
+		model_args: The argument for the respective sentiment analysis model.
+		log_path: The path of the log file for this file.
+		service_pool: A ServicePool (servicepool.py) of Gmail service objects.
+		history_path: The path of the file storing the last fully processed history id.
+		label_window: Seconds for which label assignments are buffered before being applied together.
+		label_batch_size: Number of buffered label assignments which triggers applying them immediately.
+		coalesce_window: Seconds without a new message after which coalesced messages are processed.
+		coalesce_max_wait: Maximum number of seconds messages are coalesced for.
+		cache_size: Maximum number of cached text polarity predictions, or 0 to disable the cache.
+		cache_path: The path of a SQLite file to persist cached predictions to, or None to keep them in memory only.
+		download: Whether missing nltk data of the model may be downloaded.
+		inference_workers: Number of worker processes running the model, or 0 to run it in the callback threads.
+		metrics_path: The path of the SQLite file the mail statistics are written to.
+		metrics_port: The port the instrumentation metrics are served on in the Prometheus text format, or 0 to not serve them.
+		metrics_host: The host the instrumentation metrics are served on.
+		rollup_interval: Seconds between rollups of the instrumentation metrics into the SQLite file of the mail statistics, or 0 to not roll them up.
+	'''
+	start_shared(log_path, model_type, model_args, cache_size, cache_path, download, inference_workers, metrics_path, metrics_port, metrics_host, rollup_interval)
+
+	global label_cache
+	global history_sync
+	global label_batcher
+	label_cache, history_sync, label_batcher = start_mailbox(service_pool, history_path, label_window, label_batch_size)
+
+	global coalescer
+	coalescer = NotificationCoalescer(instrumentation.timed('total', functools.partial(process_history, service_pool, history_sync, label_batcher, model.analyze_many)), coalesce_window, coalesce_max_wait, history_sync.cursor)
+	instrumentation.register_queue('labels', lambda: label_batcher.pending_count)
+
+	logger.info('initialization complete')
+
+def stop_shared():
+	'''Performs the shutdown tasks shared by every inbox, once the label assignments of every inbox have been applied.
+
+	Writes the queued mail statistics.
+	Persists the prediction cache.
+	Stops the inference workers.
+	Writes the last rollup of the instrumentation metrics and stops serving them.
+	'''
+	mail_stats.close()
+	model.close()
+	if metrics_rollup is not None:
+		metrics_rollup.close()
+	if metrics_server is not None:
+		metrics_server.close()
+	if prediction_cache is not None:
+		logger.info('prediction cache stats: %s', str(prediction_cache.stats()))
+		prediction_cache.close()
+
+def stop():
+	'''Performs shutdown tasks for a single inbox.
+
+	Applies the label assignments which are still buffered.
+	Performs the shared shutdown tasks (stop_shared).
+	'''
+	logger.info('stopping')
+	label_batcher.close()
+	stop_shared()
+	logger.info('stopped')
@@ -1,26 +1,64 @@
 #!/usr/bin/env python3
 
 import sqlite3
-from datetime import datetime, timezone
+import argparse
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger('mailsense.mail.metrics')
+
+# rollup table information store: name as key, tuple (bucket field name, bucket size in seconds) as value
+# ordered from the coarsest to the finest bucket
+ROLLUPS = {
+	'polarities_daily': ('day', 86400),
+	'polarities_hourly': ('hour', 3600)
+}
+# upper bound for open-ended time ranges, aligned to every bucket size
+MAX_TIMESTAMP = (2 ** 40 // 86400) * 86400
 
 class metrics(object):
 	'''Responsible for the project's statistics.
 	'''
-	def __init__(self):
+	def __init__(self, batch_size=100, flush_interval=1.0, db_name='mailsense.db'):
 		'''Initializes a metrics object.
 
 		Defines database name.
 		Defines tables.
 		Initializes database objects.
-		Creates tables.
+		Enables write-ahead logging, so that the writer does not block readers.
+		Creates tables, migrating the previous schema if needed.
+
+		Args:
+			batch_size: Maximum number of records committed together by the writer.
+			flush_interval: Maximum number of seconds the first record of a batch waits for more records before being committed.
+			db_name: Path of the SQLite database file.
 		'''
 		super(metrics, self).__init__()
-		self.DB_NAME = 'mailsense.db'
+		self.DB_NAME = db_name
 		# table information store: name as key, list of tuples (field name, field type) as value
+		# timestamps are seconds since the epoch (UTC)
 		self.TABLES_NAME_FIELDS = {
-			'polarities': [('datetime', 'text'), ('polarity', 'text')]
+			'polarities': [('timestamp', 'integer'), ('polarity', 'text')],
+			'polarities_hourly': [('hour', 'integer'), ('polarity', 'text'), ('count', 'integer'), ('primary key', '(hour, polarity)')],
+			'polarities_daily': [('day', 'integer'), ('polarity', 'text'), ('count', 'integer'), ('primary key', '(day, polarity)')]
 		}
+		# index information store: name as key, tuple (table name, field name) as value
+		self.INDEXES = {
+			'polarities_timestamp': ('polarities', 'timestamp')
+		}
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		# records are written by a single thread which owns its connection, started on the first record
+		self.records = queue.Queue()
+		self.writer = None
+		self.writer_lock = threading.Lock()
+		self.reader_lock = threading.Lock()
+
 		self.setDBObjects()
+		self.c.execute('pragma journal_mode=wal')
+		self.migrateTables()
 		self.createTables()
 		self.conn.commit()
 
@@ -30,11 +68,11 @@ class metrics(object):
 		Creates new connection object.
 		Creates new cursor object.
 		'''
-		self.conn = sqlite3.connect(self.DB_NAME)
+		self.conn = sqlite3.connect(self.DB_NAME, check_same_thread=False)
 		self.c = self.conn.cursor()
 
 	def createTables(self):
-		'''Creates tables in the database if they don't already exist.
+		'''Creates tables and indexes in the database if they don't already exist.
 		'''
 		for table_name in self.TABLES_NAME_FIELDS.keys():
 			create_table_query = "create table if not exists {tn} (".format(tn=table_name)
@@ -45,30 +83,205 @@ class metrics(object):
 			create_table_query = create_table_query[:len(create_table_query)-2] + ")"
 			self.c.execute(create_table_query)
 
+		for index_name, (table_name, field_name) in self.INDEXES.items():
+			self.c.execute('create index if not exists {ixn} on {tn} ({fn})'.format(ixn=index_name, tn=table_name, fn=field_name))
+
+	def migrateTables(self):
+		'''Converts a 'polarities' table with text datetimes to integer timestamps, and builds its rollups.
+		'''
+		fields = [row[1] for row in self.c.execute('pragma table_info(polarities)')]
+		if 'datetime' not in fields:
+			return
+
+		logger.info('migrating polarities table to integer timestamps')
+		self.c.execute('alter table polarities rename to polarities_legacy')
+		self.createTables()
+		# sqlite understands the stored iso format, including its utc offset
+		self.c.execute("insert into polarities select cast(strftime('%s', datetime) as integer), polarity from polarities_legacy")
+		self.c.execute('drop table polarities_legacy')
+		for table_name, (bucket_name, bucket_size) in ROLLUPS.items():
+			self.c.execute('insert into {tn} select timestamp / {bs} * {bs}, polarity, count(*) from polarities group by 1, 2'.format(tn=table_name, bs=bucket_size))
+
 	def addPolarity(self, value):
-		'''Adds an entry to the 'polarities' table, with the current datetime and a polarity string value.
+		'''Queues an entry for the 'polarities' table, with the current timestamp and a polarity string value.
+		The entry is written by the writer thread, without blocking the caller on disk I/O.
 
 		Args:
 			value: The polarity string value to be added.
 		'''
-		# to overcome thread-unsafe db objects
-		self.setDBObjects()
-		self.c.execute('insert into polarities values (?, ?)', (datetime.now(timezone.utc).astimezone(), value))
-		self.conn.commit()
+		if self.writer is None:
+			self.startWriter()
+		self.records.put((int(time.time()), value))
 
-	def printPolarityCounts(self):
-		'''Prints the total count of the 'polarities' table, along with the count of each polarity value.
+	def startWriter(self):
+		'''Starts the writer thread if it is not running yet.
 		'''
-		to_print = '---Polarity Counts---\n'
-		for row in self.c.execute('select count(*) from {tn}'.format(tn='polarities')):
-			to_print = to_print + 'Total: {tc}\n'.format(tc=row[0])
+		with self.writer_lock:
+			if self.writer is None:
+				self.writer = threading.Thread(target=self.runWriter, name='mailsense-metrics', daemon=True)
+				self.writer.start()
+
+	def runWriter(self):
+		'''Writes queued entries in batches until a stop sentinel (None) is received.
+
+		Uses its own connection, since sqlite connection objects are not thread safe.
+		Each batch is committed in a single transaction.
+		'''
+		conn = sqlite3.connect(self.DB_NAME)
+		conn.execute('pragma synchronous=normal')
+		stopped = False
+		while not stopped:
+			record = self.records.get()
+			if record is None:
+				break
+
+			batch = [record]
+			deadline = time.monotonic() + self.flush_interval
+			while len(batch) < self.batch_size:
+				try:
+					record = self.records.get(timeout=max(deadline - time.monotonic(), 0))
+				except queue.Empty:
+					break
+				if record is None:
+					stopped = True
+					break
+				batch.append(record)
+
+			try:
+				with conn:
+					self.writeBatch(conn, batch)
+			except sqlite3.Error as e:
+				logger.error('failed to record %d email polarity classifications', len(batch), exc_info=True)
+
+		conn.close()
+
+	def writeBatch(self, conn, batch):
+		'''Inserts a batch of entries and adds them to the rollup tables.
+
+		Args:
+			conn: The writer's connection, within a transaction.
+			batch: A list of tuples: [(timestamp, polarity), ...]
+		'''
+		conn.executemany('insert into polarities values (?, ?)', batch)
+		for table_name, (bucket_name, bucket_size) in ROLLUPS.items():
+			counts = {}
+			for timestamp, polarity in batch:
+				key = (timestamp // bucket_size * bucket_size, polarity)
+				counts[key] = counts.get(key, 0) + 1
+
+			conn.executemany('insert or ignore into {tn} values (?, ?, 0)'.format(tn=table_name), counts.keys())
+			conn.executemany('update {tn} set count = count + ? where {bn} = ? and polarity = ?'.format(tn=table_name, bn=bucket_name),
+				[(count, bucket, polarity) for (bucket, polarity), count in counts.items()])
+
+	def close(self):
+		'''Writes the queued entries and stops the writer thread.
+		'''
+		if self.writer is not None:
+			self.records.put(None)
+			self.writer.join()
+			self.writer = None
+		self.conn.close()
+
+	def countPolarities(self, start=None, end=None):
+		'''Returns a dictionary of the count of each polarity value within a time range.
+
+		Whole days and hours of the range are read from the rollup tables,
+		only the partial hours at its edges are counted from the 'polarities' table.
+
+		Args:
+			start: Timestamp (seconds since the epoch) from which entries are counted, inclusive. None for no lower bound.
+			end: Timestamp (seconds since the epoch) up to which entries are counted, exclusive. None for no upper bound.
+		'''
+		start = 0 if start is None else int(start)
+		end = MAX_TIMESTAMP if end is None else int(end)
+
+		# tuples (table name, field name, start, end) of the ranges to count
+		ranges = []
+		for table_name, (bucket_name, bucket_size) in ROLLUPS.items():
+			bucket_start = -(-start // bucket_size) * bucket_size
+			bucket_end = end // bucket_size * bucket_size
+			if bucket_start >= bucket_end:
+				continue
+			# the remaining edges are counted with finer buckets or raw entries
+			ranges.append((table_name, bucket_name, bucket_start, bucket_end))
+			ranges.extend(self.splitRange(start, bucket_start, end, bucket_end))
 			break
+		else:
+			ranges.append(('polarities', 'timestamp', start, end))
+
+		counts = {}
+		with self.reader_lock:
+			for table_name, field_name, range_start, range_end in ranges:
+				count_field = 'count(*)' if table_name == 'polarities' else 'sum(count)'
+				query = 'select polarity, {cf} from {tn} where {fn} >= ? and {fn} < ? group by polarity'.format(cf=count_field, tn=table_name, fn=field_name)
+				for row in self.conn.execute(query, (range_start, range_end)):
+					counts[row[0]] = counts.get(row[0], 0) + row[1]
+
+		return counts
+
+	def splitRange(self, start, bucket_start, end, bucket_end):
+		'''Returns the ranges to count for the edges of a time range which are not covered by a bucket range.
+
+		Args:
+			start: Start of the time range.
+			bucket_start: Start of the range covered by whole buckets.
+			end: End of the time range.
+			bucket_end: End of the range covered by whole buckets.
+		'''
+		ranges = []
+		for edge_start, edge_end in [(start, bucket_start), (bucket_end, end)]:
+			if edge_start >= edge_end:
+				continue
+			hour_start = -(-edge_start // 3600) * 3600
+			hour_end = edge_end // 3600 * 3600
+			if hour_start >= hour_end:
+				ranges.append(('polarities', 'timestamp', edge_start, edge_end))
+				continue
+			ranges.append(('polarities_hourly', 'hour', hour_start, hour_end))
+			for raw_start, raw_end in [(edge_start, hour_start), (hour_end, edge_end)]:
+				if raw_start < raw_end:
+					ranges.append(('polarities', 'timestamp', raw_start, raw_end))
+		return ranges
+
+	def countPolaritiesByBucket(self, start=None, end=None, bucket='day'):
+		'''Returns a list of tuples (bucket start timestamp, polarity, count) within a time range, read from a rollup table.
 
-		for row in self.c.execute('select polarity, count(polarity) from polarities group by polarity'):
-			to_print = to_print + '{pv}: {pc}\n'.format(pv=row[0], pc=row[1])
+		Args:
+			start: Timestamp (seconds since the epoch) of the first bucket, inclusive. None for no lower bound.
+			end: Timestamp (seconds since the epoch) of the last bucket, exclusive. None for no upper bound.
+			bucket: The bucket size, 'day' or 'hour'.
+		'''
+		table_name = {'day': 'polarities_daily', 'hour': 'polarities_hourly'}[bucket]
+		start = 0 if start is None else int(start)
+		end = MAX_TIMESTAMP if end is None else int(end)
+
+		query = 'select {bn}, polarity, count from {tn} where {bn} >= ? and {bn} < ? order by {bn}, polarity'.format(bn=bucket, tn=table_name)
+		with self.reader_lock:
+			return self.conn.execute(query, (start, end)).fetchall()
+
+	def printPolarityCounts(self, start=None, end=None):
+		'''Prints the total count of the 'polarities' table, along with the count of each polarity value.
+
+		Args:
+			start: Timestamp (seconds since the epoch) from which entries are counted, inclusive. None for no lower bound.
+			end: Timestamp (seconds since the epoch) up to which entries are counted, exclusive. None for no upper bound.
+		'''
+		counts = self.countPolarities(start, end)
+		to_print = '---Polarity Counts---\n'
+		to_print = to_print + 'Total: {tc}\n'.format(tc=sum(counts.values()))
+		for polarity in sorted(counts.keys()):
+			to_print = to_print + '{pv}: {pc}\n'.format(pv=polarity, pc=counts[polarity])
 
 		print(to_print)
 
 if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='print statistics of the polarities assigned to mails')
+	parser.add_argument('-d', '--days', help='int: only count the polarities of the last number of days', type=int, action='store', required=False)
+	args = parser.parse_args()
+
+	start = None
+	if args.days is not None:
+		start = int(time.time()) - args.days * 86400
+
 	metrics = metrics()
-	metrics.printPolarityCounts()
+	metrics.printPolarityCounts(start)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# This script caches the polarity predicted for texts, so that repeated texts are not classified again.
+# Automated senders (newsletters, alerts, notifications) often send identical subjects and snippets.
+
+from collections import OrderedDict
+import hashlib
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger('mailsense.mail.predictioncache')
+
+def normalize_text(text):
+	'''Returns a text with its whitespace collapsed, so that texts differing only in spacing share a cache entry.
+
+	Args:
+		text: Text to normalize.
+	'''
+	return ' '.join(text.split())
+
+def hash_text(text):
+	'''Returns the hash of a normalized text.
+
+	Args:
+		text: Text to hash.
+	'''
+	return hashlib.sha1(normalize_text(text).encode('utf-8')).hexdigest()
+
+class PredictionCache(object):
+	'''A bounded, thread-safe cache of text polarity predictions with LRU eviction.
+
+	Entries are keyed by model type, model identity and normalized text hash.
+	The cache can be persisted to a SQLite file, so that it survives restarts.
+	Changes are written by a background thread, so that lookups and predictions never wait on the file.
+	'''
+	def __init__(self, max_size=10000, path=None, flush_interval=5.0):
+		'''Initializes a PredictionCache object.
+
+		Loads the most recently used persisted entries and starts the writing thread if a path is given.
+
+		Args:
+			max_size: Maximum number of cached predictions.
+			path: Path of a SQLite file to persist the cache to, or None to keep it in memory only.
+			flush_interval: Seconds between writes of the changes to the SQLite file.
+		'''
+		super(PredictionCache, self).__init__()
+		if max_size < 1:
+			raise ValueError('prediction cache size must be at least 1')
+
+		self.max_size = max_size
+		self.path = path
+		self.flush_interval = flush_interval
+		# key as key, polarity as value, ordered from least to most recently used
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+		# serializes the writes, which happen outside of the lock
+		self.write_lock = threading.Lock()
+		self.stopped = threading.Event()
+		# persisted changes not yet written: key as key, polarity (or None if evicted) as value
+		self.pending = {}
+		self.tick = 0
+
+		self.conn = None
+		if path is not None:
+			self.conn = sqlite3.connect(path, check_same_thread=False)
+			self.conn.execute('create table if not exists predictions (model_type text, model_identity text, text_hash text, polarity text, last_used integer, primary key (model_type, model_identity, text_hash))')
+			rows = self.conn.execute('select model_type, model_identity, text_hash, polarity, last_used from predictions order by last_used desc limit ?', (max_size,)).fetchall()
+			for row in reversed(rows):
+				self.entries[(row[0], row[1], row[2])] = row[3]
+			if len(rows) > 0:
+				self.tick = rows[0][4]
+
+			self.flush_thread = threading.Thread(target=self.run_flush, name='mailsense-predictioncache', daemon=True)
+			self.flush_thread.start()
+
+	def get_many(self, model_type, model_identity, texts):
+		'''Returns the cached polarity of each text, with None for texts which are not cached.
+
+		Args:
+			model_type: A ModelType (sentimentanalysis.py) value of the model which predicted the polarities.
+			model_identity: A string identifying the loaded model, eg. its file and version.
+			texts: List of texts to retrieve the polarities of.
+		'''
+		polarities = []
+		with self.lock:
+			for text in texts:
+				key = (str(model_type), model_identity, hash_text(text))
+				polarity = self.entries.get(key)
+				if polarity is None:
+					self.misses = self.misses + 1
+				else:
+					self.hits = self.hits + 1
+					self.entries.move_to_end(key)
+					self.touch(key, polarity)
+				polarities.append(polarity)
+		return polarities
+
+	def put_many(self, model_type, model_identity, texts, polarities):
+		'''Caches the polarities of texts, evicting the least recently used entries if the cache is full.
+
+		Args:
+			model_type: A ModelType (sentimentanalysis.py) value of the model which predicted the polarities.
+			model_identity: A string identifying the loaded model, eg. its file and version.
+			texts: List of texts which were classified.
+			polarities: List of the predicted polarity of each text.
+		'''
+		with self.lock:
+			for text, polarity in zip(texts, polarities):
+				key = (str(model_type), model_identity, hash_text(text))
+				self.entries[key] = polarity
+				self.entries.move_to_end(key)
+				self.touch(key, polarity)
+
+			while len(self.entries) > self.max_size:
+				key, polarity = self.entries.popitem(last=False)
+				self.evictions = self.evictions + 1
+				if self.conn is not None:
+					self.pending[key] = None
+
+	def touch(self, key, polarity):
+		'''Records a use of an entry to be persisted. The caller must hold the lock.
+
+		Args:
+			key: Key of the entry.
+			polarity: Cached polarity of the entry.
+		'''
+		if self.conn is not None:
+			self.tick = self.tick + 1
+			self.pending[key] = (polarity, self.tick)
+
+	def flush(self):
+		'''Writes the pending changes to the SQLite file, in a single transaction.
+		'''
+		if self.conn is None:
+			return
+
+		with self.write_lock:
+			with self.lock:
+				if len(self.pending) == 0:
+					return
+				pending = self.pending
+				self.pending = {}
+			upserts = [key + value for key, value in pending.items() if value is not None]
+			deletes = [key for key, value in pending.items() if value is None]
+
+			try:
+				with self.conn:
+					self.conn.executemany('insert or replace into predictions values (?, ?, ?, ?, ?)', upserts)
+					self.conn.executemany('delete from predictions where model_type = ? and model_identity = ? and text_hash = ?', deletes)
+			except Exception:
+				# keeps the changes for the next write, unless they have been superseded since
+				with self.lock:
+					for key, value in pending.items():
+						self.pending.setdefault(key, value)
+				raise
+
+	def run_flush(self):
+		'''Writes the pending changes every flush interval until the cache is closed.
+		'''
+		while not self.stopped.wait(self.flush_interval):
+			try:
+				self.flush()
+			except Exception as e:
+				logger.error('failed to persist cached predictions', exc_info=True)
+
+	def stats(self):
+		'''Returns a dictionary of the cache's size and its hit, miss and eviction counters.
+		'''
+		with self.lock:
+			return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+	def close(self):
+		'''Stops the writing thread, writes the pending changes and closes the SQLite file.
+		'''
+		if self.conn is not None:
+			self.stopped.set()
+			self.flush_thread.join()
+		self.flush()
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# This script manages the resources needed by the sentiment analysis backends: their modules, nltk data and model artifacts.
+# Only the backend of the selected model type is imported, and the network is only used if downloads are explicitly allowed.
+
+import importlib
+import os
+import sys
+
+# backend information store: model type name as key, tuple (backend directory, backend module) as value
+BACKENDS = {
+	'fastai': (os.path.join(os.path.dirname(__file__), '../../fastai/'), 'src.inference'),
+	'textblob': (os.path.join(os.path.dirname(__file__), '../../textblob/'), 'src.textblob_inference'),
+	'nltk': (os.path.join(os.path.dirname(__file__), '../../nltk/'), 'src.nltk_inference')
+}
+
+def import_backend(model_type):
+	'''Returns the inference module of a sentiment analysis backend, importing it if needed.
+
+	Only the directory of the requested backend is added to the module search path.
+
+	Args:
+		model_type: A ModelType (sentimentanalysis.py) value of the backend to import.
+	'''
+	backend_dir, module_name = BACKENDS[str(model_type)]
+	backend_dir = os.path.abspath(backend_dir)
+	if backend_dir not in sys.path:
+		sys.path.append(backend_dir)
+	return importlib.import_module(module_name)
+
+def find_nltk_resource(resource_path):
+	'''Returns whether a nltk data resource is available locally, without using the network.
+
+	Args:
+		resource_path: Path of the resource within the nltk data directories, eg. 'sentiment/vader_lexicon.zip'.
+	'''
+	import nltk
+
+	try:
+		nltk.data.find(resource_path)
+		return True
+	except LookupError:
+		return False
+
+def get_missing_resources(model_type, model_args, backend):
+	'''Returns a list of tuples (resource kind, name, path) of the resources of a backend which are not available locally.
+
+	Args:
+		model_type: A ModelType (sentimentanalysis.py) value of the backend.
+		model_args: The arguments for the respective sentiment analysis model.
+		backend: The inference module of the backend.
+	'''
+	missing = []
+	if str(model_type) == 'fastai':
+		model_path = os.path.join(model_args['model_dir'], model_args['model_name'])
+		if not os.path.exists(model_path):
+			missing.append(('model', model_args['model_name'], model_path))
+
+	nltk_resources = list(getattr(backend, 'NLTK_RESOURCES', []))
+	# the textblob analyzer is only trained, using its corpus, if its artifact has not been built
+	if str(model_type) == 'textblob' and not os.path.exists(backend.get_artifact_path()):
+		nltk_resources.extend(backend.BUILD_NLTK_RESOURCES)
+
+	for package, resource_path in nltk_resources:
+		if not find_nltk_resource(resource_path):
+			missing.append(('nltk', package, resource_path))
+
+	return missing
+
+def ensure_resources(model_type, model_args, backend, download=False):
+	'''Checks that the resources of a backend are available locally, downloading missing nltk data only if allowed.
+
+	Raises a RuntimeError listing the resources which are still missing.
+
+	Args:
+		model_type: A ModelType (sentimentanalysis.py) value of the backend.
+		model_args: The arguments for the respective sentiment analysis model.
+		backend: The inference module of the backend.
+		download: Whether missing nltk data may be downloaded.
+	'''
+	missing = get_missing_resources(model_type, model_args, backend)
+	if download:
+		import nltk
+
+		for kind, name, path in missing:
+			if kind == 'nltk':
+				nltk.download(name)
+		missing = get_missing_resources(model_type, model_args, backend)
+
+	if len(missing) > 0:
+		descriptions = ', '.join('{k} {n} ({p})'.format(k=kind, n=name, p=path) for kind, name, path in missing)
+		hint = '' if download else ', allow downloading them to retrieve missing nltk data'
+		raise RuntimeError('missing resources for {mt} model: {d}{h}'.format(mt=model_type, d=descriptions, h=hint))
@@ -2,18 +2,18 @@
 
 import argparse
 from enum import Enum
-import os
-import sys
-sys.path.append(os.path.join(os.path.dirname(__file__), '../../fastai/'))
-sys.path.append(os.path.join(os.path.dirname(__file__), '../../textblob/'))
-sys.path.append(os.path.join(os.path.dirname(__file__), '../../nltk/'))
+
+import resources
 
 MODEL_ARGUMENT_CHOICES = {
-	"fastai": "{'model_dir': Directory of the saved fastai model, 'model_name': File name of the saved fastai model}",
+	"fastai": "{'model_dir': Directory of the saved fastai model, 'model_name': File name of the saved fastai model, (optional) 'quantize': Whether to apply dynamic int8 quantization, (optional) 'num_threads': Number of torch threads}",
 	"textblob": "no arguments needed",
 	"nltk": "no arguments needed"
 }
 
+# score of each text polarity, weighted to determine the overall polarity
+POLARITY_SCORES = {'positive': 1.0, 'neutral': 0.0, 'negative': -1.0}
+
 class ModelType(Enum):
 	'''Enum to define the different type of sentiment analysis models supported in the project.
 	'''
@@ -30,7 +30,7 @@ class ModelType(Enum):
 class Model(object):
 	'''Represents the sentiment analysis model.
 	'''
-	def __init__(self, model_type, model_args):
+	def __init__(self, model_type, model_args, cache=None, download=False, workers=0):
 		'''Initializes a Model object.
 
 		Initializes a logger.
@@ -40,6 +40,9 @@ class Model(object):
 		Args:
 			model_type: A ModelType value to specify the type of sentiment analysis model to initialize.
 			model_args: Arguments for the respective sentiment analysis model.
+			cache: A PredictionCache (predictioncache.py) of text polarities, or None to classify every text.
+			download: Whether missing nltk data may be downloaded. Otherwise the network is never used.
+			workers: Number of worker processes running the model (inferencepool.py), or 0 to run it in this process.
 		'''
 		super(Model, self).__init__()
 
@@ -53,32 +56,47 @@ class Model(object):
 			ModelType.textblob: self.initialize_textblob,
 			ModelType.nltk: self.initialize_nltk
 		}
-		self.model = self.initialize_models[model_type](model_args)
-
-	def initialize_fastai(self, args):
+		if workers > 0:
+			# the workers load the model, this process only waits for their predictions
+			from inferencepool import InferencePool
+			self.model = InferencePool(model_type, model_args, workers, download)
+		else:
+			# only the backend of the selected model type is imported
+			backend = resources.import_backend(model_type)
+			resources.ensure_resources(model_type, model_args, backend, download)
+			self.model = self.initialize_models[model_type](backend, model_args)
+		# identifies the loaded model in prediction cache keys
+		self.model_identity = self.model.get_identity()
+		self.cache = cache
+
+	def initialize_fastai(self, fastai_inference, args):
 		'''Initializes the fastai classification model.
 
 		Args:
-			args: A dictionary: {'model_dir': Directory of the saved fastai model, 'model_name': File name of the saved fastai model}
+			fastai_inference: The fastai inference module.
+			args: A dictionary: {'model_dir': Directory of the saved fastai model, 'model_name': File name of the saved fastai model,
+				(optional) 'quantize': Whether to apply dynamic int8 quantization, (optional) 'num_threads': Number of torch threads}
 		'''
-		from src import inference as fastai_inference
-
-		fastai_inference.initialize_model(args['model_dir'], args['model_name'])
+		fastai_inference.initialize_model(args['model_dir'], args['model_name'], args.get('quantize', False), args.get('num_threads'))
 		return fastai_inference
 
-	def initialize_textblob(self, args):
+	def initialize_textblob(self, textblob_inference, args):
 		'''Initializes the textblob classification model.
-		'''
-		from src import textblob_inference
 
+		Args:
+			textblob_inference: The textblob inference module.
+			args: Unused.
+		'''
 		textblob_inference.initialize_model()
 		return textblob_inference
 
-	def initialize_nltk(self, args):
+	def initialize_nltk(self, nltk_inference, args):
 		'''Initializes the nltk sentiment intensity analysis model.
-		'''
-		from src import nltk_inference
 
+		Args:
+			nltk_inference: The nltk inference module.
+			args: Unused.
+		'''
 		nltk_inference.initialize_model()
 		return nltk_inference
 
@@ -91,27 +109,76 @@ class Model(object):
 		Args:
 			texts_weights: A List of tuples: [(text, weight of text), ...]
 		'''
-		score = 0.0
-		for text, weight in texts_weights:
-			if len(text) < 1:
-				continue
-
-			text_polarity = self.model.predict(text)
-			if text_polarity == 'positive':
-				score = 1.0 * weight + score
-			elif text_polarity == 'neutral':
-				score = 0.0 * weight + score
-			elif text_polarity == 'negative':
-				score = -1.0 * weight + score
-			else:
-				raise ValueError('Text Polarity predicted by model must be one of the following: "positive", "negative", "neutral"')
-
-		total_polarity = None
-		if score >= 0.5:
-			total_polarity = 'positive'
-		elif score > -0.5 and score < 0.5:
-			total_polarity = 'neutral'
-		elif score <= -0.5:
-			total_polarity = 'negative'
-
-		return self.POLARITY_LABELS[total_polarity]
+		return self.analyze_many([texts_weights])[0]
+
+	def analyze_many(self, texts_weights_list):
+		'''Returns the polarity labels after classifying the texts of several items, eg. mails.
+
+		Predicts the polarity of the texts of every item with a single batch.
+		Determines the overall polarity of each item through weighting.
+
+		Args:
+			texts_weights_list: A List of lists of tuples: [[(text, weight of text), ...], ...]
+		'''
+		texts = [text for texts_weights in texts_weights_list for text, weight in texts_weights if len(text) > 0]
+		text_polarities = iter(self.predict_many(texts))
+
+		polarity_labels = []
+		for texts_weights in texts_weights_list:
+			score = 0.0
+			for text, weight in texts_weights:
+				if len(text) < 1:
+					continue
+
+				text_polarity = next(text_polarities)
+				if text_polarity not in POLARITY_SCORES:
+					raise ValueError('Text Polarity predicted by model must be one of the following: "positive", "negative", "neutral"')
+				score = POLARITY_SCORES[text_polarity] * weight + score
+
+			polarity_labels.append(self.POLARITY_LABELS[get_total_polarity(score)])
+
+		return polarity_labels
+
+	def predict_many(self, texts):
+		'''Returns the polarity of each text, predicting only the texts which are not cached.
+
+		Args:
+			texts: List of texts to classify.
+		'''
+		if len(texts) == 0:
+			return []
+		if self.cache is None:
+			return self.model.predict_batch(texts)
+
+		polarities = self.cache.get_many(self.model_type, self.model_identity, texts)
+		# texts repeated within the batch are predicted once
+		uncached_texts = list(dict.fromkeys(text for text, polarity in zip(texts, polarities) if polarity is None))
+		if len(uncached_texts) > 0:
+			predicted = dict(zip(uncached_texts, self.model.predict_batch(uncached_texts)))
+			# the cache persists the new predictions in the background
+			self.cache.put_many(self.model_type, self.model_identity, uncached_texts, [predicted[text] for text in uncached_texts])
+			polarities = [predicted[text] if polarity is None else polarity for text, polarity in zip(texts, polarities)]
+
+		return polarities
+
+	def close(self):
+		'''Stops the worker processes of the model, if it runs in an inference pool.
+		'''
+		if hasattr(self.model, 'close'):
+			self.model.close()
+
+def get_total_polarity(score):
+	'''Returns the overall polarity for a weighted polarity score.
+
+	Args:
+		score: Sum of the weighted scores of the texts of an item.
+	'''
+	total_polarity = None
+	if score >= 0.5:
+		total_polarity = 'positive'
+	elif score > -0.5 and score < 0.5:
+		total_polarity = 'neutral'
+	elif score <= -0.5:
+		total_polarity = 'negative'
+
+	return total_polarity
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# This script provides reusable Gmail service objects for concurrent subscriber callbacks.
+# Credentials are held in memory and refreshed in the background, so building a service
+# no longer touches the token file.
+
+from googleapiclient.discovery import build
+from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.transport.requests import Request
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import logging
+import os.path
+import pickle
+import queue
+import threading
+
+SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+
+logger = logging.getLogger('mailsense.mail.servicepool')
+
+def load_credentials(credentials_path, token_path):
+	''' Returns valid Google API credentials for the Gmail API.
+		Makes use of a credentials and token file (separate).
+
+		Args:
+			credentials_path: Path to a file with Google API credentials.
+			token_path: Path to a pickle file with  user's access and refresh tokens.
+	'''
+	creds = None
+	# The file token.pickle stores the user's access and refresh tokens, and is
+	# created automatically when the authorization flow completes for the first
+	# time.
+	if os.path.exists(token_path):
+		with open(token_path, 'rb') as token:
+			creds = pickle.load(token)
+
+	# If there are no (valid) credentials available, let the user log in.
+	if not creds or not creds.valid:
+		if creds and creds.expired and creds.refresh_token:
+			creds.refresh(Request())
+		else:
+			flow = InstalledAppFlow.from_client_secrets_file(
+				credentials_path, SCOPES)
+			creds = flow.run_local_server()
+		# Save the credentials for the next run
+		save_credentials(creds, token_path)
+
+	return creds
+
+def save_credentials(creds, token_path):
+	'''Writes credentials to a pickle file.
+
+	Args:
+		creds: Google API credentials to save.
+		token_path: Path to a pickle file with  user's access and refresh tokens.
+	'''
+	with open(token_path, 'wb') as token:
+		pickle.dump(creds, token)
+
+def build_service(creds):
+	'''Returns a Gmail service object using in-memory credentials.
+
+	Args:
+		creds: Google API credentials.
+	'''
+	# the discovery document is bundled with the client since 2.0, avoid the file cache lookup
+	return build('gmail', 'v1', credentials=creds, cache_discovery=False)
+
+class CredentialHolder(object):
+	'''Holds Gmail API credentials in memory and keeps them fresh.
+
+	A background thread refreshes the access token shortly before it expires.
+	The token file is only written when the token has changed.
+	'''
+	def __init__(self, credentials_path, token_path, refresh_margin=300):
+		'''Initializes a CredentialHolder object.
+
+		Loads the credentials once, running the authorization flow if required.
+		Starts the background refresh thread.
+
+		Args:
+			credentials_path: Path to a file with Google API credentials.
+			token_path: Path to a pickle file with  user's access and refresh tokens.
+			refresh_margin: Seconds before expiry at which the access token is refreshed.
+		'''
+		super(CredentialHolder, self).__init__()
+		self.credentials_path = credentials_path
+		self.token_path = token_path
+		self.refresh_margin = refresh_margin
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+
+		self.creds = load_credentials(credentials_path, token_path)
+		self.saved_token = self.creds.token
+
+		self.refresh_thread = threading.Thread(target=self.run_refresh, name='mailsense-credentials', daemon=True)
+		self.refresh_thread.start()
+
+	def get(self):
+		'''Returns the shared credentials object.
+		'''
+		return self.creds
+
+	def refresh(self):
+		'''Refreshes the access token and saves it if it has changed.
+		'''
+		with self.lock:
+			if self.creds.refresh_token:
+				self.creds.refresh(Request())
+			self.save_if_changed()
+
+	def save_if_changed(self):
+		'''Writes the token file if the in-memory token differs from the last saved one.
+
+		The token may also have been refreshed by a service object on an expired request.
+		'''
+		if self.creds.token != self.saved_token:
+			save_credentials(self.creds, self.token_path)
+			self.saved_token = self.creds.token
+			logger.info('saved refreshed credentials to %s', self.token_path)
+
+	def seconds_until_refresh(self):
+		'''Returns the number of seconds to wait before the next refresh.
+		'''
+		expiry = self.creds.expiry
+		if expiry is None:
+			return self.refresh_margin
+
+		remaining = expiry - datetime.utcnow() - timedelta(seconds=self.refresh_margin)
+		return max(remaining.total_seconds(), 0)
+
+	def run_refresh(self):
+		'''Refreshes the credentials in the background until stopped.
+		'''
+		while not self.stopped.wait(self.seconds_until_refresh()):
+			try:
+				self.refresh()
+			except Exception as e:
+				logger.error('failed to refresh credentials', exc_info=True)
+				# avoid a busy loop while the token endpoint is unavailable
+				self.stopped.wait(self.refresh_margin / 10)
+
+	def stop(self):
+		'''Stops the background refresh thread and saves the latest token.
+		'''
+		self.stopped.set()
+		with self.lock:
+			self.save_if_changed()
+
+class ServicePool(object):
+	'''A thread-safe pool of Gmail service objects.
+
+	Service objects are not thread safe, so each one is checked out by a single thread at a time.
+	Services are built lazily, up to the size of the pool, and reused afterwards.
+	'''
+	def __init__(self, credential_holder, size=10, build=build_service):
+		'''Initializes a ServicePool object.
+
+		Args:
+			credential_holder: A CredentialHolder providing the shared credentials.
+			size: Maximum number of service objects in the pool.
+			build: Function building a service object from the credentials, eg. a fake Gmail service for benchmarks.
+		'''
+		super(ServicePool, self).__init__()
+		if size < 1:
+			raise ValueError('service pool size must be at least 1')
+
+		self.credential_holder = credential_holder
+		self.size = size
+		self.build = build
+		self.idle = queue.LifoQueue()
+		self.created = 0
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		'''Returns a service object, building one if none are idle and the pool is not full.
+
+		Blocks until a service object is returned to the pool otherwise.
+		'''
+		try:
+			return self.idle.get_nowait()
+		except queue.Empty:
+			pass
+
+		with self.lock:
+			can_build = self.created < self.size
+			if can_build:
+				self.created = self.created + 1
+
+		if can_build:
+			try:
+				return self.build(self.credential_holder.get())
+			except Exception:
+				with self.lock:
+					self.created = self.created - 1
+				raise
+
+		return self.idle.get()
+
+	def release(self, service):
+		'''Returns a service object to the pool.
+
+		Args:
+			service: A service object obtained from acquire.
+		'''
+		self.idle.put(service)
+
+	@contextmanager
+	def borrow(self):
+		'''Context manager which checks out a service object for the duration of the block.
+		'''
+		service = self.acquire()
+		try:
+			yield service
+		finally:
+			self.release(service)
+
+	def close(self):
+		'''Stops refreshing the credentials used by the pool.
+		'''
+		self.credential_holder.stop()
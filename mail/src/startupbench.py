@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# This script benchmarks the startup cost of each sentiment analysis backend.
+# Every measurement runs in a fresh interpreter, so that module imports are not shared between runs.
+
+import argparse
+import ast
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+def measure(model_type_name, model_args):
+	'''Returns a dictionary of the seconds taken to import and to initialize a backend, in the current interpreter.
+
+	Args:
+		model_type_name: Name of the ModelType (sentimentanalysis.py) of the backend.
+		model_args: The arguments for the respective sentiment analysis model.
+	'''
+	start = time.perf_counter()
+	import resources
+	from sentimentanalysis import Model, ModelType
+	model_type = ModelType[model_type_name]
+	resources.import_backend(model_type)
+	imported = time.perf_counter()
+	# the backend module is already imported, only its initialization is measured
+	Model(model_type, model_args)
+	initialized = time.perf_counter()
+
+	return {'import_seconds': imported - start, 'initialize_seconds': initialized - imported}
+
+def run_measurement(model_type_name, model_args):
+	'''Returns the measurement of a backend run in a fresh interpreter, or a dictionary with its error.
+
+	Args:
+		model_type_name: Name of the ModelType (sentimentanalysis.py) of the backend.
+		model_args: The arguments for the respective sentiment analysis model.
+	'''
+	command = [sys.executable, __file__, '--child', '-mt', model_type_name, '-ma', repr(model_args)]
+	completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+	if completed.returncode != 0:
+		return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'exit code ' + str(completed.returncode)}
+	return json.loads(completed.stdout.strip().splitlines()[-1])
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='benchmark the import and initialization cost of the sentiment analysis backends')
+	parser.add_argument('-mt', '--modeltypes', help='string: comma separated model types to benchmark', type=str, action='store', default='nltk,textblob,fastai')
+	parser.add_argument('-ma', '--modelargs', help='dict: model type as key, arguments to initialize the respective model as value', type=ast.literal_eval, action='store', default={})
+	parser.add_argument('-r', '--runs', help='int: number of runs per model type', type=int, action='store', default=3)
+	parser.add_argument('-op', '--outputpath', help='string: path to output json file with the measurements', type=str, action='store', required=False)
+	parser.add_argument('--child', help=argparse.SUPPRESS, action='store_true')
+	args = parser.parse_args()
+
+	if args.child:
+		# a single measurement, model args are those of the measured model type
+		print(json.dumps(measure(args.modeltypes, args.modelargs)))
+		sys.exit(0)
+
+	results = {}
+	for model_type_name in args.modeltypes.split(','):
+		runs = [run_measurement(model_type_name, args.modelargs.get(model_type_name)) for i in range(args.runs)]
+		errors = [run['error'] for run in runs if 'error' in run]
+		if len(errors) > 0:
+			results[model_type_name] = {'error': errors[0]}
+			print('{mt}: failed: {e}'.format(mt=model_type_name, e=errors[0]))
+			continue
+
+		results[model_type_name] = {
+			'runs': runs,
+			'import_seconds_median': statistics.median(run['import_seconds'] for run in runs),
+			'initialize_seconds_median': statistics.median(run['initialize_seconds'] for run in runs)
+		}
+		print('{mt}: import {i:.3f}s, initialize {n:.3f}s (median of {r} runs)'.format(mt=model_type_name, i=results[model_type_name]['import_seconds_median'], n=results[model_type_name]['initialize_seconds_median'], r=args.runs))
+
+	if args.outputpath is not None:
+		with open(args.outputpath, 'w') as f:
+			json.dump(results, f, indent=2)
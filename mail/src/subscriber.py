@@ -8,49 +8,188 @@ from google.cloud import pubsub_v1
 import time
 import argparse
 import ast
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
 import os
 import sys
 
 import mail
+from servicepool import CredentialHolder, ServicePool
 from watch import watch
 from sentimentanalysis import ModelType
 from sentimentanalysis import MODEL_ARGUMENT_CHOICES
 
-def callback(message):
+logger = logging.getLogger('mailsense.mail.subscriber')
+
+def callback(message, process_message=mail.process_message):
 	'''Receives a Gmail subscription message and processes it.
 
-	Acknowledges the message.
-	Creates a service object to access the Gmail API, to process the message.
-	Uses mail to process the message.
+	Uses mail to process the message, together with other messages arriving close to it.
+	Acknowledges the message once every new mail has been labeled.
+	Otherwise the message is not acknowledged, so that it is delivered again and the remaining mails are synced again.
+	While the message is processed, the subscriber client extends its lease, up to the maximum lease duration.
 
 	Args:
 		message: A Gmail subscription message
+		process_message: Function processing the message, eg. Account.process_message (accounts.py) when serving several accounts.
+	'''
+	try:
+		processed = process_message(message)
+	except Exception as e:
+		logger.error('failed to process message %s', message.message_id, exc_info=True)
+		processed = False
+
+	if processed:
+		message.ack()
+	else:
+		message.nack()
+
+def async_callback(pipeline, message):
+	'''Receives a Gmail subscription message and queues it to be processed by the asyncio pipeline.
+
+	Returns without waiting for the message to be processed, so that callback threads are not held.
+	The pipeline acknowledges the message once every new mail has been labeled.
+
+	Args:
+		pipeline: A running AsyncPipeline (asyncpipeline.py).
+		message: A Gmail subscription message
+	'''
+	try:
+		pipeline.submit(mail.get_message_history_id(message), message)
+	except Exception as e:
+		logger.error('failed to queue message %s', message.message_id, exc_info=True)
+		message.nack()
+
+def get_flow_control(max_messages, max_bytes, max_lease_duration):
+	'''Returns the flow control settings of the subscriber client.
+
+	Messages beyond the limits are left in the subscription, so that a burst waits upstream instead of in memory.
+
+	Args:
+		max_messages: Maximum number of messages received but not acknowledged yet.
+		max_bytes: Maximum total size of the messages received but not acknowledged yet.
+		max_lease_duration: Maximum number of seconds the lease of a message is extended for while it is processed.
 	'''
-	# respond with acknowledgement, otherwise the message will keep being received
-	message.ack()
+	return pubsub_v1.types.FlowControl(max_messages=max_messages, max_bytes=max_bytes, max_lease_duration=max_lease_duration)
 
-	# create a new service object every time because it is not thread safe
-	service = mail.get_service(args.credentialspath, args.tokenpath)
-	mail.process_message(service, message)
+def get_scheduler(callback_threads):
+	'''Returns a scheduler running the subscriber callbacks in a fixed number of threads.
+
+	Args:
+		callback_threads: Number of threads running callbacks.
+	'''
+	executor = ThreadPoolExecutor(max_workers=callback_threads, thread_name_prefix='mailsense-callback')
+	return pubsub_v1.subscriber.scheduler.ThreadScheduler(executor)
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='process arguments required for subscriber and mail functionality')
 	parser.add_argument('-p', '--project', help='string: name of the project from Google Cloud', type=str, action='store', required=True)
-	parser.add_argument('-s', '--subscription', help='string: name of the subscription from Google Cloud', type=str, action='store', required=True)
-	parser.add_argument('-t', '--topic', help='string: name of the topic from Google Cloud', type=str, action='store', required=True)
+	parser.add_argument('-s', '--subscription', help='string: name of the subscription from Google Cloud, required unless -ac is given', type=str, action='store', required=False)
+	parser.add_argument('-t', '--topic', help='string: name of the topic from Google Cloud, required unless -ac is given', type=str, action='store', required=False)
 	parser.add_argument('-mt', '--modeltype', help='string: the type of model to initialize', type=lambda model: ModelType[model], choices=list(ModelType), action='store', required=True)
 	parser.add_argument('-ma', '--modelargs', help='dict: the arguments to initialize the respective model. Arguments required for the various model types: ' + str(MODEL_ARGUMENT_CHOICES), type=ast.literal_eval, action='store', required=False)
+	parser.add_argument('-dl', '--download', help='download missing nltk data required by the model, otherwise the network is not used to load the model', action='store_true')
 	parser.add_argument('-cp', '--credentialspath', help='string: path to Gmail API credentials file', type=str, action='store', required=True)
-	parser.add_argument('-tp', '--tokenpath', help='string: path to Gmail API token file', type=str, action='store', required=True)
+	parser.add_argument('-tp', '--tokenpath', help='string: path to Gmail API token file, required unless -ac is given', type=str, action='store', required=False)
+	parser.add_argument('-hp', '--historypath', help='string: path to the file storing the last fully processed Gmail history id', type=str, action='store', default='mailsense.history')
+	parser.add_argument('-lw', '--labelwindow', help='float: seconds for which label assignments are buffered before being applied together', type=float, action='store', default=0.5)
+	parser.add_argument('-lb', '--labelbatchsize', help='int: number of buffered label assignments which triggers applying them immediately (at most 1000 per request)', type=int, action='store', default=1000)
+	parser.add_argument('-cw', '--coalescewindow', help='float: seconds without a new message after which coalesced messages are processed together', type=float, action='store', default=0.05)
+	parser.add_argument('-cm', '--coalescemaxwait', help='float: maximum number of seconds messages are coalesced for', type=float, action='store', default=0.2)
+	parser.add_argument('-cs', '--cachesize', help='int: maximum number of cached text polarity predictions, 0 to disable the cache', type=int, action='store', default=10000)
+	parser.add_argument('-cdb', '--cachepath', help='string: path to a SQLite file to persist cached predictions to', type=str, action='store', required=False)
+	parser.add_argument('-sp', '--servicepoolsize', help='int: maximum number of Gmail service objects shared by callbacks', type=int, action='store', default=10)
+	parser.add_argument('-iw', '--inferenceworkers', help='int: number of worker processes running the model, 0 to run it in the callback threads', type=int, action='store', default=0)
+	parser.add_argument('-ap', '--asyncpipeline', help='process messages with the asyncio pipeline instead of in the callback threads', action='store_true')
+	parser.add_argument('-hc', '--httpconnections', help='int: maximum number of HTTP connections to Gmail shared by the asyncio pipeline', type=int, action='store', default=100)
+	parser.add_argument('-fc', '--fetchconcurrency', help='int: number of batch requests fetching mails at the same time in the asyncio pipeline, each for up to 50 mails', type=int, action='store', default=50)
+	parser.add_argument('-ic', '--inferenceconcurrency', help='int: number of mail batches classified at the same time by the asyncio pipeline', type=int, action='store', default=2)
+	parser.add_argument('-lc', '--labelconcurrency', help='int: number of label batches applied at the same time by the asyncio pipeline', type=int, action='store', default=1)
+	parser.add_argument('-qs', '--queuesize', help='int: maximum number of mails waiting for each stage of the asyncio pipeline', type=int, action='store', default=1000)
+	parser.add_argument('-fm', '--flowmaxmessages', help='int: maximum number of messages being processed, further messages wait in the subscription', type=int, action='store', default=100)
+	parser.add_argument('-fb', '--flowmaxbytes', help='int: maximum total size in bytes of the messages being processed', type=int, action='store', default=10 * 1024 * 1024)
+	parser.add_argument('-ml', '--maxlease', help='int: maximum number of seconds the lease of a message is extended for while it is processed', type=int, action='store', default=3600)
+	parser.add_argument('-ct', '--callbackthreads', help='int: number of threads running subscriber callbacks, each processing a message at a time unless the asyncio pipeline is used', type=int, action='store', default=10)
+	parser.add_argument('-mp', '--metricsport', help='int: port serving the stage latencies, API calls, queue depths and cache hit rates in the Prometheus text format, 0 to not serve them', type=int, action='store', default=0)
+	parser.add_argument('-mh', '--metricshost', help='string: host serving the metrics', type=str, action='store', default='127.0.0.1')
+	parser.add_argument('-mri', '--metricsrollupinterval', help='int: seconds between rollups of the metrics into mailsense.db, 0 to not roll them up', type=int, action='store', default=0)
+	parser.add_argument('-ac', '--accountspath', help='string: path to a json file of Gmail accounts to serve with one shared model, instead of the account of -tp, -s and -t', type=str, action='store', required=False)
+	parser.add_argument('-iq', '--inferencequantum', help='int: number of mails of an account classified per turn when several accounts are served', type=int, action='store', default=64)
 	args = parser.parse_args()
 
+	if args.accountspath is None and (args.subscription is None or args.topic is None or args.tokenpath is None):
+		parser.error('-s, -t and -tp are required unless -ac is given')
+
 	subscriber = pubsub_v1.SubscriberClient()
+
+	if args.accountspath is not None:
+		from accounts import Account, load_accounts
+		from fairinference import FairInference
+
+		log_dir = os.path.join(os.path.dirname(__file__), '../logs')
+		if not os.path.exists(log_dir):
+			os.makedirs(log_dir)
+		log_path = log_dir + '/mail.log'
+
+		accounts = []
+		try:
+			accounts_settings = load_accounts(args.accountspath, {'project': args.project, 'credentialspath': args.credentialspath})
+			# the model is loaded once, only the connection state is kept per account
+			mail.start_shared(log_path, args.modeltype, args.modelargs, args.cachesize, args.cachepath, args.download, args.inferenceworkers, metrics_port=args.metricsport, metrics_host=args.metricshost, rollup_interval=args.metricsrollupinterval)
+			inference = FairInference(mail.model, args.inferencequantum, args.inferenceworkers)
+			for name, settings in accounts_settings.items():
+				service_pool = ServicePool(CredentialHolder(settings['credentialspath'], settings['tokenpath']), args.servicepoolsize)
+				with service_pool.borrow() as service:
+					watch(service, settings['project'], settings['topic'])
+				accounts.append(Account(name, service_pool, settings['historypath'], inference, settings['weight'], args.labelwindow, args.labelbatchsize, args.coalescewindow, args.coalescemaxwait))
+		except Exception as e:
+			print('The following error occurred when initializing the accounts:\n' + str(e) + '\nPlease check ' + log_path + ' for more information')
+			sys.exit(1)
+
+		loop, pipelines = None, []
+		if args.asyncpipeline:
+			from asyncpipeline import AsyncPipeline
+
+			# the pipelines of every account run in one event loop
+			loop = asyncio.get_event_loop()
+			for account in accounts:
+				pipeline = AsyncPipeline(account.service_pool.credential_holder, account.history_sync, account.label_cache, account.analyze_many, mail.mail_stats, account.name, args.httpconnections, args.fetchconcurrency, args.inferenceconcurrency, args.labelconcurrency, args.queuesize, label_window=args.labelwindow, coalesce_window=args.coalescewindow, coalesce_max_wait=args.coalescemaxwait)
+				loop.run_until_complete(pipeline.start())
+				pipelines.append(pipeline)
+
+		streaming_pull_futures = []
+		for i, account in enumerate(accounts):
+			settings = accounts_settings[account.name]
+			subscription_path = subscriber.subscription_path(settings['project'], settings['subscription'])
+			account_callback = functools.partial(async_callback, pipelines[i]) if args.asyncpipeline else functools.partial(callback, process_message=account.process_message)
+			# every account has its own flow control and callback threads, so a busy account cannot hold those of the others
+			streaming_pull_futures.append(subscriber.subscribe(subscription_path, callback=account_callback, flow_control=get_flow_control(args.flowmaxmessages, args.flowmaxbytes, args.maxlease), scheduler=get_scheduler(args.callbackthreads)))
+			print('Listening for messages of {} on {}'.format(account.name, subscription_path))
+		try:
+			if loop is not None:
+				loop.run_forever()
+			while True:
+				time.sleep(60)
+		except KeyboardInterrupt:
+			for streaming_pull_future in streaming_pull_futures:
+				streaming_pull_future.cancel()
+			for pipeline in pipelines:
+				loop.run_until_complete(pipeline.stop())
+			inference.close()
+			for account in accounts:
+				account.close()
+			mail.stop_shared()
+		sys.exit(0)
 	# The `subscription_path` method creates a fully qualified identifier
 	# in the form `projects/{project_id}/subscriptions/{subscription_name}`
 	subscription_path = subscriber.subscription_path(args.project, args.subscription)
 
-	service = mail.get_service(args.credentialspath, args.tokenpath)
-	watch(service, args.project, args.topic)
+	credential_holder = CredentialHolder(args.credentialspath, args.tokenpath)
+	service_pool = ServicePool(credential_holder, args.servicepoolsize)
+	with service_pool.borrow() as service:
+		watch(service, args.project, args.topic)
 
 	log_dir = os.path.join(os.path.dirname(__file__), '../logs')
 	if not os.path.exists(log_dir):
@@ -60,14 +199,37 @@ if __name__ == '__main__':
 	log_path = log_dir + '/' + MAIL_LOG_NAME
 	try:
 		# perform mail initialization tasks
-		mail.start(args.modeltype, args.modelargs, log_path)
+		mail.start(args.modeltype, args.modelargs, log_path, service_pool, args.historypath, args.labelwindow, args.labelbatchsize, args.coalescewindow, args.coalescemaxwait, args.cachesize, args.cachepath, args.download, args.inferenceworkers, metrics_port=args.metricsport, metrics_host=args.metricshost, rollup_interval=args.metricsrollupinterval)
 	except Exception as e:
 		print('The following error occurred when initializing mail:\n' + str(e) + '\nPlease check ' + log_path + ' for more information')
 		sys.exit(1)
 
-	subscriber.subscribe(subscription_path, callback=callback)
+	flow_control = get_flow_control(args.flowmaxmessages, args.flowmaxbytes, args.maxlease)
+	if args.asyncpipeline:
+		from asyncpipeline import AsyncPipeline
+
+		loop = asyncio.get_event_loop()
+		pipeline = AsyncPipeline(credential_holder, mail.history_sync, mail.label_cache, mail.model.analyze_many, mail.mail_stats, None, args.httpconnections, args.fetchconcurrency, args.inferenceconcurrency, args.labelconcurrency, args.queuesize, label_window=args.labelwindow, coalesce_window=args.coalescewindow, coalesce_max_wait=args.coalescemaxwait)
+		loop.run_until_complete(pipeline.start())
+		streaming_pull_future = subscriber.subscribe(subscription_path, callback=functools.partial(async_callback, pipeline), flow_control=flow_control, scheduler=get_scheduler(args.callbackthreads))
+		print('Listening for messages on {} with the asyncio pipeline'.format(subscription_path))
+		try:
+			loop.run_forever()
+		except KeyboardInterrupt:
+			streaming_pull_future.cancel()
+			loop.run_until_complete(pipeline.stop())
+			mail.stop()
+			service_pool.close()
+		sys.exit(0)
+
+	streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback, flow_control=flow_control, scheduler=get_scheduler(args.callbackthreads))
 	# The subscriber is non-blocking. We must keep the main thread from
 	# exiting to allow it to process messages asynchronously in the background.
 	print('Listening for messages on {}'.format(subscription_path))
-	while True:
-		time.sleep(60)
+	try:
+		while True:
+			time.sleep(60)
+	except KeyboardInterrupt:
+		streaming_pull_future.cancel()
+		mail.stop()
+		service_pool.close()
@@ -0,0 +1,34 @@
+# Shared fixtures of the mail tests, run against a fake Gmail inbox (fakegmail.py) rather than a Google account.
+
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+import fakegmail
+import mail
+from metrics import metrics
+from servicepool import ServicePool
+
+@pytest.fixture
+def mailbox():
+	return fakegmail.FakeMailbox()
+
+@pytest.fixture
+def service_pool(mailbox):
+	pool = ServicePool(fakegmail.FakeCredentialHolder(), 4, build=lambda creds: fakegmail.FakeGmailService(mailbox))
+	yield pool
+	pool.close()
+
+@pytest.fixture
+def mail_globals(monkeypatch, tmp_path):
+	'''Sets the module globals of mail which process_history needs, as start_shared would.
+	'''
+	mail_stats = metrics(db_name=str(tmp_path / 'mailsense.db'))
+	monkeypatch.setattr(mail, 'logger', logging.getLogger('mailsense.mail.mail'), raising=False)
+	monkeypatch.setattr(mail, 'mail_stats', mail_stats, raising=False)
+	yield
+	mail_stats.close()
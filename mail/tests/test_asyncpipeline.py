@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+
+from asyncpipeline import AsyncGmailClient, AsyncPipeline
+from fakegmail import FakeCredentialHolder, FakeGmailServer
+from history import HistoryCursor, HistorySync
+from labels import LabelCache
+import mail
+
+@pytest.fixture
+def server(mailbox):
+	server = FakeGmailServer(mailbox)
+	server.start()
+	yield server
+	server.stop()
+
+def get_mails(server, mail_ids):
+	async def run():
+		client = AsyncGmailClient(FakeCredentialHolder(), base_url=server.base_url)
+		await client.open()
+		try:
+			return await client.get_mails(mail_ids)
+		finally:
+			await client.close()
+	return asyncio.run(run())
+
+def test_mails_are_fetched_with_one_batch_request(mailbox, server):
+	mail_ids = [mailbox.deliver('subject {i}'.format(i=i), 'snippet é {i}'.format(i=i))[0] for i in range(3)]
+	requests = mailbox.stats()['requests']
+
+	mail_objs, mail_errors = get_mails(server, mail_ids)
+	assert mailbox.stats()['requests'] == requests + 1
+	assert mail_errors == {}
+	assert sorted(mail_objs) == sorted(mail_ids)
+	assert mail_objs[mail_ids[2]]['snippet'] == 'snippet é 2'
+
+def test_mail_which_could_not_be_fetched_is_reported_with_its_status(mailbox, server):
+	found_id, found_history_id = mailbox.deliver('subject', 'snippet')
+	missing_id, missing_history_id = mailbox.deliver('subject', 'snippet')
+	mailbox.mails.pop(missing_id)
+
+	mail_objs, mail_errors = get_mails(server, [found_id, missing_id])
+	assert list(mail_objs) == [found_id]
+	assert list(mail_errors) == [missing_id]
+	assert mail_errors[missing_id].resp.status == 404
+
+class FakeMessage(object):
+	'''A Gmail subscription message recording whether it was acknowledged.
+	'''
+
+	def __init__(self):
+		self.acked = None
+
+	def ack(self):
+		self.acked = True
+
+	def nack(self):
+		self.acked = False
+
+@pytest.fixture
+def inbox(tmp_path, service_pool, mail_globals):
+	'''Returns a tuple of the HistorySync and LabelCache of the fake inbox.
+	'''
+	label_cache = LabelCache()
+	with service_pool.borrow() as service:
+		label_cache.warm(service, ['positive'])
+		history_sync = HistorySync(HistoryCursor(str(tmp_path / 'mailsense.history')))
+		history_sync.seed(service)
+	return history_sync, label_cache
+
+def analyze_many(texts_weights_list):
+	return ['positive'] * len(texts_weights_list)
+
+def process_history(server, inbox, history_id, analyze_many=analyze_many):
+	'''Processes a notification with an asyncio pipeline and returns whether its message was acknowledged.
+	'''
+	history_sync, label_cache = inbox
+	message = FakeMessage()
+	async def run():
+		pipeline = AsyncPipeline(FakeCredentialHolder(), history_sync, label_cache, analyze_many, mail.mail_stats, label_window=0.01, coalesce_window=0.01, base_url=server.base_url)
+		await pipeline.start()
+		pipeline.submit(history_id, message)
+		await asyncio.sleep(0.05)
+		await pipeline.stop(5)
+		assert pipeline.is_idle()
+	asyncio.run(run())
+	return message.acked
+
+def test_deleted_mail_does_not_hold_the_cursor(mailbox, server, inbox):
+	history_sync, label_cache = inbox
+	deleted_id, deleted_history_id = mailbox.deliver('subject', 'snippet')
+	labeled_id, labeled_history_id = mailbox.deliver('subject', 'snippet')
+	del mailbox.mails[deleted_id]
+
+	assert process_history(server, inbox, labeled_history_id)
+	assert labeled_id in mailbox.labeled_at
+	assert history_sync.cursor.get() == labeled_history_id
+
+def test_mail_without_texts_does_not_hold_the_cursor(mailbox, server, inbox):
+	history_sync, label_cache = inbox
+	mail_id, history_id = mailbox.deliver('subject', 'snippet')
+	del mailbox.mails[mail_id]['snippet']
+
+	assert process_history(server, inbox, history_id)
+	assert history_sync.cursor.get() == history_id
+
+def test_unexpected_failure_of_a_stage_fails_the_mails_of_its_group(mailbox, server, inbox):
+	history_sync, label_cache = inbox
+	seed_history_id = history_sync.cursor.get()
+	mail_id, history_id = mailbox.deliver('subject', 'snippet')
+	def analyze_many_returning_nothing(texts_weights_list):
+		# the mails cannot be zipped with no labels, which fails the stage outside of its handled errors
+		return None
+
+	assert process_history(server, inbox, history_id, analyze_many_returning_nothing) is False
+	assert mail_id not in mailbox.labeled_at
+	assert history_sync.cursor.get() == seed_history_id
+
+	assert process_history(server, inbox, history_id)
+	assert mail_id in mailbox.labeled_at
+	assert history_sync.cursor.get() == history_id
+
+def test_mail_deleted_before_being_labeled_does_not_hold_the_cursor(mailbox, server, inbox):
+	history_sync, label_cache = inbox
+	deleted_id, deleted_history_id = mailbox.deliver('subject', 'snippet')
+	labeled_id, labeled_history_id = mailbox.deliver('subject', 'snippet')
+	def analyze_many_deleting(texts_weights_list):
+		mailbox.mails.pop(deleted_id, None)
+		return analyze_many(texts_weights_list)
+
+	assert process_history(server, inbox, labeled_history_id, analyze_many_deleting)
+	assert list(mailbox.labeled_at) == [labeled_id]
+	assert history_sync.cursor.get() == labeled_history_id
+
+def test_notification_covered_by_the_cursor_is_acknowledged_without_a_history_scan(mailbox, server, inbox):
+	history_sync, label_cache = inbox
+	mail_id, history_id = mailbox.deliver('subject', 'snippet')
+	assert process_history(server, inbox, history_id)
+	calls = mailbox.stats()['calls']['history.list']
+
+	assert process_history(server, inbox, history_id)
+	assert mailbox.stats()['calls']['history.list'] == calls
@@ -0,0 +1,57 @@
+import threading
+
+from coalesce import NotificationCoalescer
+from history import HistoryCursor
+
+def submit_all(coalescer, history_ids):
+	'''Submits notifications from concurrent threads and returns their results, or exceptions, in order.
+	'''
+	results = [None] * len(history_ids)
+	def submit(i):
+		try:
+			results[i] = coalescer.submit(history_ids[i])
+		except Exception as e:
+			results[i] = e
+	threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(history_ids))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join(5)
+	return results
+
+def test_burst_is_processed_once_from_its_minimum_history_id():
+	processed = []
+	def process(history_id, notifications):
+		processed.append((history_id, notifications))
+		return True
+	coalescer = NotificationCoalescer(process, window=0.2, max_wait=1)
+
+	assert submit_all(coalescer, [1007, 1003, '1005']) == [True, True, True]
+	assert processed == [(1003, 3)]
+
+	assert coalescer.submit(1010)
+	assert processed == [(1003, 3), (1010, 1)]
+
+def test_failure_of_a_group_is_raised_to_every_notification():
+	def process(history_id, notifications):
+		raise RuntimeError('history scan failed')
+	coalescer = NotificationCoalescer(process, window=0.2, max_wait=1)
+
+	results = submit_all(coalescer, [1001, 1002])
+	assert all(isinstance(result, RuntimeError) for result in results)
+
+def test_group_covered_by_the_cursor_is_not_processed(tmp_path):
+	cursor = HistoryCursor(str(tmp_path / 'mailsense.history'))
+	cursor.commit(1005)
+	processed = []
+	def process(history_id, notifications):
+		processed.append((history_id, notifications))
+		return False
+	coalescer = NotificationCoalescer(process, window=0.2, max_wait=1, cursor=cursor)
+
+	assert submit_all(coalescer, [1004, 1005]) == [True, True]
+	assert processed == []
+
+	# a single newer notification makes the group be scanned
+	assert submit_all(coalescer, [1004, 1006]) == [False, False]
+	assert processed == [(1004, 2)]
@@ -0,0 +1,165 @@
+import threading
+
+import pytest
+
+from history import HistoryCursor, HistorySync
+from labels import LabelBatcher, LabelCache
+import mail
+
+def test_cursor_is_persisted_and_only_advances(tmp_path):
+	path = str(tmp_path / 'mailsense.history')
+	cursor = HistoryCursor(path)
+	assert cursor.get() is None
+
+	cursor.commit(1005)
+	cursor.commit(1003)
+	assert cursor.get() == 1005
+	assert HistoryCursor(path).get() == 1005
+
+	cursor.commit(1001, force=True)
+	assert HistoryCursor(path).get() == 1001
+
+def test_sync_claims_each_mail_once(tmp_path, mailbox, service_pool):
+	history_sync = HistorySync(HistoryCursor(str(tmp_path / 'mailsense.history')))
+	with service_pool.borrow() as service:
+		history_sync.seed(service)
+		first_id, first_history_id = mailbox.deliver('subject', 'snippet')
+		mail_ids, synced_history_id, sequence = history_sync.sync(service, first_history_id)
+		assert mail_ids == [first_id]
+
+		second_id, second_history_id = mailbox.deliver('subject', 'snippet')
+		# the cursor has not advanced, so the first mail is listed again but not claimed again
+		overlapping_ids, overlapping_history_id, overlapping_sequence = history_sync.sync(service, second_history_id)
+		assert overlapping_ids == [second_id]
+
+	history_sync.complete(sequence)
+	history_sync.complete(overlapping_sequence)
+	assert history_sync.cursor.get() == second_history_id
+
+def test_cursor_does_not_skip_mails_of_an_earlier_failed_sync(tmp_path, mailbox, service_pool):
+	path = str(tmp_path / 'mailsense.history')
+	history_sync = HistorySync(HistoryCursor(path))
+	with service_pool.borrow() as service:
+		history_sync.seed(service)
+		seed_history_id = history_sync.cursor.get()
+		failed_id, failed_history_id = mailbox.deliver('subject', 'snippet')
+		failed_ids, synced_history_id, failed_sequence = history_sync.sync(service, failed_history_id)
+		later_id, later_history_id = mailbox.deliver('subject', 'snippet')
+		later_ids, synced_history_id, later_sequence = history_sync.sync(service, later_history_id)
+		assert (failed_ids, later_ids) == ([failed_id], [later_id])
+
+		# the later sync completes first, and must wait for the earlier one
+		history_sync.complete(later_sequence)
+		assert history_sync.cursor.get() == seed_history_id
+		history_sync.complete(failed_sequence, failed_ids)
+		assert HistoryCursor(path).get() == seed_history_id
+
+		# after a restart, the failed mail is listed again
+		history_sync = HistorySync(HistoryCursor(path))
+		retried_ids, synced_history_id, retried_sequence = history_sync.sync(service, later_history_id)
+		assert retried_ids == [failed_id, later_id]
+		history_sync.complete(retried_sequence)
+		assert HistoryCursor(path).get() == later_history_id
+
+@pytest.fixture
+def inbox(tmp_path, service_pool, mail_globals):
+	'''Returns a tuple of the HistorySync and LabelBatcher of the fake inbox.
+	'''
+	label_cache = LabelCache()
+	with service_pool.borrow() as service:
+		label_cache.warm(service, ['positive'])
+		history_sync = HistorySync(HistoryCursor(str(tmp_path / 'mailsense.history')))
+		history_sync.seed(service)
+	label_batcher = LabelBatcher(service_pool, label_cache, 0.01)
+	yield history_sync, label_batcher
+	label_batcher.close()
+
+def analyze_many(texts_weights_list):
+	return ['positive'] * len(texts_weights_list)
+
+def test_overlapping_groups_do_not_skip_the_mails_of_a_failed_group(mailbox, service_pool, inbox):
+	history_sync, label_batcher = inbox
+	seed_history_id = history_sync.cursor.get()
+	failing = threading.Event()
+	fail = threading.Event()
+	def analyze_many_failing(texts_weights_list):
+		failing.set()
+		fail.wait(5)
+		raise RuntimeError('inference failed')
+
+	failed_id, failed_history_id = mailbox.deliver('subject', 'snippet')
+	errors = []
+	def process_failing_group():
+		try:
+			mail.process_history(service_pool, history_sync, label_batcher, analyze_many_failing, failed_history_id)
+		except RuntimeError as e:
+			errors.append(e)
+	failing_group = threading.Thread(target=process_failing_group)
+	failing_group.start()
+	assert failing.wait(5)
+
+	later_id, later_history_id = mailbox.deliver('subject', 'snippet')
+	assert mail.process_history(service_pool, history_sync, label_batcher, analyze_many, later_history_id)
+	assert history_sync.cursor.get() == seed_history_id
+
+	fail.set()
+	failing_group.join(5)
+	assert len(errors) == 1
+	assert history_sync.cursor.get() == seed_history_id
+	assert failed_id not in mailbox.labeled_at
+
+	# the next notification labels the failed mail and advances the cursor
+	assert mail.process_history(service_pool, history_sync, label_batcher, analyze_many, later_history_id)
+	assert failed_id in mailbox.labeled_at and later_id in mailbox.labeled_at
+	assert history_sync.cursor.get() == later_history_id
+
+def test_deleted_mail_does_not_hold_the_cursor(mailbox, service_pool, inbox):
+	history_sync, label_batcher = inbox
+	deleted_id, deleted_history_id = mailbox.deliver('subject', 'snippet')
+	labeled_id, labeled_history_id = mailbox.deliver('subject', 'snippet')
+	# the mail is deleted between the history listing it and its retrieval
+	del mailbox.mails[deleted_id]
+
+	assert mail.process_history(service_pool, history_sync, label_batcher, analyze_many, labeled_history_id)
+	assert labeled_id in mailbox.labeled_at
+	assert history_sync.cursor.get() == labeled_history_id
+
+	later_id, later_history_id = mailbox.deliver('subject', 'snippet')
+	assert mail.process_history(service_pool, history_sync, label_batcher, analyze_many, later_history_id)
+	assert history_sync.cursor.get() == later_history_id
+
+def test_mail_without_texts_does_not_hold_the_cursor(mailbox, service_pool, inbox):
+	history_sync, label_batcher = inbox
+	mail_id, history_id = mailbox.deliver('subject', 'snippet')
+	del mailbox.mails[mail_id]['snippet']
+
+	assert mail.process_history(service_pool, history_sync, label_batcher, analyze_many, history_id)
+	assert history_sync.cursor.get() == history_id
+
+def test_mail_which_could_not_be_fetched_is_processed_on_redelivery(mailbox, service_pool, inbox):
+	history_sync, label_batcher = inbox
+	seed_history_id = history_sync.cursor.get()
+	unavailable_id, unavailable_history_id = mailbox.deliver('subject', 'snippet')
+	labeled_id, labeled_history_id = mailbox.deliver('subject', 'snippet')
+	mailbox.unavailable_mail_ids.add(unavailable_id)
+
+	assert not mail.process_history(service_pool, history_sync, label_batcher, analyze_many, labeled_history_id)
+	assert labeled_id in mailbox.labeled_at
+	assert history_sync.cursor.get() == seed_history_id
+
+	mailbox.unavailable_mail_ids.clear()
+	assert mail.process_history(service_pool, history_sync, label_batcher, analyze_many, labeled_history_id)
+	assert unavailable_id in mailbox.labeled_at
+	assert history_sync.cursor.get() == labeled_history_id
+
+def test_mail_which_keeps_failing_is_given_up_on(mailbox, service_pool, inbox):
+	history_sync, label_batcher = inbox
+	seed_history_id = history_sync.cursor.get()
+	unavailable_id, unavailable_history_id = mailbox.deliver('subject', 'snippet')
+	mailbox.unavailable_mail_ids.add(unavailable_id)
+
+	for attempt in range(history_sync.max_failures - 1):
+		assert not mail.process_history(service_pool, history_sync, label_batcher, analyze_many, unavailable_history_id)
+		assert history_sync.cursor.get() == seed_history_id
+	assert mail.process_history(service_pool, history_sync, label_batcher, analyze_many, unavailable_history_id)
+	assert history_sync.cursor.get() == unavailable_history_id
@@ -0,0 +1,101 @@
+import time
+
+import pytest
+
+from labels import LabelBatcher, LabelCache
+
+@pytest.fixture
+def label_cache(service_pool):
+	label_cache = LabelCache()
+	with service_pool.borrow() as service:
+		label_cache.warm(service, ['positive', 'negative'])
+	return label_cache
+
+def test_single_assignment_is_applied_within_the_window(mailbox, service_pool, label_cache):
+	mail_id, history_id = mailbox.deliver('subject', 'snippet')
+	label_batcher = LabelBatcher(service_pool, label_cache, window=0.05, max_size=1000)
+	try:
+		start = time.monotonic()
+		assert label_batcher.add(mail_id, 'positive').result(timeout=1)
+		assert time.monotonic() - start < 0.5
+		assert label_cache.peek('positive') in mailbox.get_mail(mail_id)['labelIds']
+	finally:
+		label_batcher.close()
+
+def test_assignments_are_applied_with_one_request_per_label(mailbox, service_pool, label_cache):
+	mail_ids = [mailbox.deliver('subject', 'snippet')[0] for i in range(5)]
+	label_batcher = LabelBatcher(service_pool, label_cache, window=0.05, max_size=1000)
+	try:
+		futures = [label_batcher.add(mail_id, 'negative' if i == 0 else 'positive') for i, mail_id in enumerate(mail_ids)]
+		assert all(future.result(timeout=1) for future in futures)
+	finally:
+		label_batcher.close()
+	assert mailbox.stats()['calls']['messages.batchModify'] == 2
+
+def test_mail_which_already_has_the_label_is_skipped(mailbox, service_pool, label_cache):
+	mail_id, history_id = mailbox.deliver('subject', 'snippet')
+	label_batcher = LabelBatcher(service_pool, label_cache, window=0.05, max_size=1000)
+	try:
+		assert not label_batcher.add(mail_id, 'positive', [label_cache.peek('positive')]).result(timeout=1)
+	finally:
+		label_batcher.close()
+	assert 'messages.batchModify' not in mailbox.stats()['calls']
+
+def test_close_applies_the_buffered_assignments(mailbox, service_pool, label_cache):
+	mail_id, history_id = mailbox.deliver('subject', 'snippet')
+	label_batcher = LabelBatcher(service_pool, label_cache, window=60, max_size=1000)
+	future = label_batcher.add(mail_id, 'positive')
+	label_batcher.close()
+	assert future.result(timeout=1)
+
+def test_mail_which_no_longer_exists_is_dropped_from_the_chunk(mailbox, service_pool, label_cache):
+	mail_ids = [mailbox.deliver('subject', 'snippet')[0] for i in range(3)]
+	del mailbox.mails[mail_ids[1]]
+	label_batcher = LabelBatcher(service_pool, label_cache, window=0.05, max_size=1000)
+	try:
+		futures = [label_batcher.add(mail_id, 'positive') for mail_id in mail_ids]
+		assert [future.result(timeout=1) for future in futures] == [True, None, True]
+	finally:
+		label_batcher.close()
+	assert mailbox.stats()['calls']['messages.batchModify'] == 2
+	assert sorted(mailbox.labeled_at) == sorted([mail_ids[0], mail_ids[2]])
+
+def test_missing_label_is_looked_up_again(mailbox, service_pool, label_cache):
+	mail_id, history_id = mailbox.deliver('subject', 'snippet')
+	label_cache.put('positive', 'Label_deleted')
+	label_batcher = LabelBatcher(service_pool, label_cache, window=0.05, max_size=1000)
+	try:
+		assert label_batcher.add(mail_id, 'positive').result(timeout=1)
+	finally:
+		label_batcher.close()
+	assert label_cache.peek('positive') != 'Label_deleted'
+	assert label_cache.peek('positive') in mailbox.get_mail(mail_id)['labelIds']
+
+def test_mails_are_split_when_the_retry_of_a_chunk_fails(mailbox, service_pool, label_cache):
+	mail_ids = [mailbox.deliver('subject', 'snippet')[0] for i in range(6)]
+	# the fake inbox only names the first mail which no longer exists, so the retry without it fails too
+	del mailbox.mails[mail_ids[1]]
+	del mailbox.mails[mail_ids[4]]
+	label_batcher = LabelBatcher(service_pool, label_cache, window=0.05, max_size=1000)
+	try:
+		futures = [label_batcher.add(mail_id, 'positive') for mail_id in mail_ids]
+		assert [future.result(timeout=1) for future in futures] == [True, None, True, True, None, True]
+	finally:
+		label_batcher.close()
+	assert sorted(mailbox.labeled_at) == sorted([mail_ids[0], mail_ids[2], mail_ids[3], mail_ids[5]])
+
+def test_single_mail_rejected_with_a_404_no_longer_exists(mailbox, service_pool, label_cache, monkeypatch):
+	mail_ids = [mailbox.deliver('subject', 'snippet')[0] for i in range(3)]
+	add_label = mailbox.add_label
+	def add_label_without_ids(mail_ids, label_ids):
+		# an error which does not name the mail which no longer exists
+		result = add_label(mail_ids, label_ids)
+		return None if result is None else (result[0], b'Requested entity was not found.')
+	monkeypatch.setattr(mailbox, 'add_label', add_label_without_ids)
+	del mailbox.mails[mail_ids[2]]
+	label_batcher = LabelBatcher(service_pool, label_cache, window=0.05, max_size=1000)
+	try:
+		futures = [label_batcher.add(mail_id, 'positive') for mail_id in mail_ids]
+		assert [future.result(timeout=1) for future in futures] == [True, True, None]
+	finally:
+		label_batcher.close()
@@ -0,0 +1,79 @@
+import datetime
+import random
+import sqlite3
+
+import pytest
+
+from metrics import metrics
+
+# a day boundary (UTC), so that ranges start and end at days, hours and within hours
+DAY = 1600041600
+
+@pytest.fixture
+def mail_stats(tmp_path):
+	mail_stats = metrics(db_name=str(tmp_path / 'mailsense.db'))
+	yield mail_stats
+	mail_stats.close()
+
+def write_entries(mail_stats, entries):
+	conn = sqlite3.connect(mail_stats.DB_NAME)
+	with conn:
+		mail_stats.writeBatch(conn, entries)
+	conn.close()
+
+def count_entries(entries, start, end):
+	counts = {}
+	for timestamp, polarity in entries:
+		if start <= timestamp < end:
+			counts[polarity] = counts.get(polarity, 0) + 1
+	return counts
+
+def test_rollups_count_like_the_entries(mail_stats):
+	choices = random.Random(0)
+	entries = [(DAY - 86400 + choices.randrange(4 * 86400), choices.choice(['positive', 'neutral', 'negative'])) for i in range(2000)]
+	# written in several batches, which add to the same buckets
+	for i in range(0, len(entries), 300):
+		write_entries(mail_stats, entries[i:i + 300])
+
+	ranges = [(None, None), (DAY, DAY + 86400), (DAY + 1800, DAY + 2 * 86400 + 5400), (DAY + 3600, DAY + 7200), (DAY + 10, DAY + 20)]
+	ranges += [tuple(sorted(choices.randrange(DAY - 86400, DAY + 3 * 86400) for j in range(2))) for i in range(50)]
+	for start, end in ranges:
+		expected = count_entries(entries, 0 if start is None else start, float('inf') if end is None else end)
+		assert mail_stats.countPolarities(start, end) == expected
+
+	hourly = mail_stats.countPolaritiesByBucket(DAY, DAY + 86400, 'hour')
+	assert sum(count for hour, polarity, count in hourly) == sum(count_entries(entries, DAY, DAY + 86400).values())
+	assert all(DAY <= hour < DAY + 86400 and hour % 3600 == 0 for hour, polarity, count in hourly)
+
+def test_added_polarities_are_written_on_close(tmp_path):
+	mail_stats = metrics(flush_interval=60, db_name=str(tmp_path / 'mailsense.db'))
+	for polarity in ['positive', 'positive', 'negative']:
+		mail_stats.addPolarity(polarity)
+	mail_stats.close()
+
+	mail_stats = metrics(db_name=str(tmp_path / 'mailsense.db'))
+	try:
+		assert mail_stats.countPolarities() == {'positive': 2, 'negative': 1}
+		assert sum(count for day, polarity, count in mail_stats.countPolaritiesByBucket()) == 3
+	finally:
+		mail_stats.close()
+
+def test_legacy_datetimes_are_migrated_with_their_rollups(tmp_path):
+	path = str(tmp_path / 'mailsense.db')
+	conn = sqlite3.connect(path)
+	with conn:
+		conn.execute('create table polarities (datetime text, polarity text)')
+		# local datetimes were stored as sqlite3 adapts them, with their utc offset
+		local = datetime.timezone(datetime.timedelta(hours=2))
+		conn.executemany('insert into polarities values (?, ?)', [
+			(datetime.datetime.fromtimestamp(timestamp, local).isoformat(' '), polarity)
+			for timestamp, polarity in [(DAY + 60, 'positive'), (DAY + 7200, 'negative'), (DAY + 86400, 'positive')]
+		])
+	conn.close()
+
+	mail_stats = metrics(db_name=path)
+	try:
+		assert mail_stats.countPolarities(DAY, DAY + 86400) == {'positive': 1, 'negative': 1}
+		assert mail_stats.countPolaritiesByBucket(bucket='day') == [(DAY, 'negative', 1), (DAY, 'positive', 1), (DAY + 86400, 'positive', 1)]
+	finally:
+		mail_stats.close()
@@ -0,0 +1,33 @@
+import sqlite3
+import time
+
+from predictioncache import PredictionCache
+
+def count_persisted(path):
+	conn = sqlite3.connect(path)
+	try:
+		return conn.execute('select count(*) from predictions').fetchone()[0]
+	finally:
+		conn.close()
+
+def test_predictions_are_persisted_in_the_background(tmp_path):
+	path = str(tmp_path / 'mailsense.cache')
+	cache = PredictionCache(10, path, flush_interval=0.05)
+	cache.put_many('nltk', 'vader', ['great news', 'bad news'], ['positive', 'negative'])
+
+	deadline = time.time() + 5
+	while count_persisted(path) < 2 and time.time() < deadline:
+		time.sleep(0.01)
+	assert count_persisted(path) == 2
+	cache.close()
+
+def test_close_persists_the_pending_predictions(tmp_path):
+	path = str(tmp_path / 'mailsense.cache')
+	cache = PredictionCache(2, path, flush_interval=60)
+	cache.put_many('nltk', 'vader', ['great news', 'bad news', 'old news'], ['positive', 'negative', 'neutral'])
+	assert count_persisted(path) == 0
+	cache.close()
+
+	cache = PredictionCache(2, path)
+	assert cache.get_many('nltk', 'vader', ['great news', 'bad news', 'old news']) == [None, 'negative', 'neutral']
+	cache.close()
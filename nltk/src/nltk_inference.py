@@ -1,11 +1,86 @@
 #!/usr/bin/env python3
 
 import argparse
+import string
 
 import nltk
-nltk.download('vader_lexicon')
 from nltk.sentiment.vader import SentimentIntensityAnalyzer as SIA
 
+# nltk data required by the model: list of tuples (package name, resource path)
+NLTK_RESOURCES = [('vader_lexicon', 'sentiment/vader_lexicon.zip')]
+# maximum number of distinct raw tokens remembered as having a lexicon word or not
+TOKEN_CACHE_SIZE = 100000
+
+class DeduplicatingScorer(object):
+	'''Predicts the polarity of batches of texts with the same results as SentimentIntensityAnalyzer.polarity_scores,
+	calling polarity_scores once per distinct text which has a lexicon word.
+
+	Scoring is not vectorized: repeated texts of a batch are scored once, and texts without any word which could be
+	a lexicon word are classified as neutral without being scored, since every valence rule of the analyzer applies
+	to lexicon words only. Whether a raw token could be a lexicon word is cached.
+	'''
+	def __init__(self, analyzer):
+		'''Initializes a DeduplicatingScorer object.
+
+		Args:
+			analyzer: An initialized SentimentIntensityAnalyzer.
+		'''
+		super(DeduplicatingScorer, self).__init__()
+		self.analyzer = analyzer
+		self.lexicon = analyzer.lexicon
+		# raw token as key, whether it could be a lexicon word as value
+		self.tokens = {}
+
+	def is_lexicon_token(self, token):
+		'''Returns whether a whitespace separated token could be looked up as a lexicon word by the analyzer.
+
+		Depending on the nltk version, the analyzer strips a run of punctuation from either end of a token or from both ends,
+		so every such stripped form is checked.
+
+		Args:
+			token: Raw token of a text.
+		'''
+		is_lexicon = self.tokens.get(token)
+		if is_lexicon is not None:
+			return is_lexicon
+
+		lower = token.lower()
+		start = len(lower) - len(lower.lstrip(string.punctuation))
+		end = len(lower.rstrip(string.punctuation))
+		candidates = [lower[i:] for i in range(start + 1)] + [lower[:j] for j in range(end, len(lower))] + [lower[start:end]]
+		is_lexicon = any(candidate in self.lexicon for candidate in candidates)
+
+		if len(self.tokens) >= TOKEN_CACHE_SIZE:
+			self.tokens.clear()
+		self.tokens[token] = is_lexicon
+		return is_lexicon
+
+	def predict_text(self, text):
+		'''Returns the polarity of a text.
+
+		Args:
+			text: Text to classify.
+		'''
+		tokens = text.split()
+		# tokens of a single character are not words of the analyzer, so texts of only such tokens are scored as they are
+		if any(len(token) > 1 for token in tokens) and not any(self.is_lexicon_token(token) for token in tokens):
+			# every word is neutral
+			return get_polarity(0.0, 1.0, 0.0)
+		preds = self.analyzer.polarity_scores(text)
+		return get_polarity(preds['neg'], preds['neu'], preds['pos'])
+
+	def predict_batch(self, texts):
+		'''Returns the polarity of each text.
+
+		Args:
+			texts: List of texts to classify.
+		'''
+		polarities = {}
+		for text in texts:
+			if text not in polarities:
+				polarities[text] = self.predict_text(text)
+		return [polarities[text] for text in texts]
+
 def initialize_model():
 	'''Initializes a nltk sentiment intensity analysis model.
 	'''
@@ -13,6 +88,14 @@ def initialize_model():
 	global analyzer
 	analyzer = SIA()
 
+	global scorer
+	scorer = DeduplicatingScorer(analyzer)
+
+def get_identity():
+	'''Returns a string identifying the loaded model by its library version.
+	'''
+	return 'nltk-vader-' + nltk.__version__
+
 def predict(text):
 	'''Returns the polarity value after performing inference on a text.
 
@@ -22,11 +105,29 @@ def predict(text):
 		text: Text to perform inference on.
 	'''
 	preds = analyzer.polarity_scores(text)
-	if 'compound' in preds:
-		del preds['compound']
+	return get_polarity(preds['neg'], preds['neu'], preds['pos'])
 
+def predict_batch(texts):
+	'''Returns the polarity values after performing inference on several texts.
+
+	Gives the same results as predict, scoring repeated texts once and texts without lexicon words not at all.
+
+	Args:
+		texts: List of texts to perform inference on.
+	'''
+	return scorer.predict_batch(texts)
+
+def get_polarity(neg, neu, pos):
+	'''Returns the polarity value with the highest score, preferring negative then neutral on ties.
+
+	Args:
+		neg: Negative score.
+		neu: Neutral score.
+		pos: Positive score.
+	'''
 	# get the key with the max value
-	polarity = max(preds, key=preds.get)
+	scores = {'neg': neg, 'neu': neu, 'pos': pos}
+	polarity = max(scores, key=scores.get)
 	if polarity == 'pos':
 		return 'positive'
 	elif polarity == 'neu':
@@ -37,8 +138,13 @@ def predict(text):
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='process arguments required for performing inference with trained model on input text')
 	parser.add_argument('-t', '--text', help='string: text to perform inference on', type=str, action='store', required=True)
+	parser.add_argument('-dl', '--download', help='download the required nltk data', action='store_true')
 	args = parser.parse_args()
 
+	if args.download:
+		for package, resource_path in NLTK_RESOURCES:
+			nltk.download(package)
+
 	initialize_model()
 	polarity = predict(args.text)
 	print(polarity)
@@ -0,0 +1,87 @@
+import os
+import random
+import sys
+
+import nltk
+import pytest
+from nltk.sentiment.vader import SentimentIntensityAnalyzer as SIA
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+import nltk_inference
+
+# the dataset split by fastai/src/split.py, retrieved with dvc
+SPLIT_DATASET_PATH = os.path.join(os.path.dirname(__file__), '../../data/result/split_dataset.csv')
+# nltk data directory with a few entries of the vader lexicon, so that the scorer is checked without the nltk data being downloaded
+BUNDLED_DATA_PATH = os.path.join(os.path.dirname(__file__), 'data')
+
+TEXTS = [
+	'', ' ', 'a', 'a b c', '!', ':)', ':-(', 'I', 'GOOD', 'good', 'Good!', 'good!!!', '...good', 'good?!', '"good"', "'bad'",
+	'This is not good', 'This is NOT GOOD at all', 'The movie was kind of good', 'kind of', 'It was good, but the ending was terrible',
+	'He is the shit', 'That was a kiss of death', 'yeah right', 'never so good', 'without doubt the best', 'least bad option',
+	'Meeting notes for Tuesday', 'Invoice 2041 attached', 'Your payment has failed', 'Thanks a lot, this is excellent!',
+	'I am disappointed and frustrated with the lack of response.', 'extremely happy', 'very very bad', 'no', 'No way',
+	'The report covers the period from the first to the last day of the month.', 'x y z!!!', 'good good good bad',
+]
+
+@pytest.fixture(scope='module')
+def analyzer():
+	try:
+		nltk_inference.initialize_model()
+	except LookupError:
+		pytest.skip('the vader lexicon is not installed')
+	return nltk_inference.analyzer
+
+@pytest.fixture(scope='module')
+def bundled_analyzer():
+	nltk.data.path.insert(0, os.path.abspath(BUNDLED_DATA_PATH))
+	try:
+		return SIA(lexicon_file='sentiment/vader_lexicon.txt')
+	finally:
+		nltk.data.path.remove(os.path.abspath(BUNDLED_DATA_PATH))
+
+def predict_each(analyzer, texts):
+	polarities = []
+	for text in texts:
+		preds = analyzer.polarity_scores(text)
+		polarities.append(nltk_inference.get_polarity(preds['neg'], preds['neu'], preds['pos']))
+	return polarities
+
+def generate_texts(analyzer, count, seed=0):
+	'''Returns random texts mixing lexicon words with negations, boosters, capitals, punctuation and neutral words.
+	'''
+	choices = random.Random(seed)
+	lexicon_words = sorted(analyzer.lexicon)
+	other_words = ['not', 'never', 'very', 'kind', 'of', 'but', 'the', 'mail', 'a', 'I', 'meeting', 'no', 'least', 'without', 'doubt']
+	punctuation = ['', '', '', '!', '!!', '?', '?!', '.', ',', '...', '"', "'"]
+	texts = []
+	for i in range(count):
+		words = []
+		for j in range(choices.randint(0, 12)):
+			word = choices.choice(lexicon_words) if choices.random() < 0.3 else choices.choice(other_words)
+			if choices.random() < 0.1:
+				word = word.upper()
+			if choices.random() < 0.2:
+				word = choices.choice(punctuation) + word
+			words.append(word + choices.choice(punctuation))
+		texts.append(' '.join(words))
+	return texts
+
+def test_scorer_matches_polarity_scores_with_the_bundled_lexicon(bundled_analyzer):
+	texts = TEXTS + generate_texts(bundled_analyzer, 5000)
+	texts += texts[:100]
+	scorer = nltk_inference.DeduplicatingScorer(bundled_analyzer)
+	assert scorer.predict_batch(texts) == predict_each(bundled_analyzer, texts)
+
+def test_scorer_matches_polarity_scores(analyzer):
+	texts = TEXTS + generate_texts(analyzer, 5000)
+	assert nltk_inference.predict_batch(texts) == predict_each(analyzer, texts)
+
+def test_scorer_matches_polarity_scores_on_the_test_split(analyzer):
+	if not os.path.exists(SPLIT_DATASET_PATH):
+		pytest.skip('the split dataset has not been retrieved')
+	import pandas as pd
+
+	df = pd.read_csv(SPLIT_DATASET_PATH)
+	texts = df[df['set'] == 'test']['text'].astype(str).tolist()
+	assert nltk_inference.predict_batch(texts) == predict_each(analyzer, texts)
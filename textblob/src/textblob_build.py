@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+# This script trains the textblob naive bayes analyzer and saves it as an artifact,
+# so that initializing the textblob model only loads it.
+
+import argparse
+import time
+
+import textblob_inference
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='process arguments required for building the trained textblob analyzer artifact')
+	parser.add_argument('-ad', '--artifactdirectory', help='string: directory to save the artifact to', type=str, action='store', default=textblob_inference.ARTIFACT_DIR)
+	parser.add_argument('-dl', '--download', help='download the required nltk data', action='store_true')
+	args = parser.parse_args()
+
+	if args.download:
+		textblob_inference.download_resources(build=True)
+
+	start = time.time()
+	artifact_path = textblob_inference.build_artifact(args.artifactdirectory)
+	print('built {ap} in {s:.1f}s'.format(ap=artifact_path, s=time.time() - start))
+
+	start = time.time()
+	textblob_inference.initialize_model(args.artifactdirectory)
+	print('loaded in {s:.2f}s'.format(s=time.time() - start))
@@ -1,49 +1,31 @@
 #!/usr/bin/env python3
 
-# This script evaluates a textblob model on a test set.
+# This script evaluates a textblob model on a test set, using the shared evaluation harness (mail/src/evaluation.py).
 
-import nltk
-nltk.download('stopwords')
-from nltk.corpus import stopwords
-stop_words = stopwords.words('english')
-
-import pandas as pd
 import argparse
-
-import textblob_inference
-
-parser = argparse.ArgumentParser(description='process arguments required for performing inference with trained model on input text')
-parser.add_argument('-dp', '--datasetpath', help='str: path to csv dataset', type=str, action='store', required=True)
-parser.add_argument('-op', '--outputpath', help='str: path to output file containing model accuracy', type=str, action='store', required=True)
-args = parser.parse_args()
-
-DATASET_COMPONENT_LABEL = 'set'
-DATASET_TEXT_LABEL = 'text'
-DATASET_TARGET_LABEL = 'polarity'
-
-df = pd.read_csv(args.datasetpath)
-test_df = df[df[DATASET_COMPONENT_LABEL] == 'test']
-test_df['text'] = test_df['text'].str.replace('[^a-zA-Z ]', '')
-
-print('Test Size: ' + str(len(test_df)))
-
-textblob_inference.initialize_model()
-
-correct = 0
-total = 0
-for i in range(0, len(test_df)):
-	to_predict = str(test_df.iloc[i][DATASET_TEXT_LABEL])
-	target = str(test_df.iloc[i][DATASET_TARGET_LABEL])
-
-	# get the polarity prediction
-	result = textblob_inference.predict(to_predict)
-	if result == target:
-		correct = correct + 1
-
-	total = total + 1
-
-accuracy = (correct / total * 100)
-print('accuracy: ' + str(accuracy))
-
-with open(args.outputpath, 'w') as f:
-	f.write(str(accuracy))
\ No newline at end of file
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../mail/src'))
+import evaluation
+from sentimentanalysis import ModelType
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='process arguments required for evaluating a model on a test set')
+	parser.add_argument('-dp', '--datasetpath', help='str: path to csv dataset', type=str, action='store', required=True)
+	parser.add_argument('-op', '--outputpath', help='str: path to output file containing model accuracy', type=str, action='store', required=True)
+	parser.add_argument('-rp', '--reportpath', help='str: path to output json file containing the full evaluation report', type=str, action='store', required=False)
+	parser.add_argument('-bs', '--batchsize', help='int: number of texts predicted together', type=int, action='store', default=256)
+	parser.add_argument('-cd', '--cachedir', help='str: directory of the cached preprocessed test rows, defaults to mailsense/preprocessed in the user cache directory (~/.cache)', type=str, action='store', required=False)
+	parser.add_argument('-nc', '--nocache', help='preprocess the test rows without caching them', action='store_true')
+	parser.add_argument('-sh', '--shards', help='int: number of processes the test set is split between', type=int, action='store', default=1)
+	parser.add_argument('-dl', '--download', help='download the required nltk data', action='store_true')
+	args = parser.parse_args()
+
+	cache_dir = None if args.nocache else args.cachedir or evaluation.get_default_cache_dir()
+	report = evaluation.evaluate(ModelType.textblob, None, args.datasetpath, args.batchsize, args.shards, download=args.download, cache_dir=cache_dir)
+	evaluation.print_report(report)
+	if args.reportpath is not None:
+		evaluation.write_report(report, args.reportpath)
+	with open(args.outputpath, 'w') as f:
+		f.write(str(report['accuracy']))
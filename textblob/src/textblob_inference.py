@@ -1,21 +1,116 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import os
+import pickle
+import tempfile
 
 from textblob import TextBlob
 from textblob.en.sentiments import NaiveBayesAnalyzer
 import nltk
 
-def initialize_model():
+# the corpus the naive bayes analyzer is trained on
+CORPUS = 'movie_reviews'
+# nltk data required by the model: list of tuples (package name, resource path)
+NLTK_RESOURCES = [('punkt', 'tokenizers/punkt')]
+# nltk data additionally required to build the trained analyzer artifact
+BUILD_NLTK_RESOURCES = [(CORPUS, 'corpora/' + CORPUS)]
+ARTIFACT_DIR = os.path.join(os.path.dirname(__file__), '../models')
+
+def get_version(package):
+	'''Returns the installed version of a package.
+
+	Args:
+		package: Name of the package.
+	'''
+	try:
+		from importlib.metadata import version
+		return version(package)
+	except ImportError:
+		import pkg_resources
+		return pkg_resources.get_distribution(package).version
+
+def get_artifact_key():
+	'''Returns the key of the trained analyzer artifact, based on the training corpus and the library versions.
+	'''
+	key = '{c}-textblob-{tv}-nltk-{nv}'.format(c=CORPUS, tv=get_version('textblob'), nv=get_version('nltk'))
+	return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+def get_artifact_path(artifact_dir=ARTIFACT_DIR):
+	'''Returns the path of the trained analyzer artifact for the installed library versions.
+
+	Args:
+		artifact_dir: Directory of the trained analyzer artifacts.
+	'''
+	return os.path.join(artifact_dir, 'naivebayes-{k}.pickle'.format(k=get_artifact_key()))
+
+def download_resources(build=False):
+	'''Downloads the nltk data required by the model.
+
+	Args:
+		build: Whether to also download the data required to build the trained analyzer artifact.
+	'''
+	for package, resource_path in NLTK_RESOURCES + (BUILD_NLTK_RESOURCES if build else []):
+		nltk.download(package)
+
+def build_artifact(artifact_dir=ARTIFACT_DIR):
+	'''Trains a naive bayes analyzer on the corpus and saves its classifier as an artifact.
+	Returns the path of the artifact.
+
+	Args:
+		artifact_dir: Directory of the trained analyzer artifacts.
+	'''
+	trained_analyzer = NaiveBayesAnalyzer()
+	trained_analyzer.train()
+
+	artifact_path = get_artifact_path(artifact_dir)
+	if not os.path.exists(artifact_dir):
+		os.makedirs(artifact_dir)
+	artifact = {
+		'corpus': CORPUS,
+		'textblob': get_version('textblob'),
+		'nltk': get_version('nltk'),
+		'classifier': trained_analyzer._classifier
+	}
+	# write to a temporary file of its own first so that a partially written artifact is never loaded,
+	# even when several processes build the artifact at once
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(artifact_path), suffix='.tmp')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_path, artifact_path)
+	except BaseException:
+		os.remove(tmp_path)
+		raise
+	return artifact_path
+
+def initialize_model(artifact_dir=ARTIFACT_DIR):
 	'''Initializes a textblob naive bayes sentiment analysis model.
+
+	Loads the trained classifier from its artifact, building the artifact first if it does not exist.
+
+	Args:
+		artifact_dir: Directory of the trained analyzer artifacts.
 	'''
-	nltk.download('movie_reviews')
-	nltk.download('punkt')
+	artifact_path = get_artifact_path(artifact_dir)
+	if not os.path.exists(artifact_path):
+		build_artifact(artifact_dir)
+
+	with open(artifact_path, 'rb') as f:
+		artifact = pickle.load(f)
 
 	# prevent exposing the learner
 	global analyzer
 	analyzer = NaiveBayesAnalyzer()
-	analyzer.train()
+	analyzer._classifier = artifact['classifier']
+	# the analyzer would otherwise train itself on its first analysis
+	analyzer._trained = True
+
+def get_identity():
+	'''Returns a string identifying the loaded model by its corpus and library versions.
+	'''
+	return 'textblob-naivebayes-' + get_artifact_key()
 
 def predict(text):
 	'''Returns the polarity value after performing inference on a text.
@@ -26,9 +121,26 @@ def predict(text):
 	Args:
 		text: Text to perform inference on.
 	'''
+	preds = analyzer.analyze(text)
+	return get_polarity(preds)
+
+def predict_batch(texts):
+	'''Returns the polarity values after performing inference on several texts.
+
+	Args:
+		texts: List of texts to perform inference on.
+	'''
+	return [get_polarity(analyzer.analyze(text)) for text in texts]
+
+def get_polarity(preds):
+	'''Returns the polarity value for the result of the naive bayes analyzer.
+	If the difference between positive and negative probabilities is too small, the result is considered neutral.
+
+	Args:
+		preds: Result of the analyzer: (classification, positive probability, negative probability)
+	'''
 	MIN_DELTA = 0.1
 
-	preds = analyzer.analyze(text)
 	p_pos = preds[1]
 	p_neg = preds[2]
 	diff = p_pos - p_neg
@@ -42,8 +154,12 @@ def predict(text):
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='process arguments required for performing inference with trained model on input text')
 	parser.add_argument('-t', '--text', help='string: text to perform inference on', type=str, action='store', required=True)
+	parser.add_argument('-dl', '--download', help='download the required nltk data', action='store_true')
 	args = parser.parse_args()
 
+	if args.download:
+		download_resources(build=True)
+
 	initialize_model()
 	polarity = predict(args.text)
 	print(polarity)